@@ -4,20 +4,26 @@
 """
 import os
 import time
+import asyncio
+import hashlib
 from typing import List, Dict, Optional, Tuple
 from PIL import Image
 import io
 import base64
 
-from gemini_client import GeminiClient
-from image_processor import ImageProcessor
+from gemini_client import get_gemini_client, get_async_gemini_client, run_async, analysis_to_mockup_args
+from image_processor import ImageProcessor, PreparedImage
 from cache_manager import CacheManager
-from config import OUTPUT_DIR, BATCH_SIZE
+from prompt_templates import render_mockup_prompt
+from usage_ledger import usage_context, usage_tally, estimate_mockup_call
+from retry_policy import classify_error, is_cacheable_failure
+from config import OUTPUT_DIR, BATCH_SIZE, MAX_CONCURRENT_REQUESTS, COLLECTION_ANALYSIS_CHUNK_SIZE
 
 class BatchProcessor:
     def __init__(self):
         """Инициализация пакетного процессора"""
-        self.gemini_client = GeminiClient()
+        self.gemini_client = get_gemini_client()
+        self.async_gemini_client = get_async_gemini_client()
         self.image_processor = ImageProcessor()
         self.cache_manager = CacheManager()
         
@@ -45,6 +51,26 @@ class BatchProcessor:
         start_time = time.time()
         
         try:
+            # Создание промпта для анализа коллекции
+            collection_prompt = self._create_collection_analysis_prompt(
+                product_color, collection_style, len(product_images)
+            )
+            
+            # Проверка кэша: тот же набор товаров (в том же порядке), логотип и настройки
+            cache_key = self._get_analysis_cache_key(
+                product_images, logo_image, product_color, collection_style, collection_prompt
+            )
+            cached_result = self.cache_manager.get_cached_result(cache_key)
+            if cached_result and cached_result["result"].get("individual_prompts"):
+                print("Использован кэшированный анализ коллекции")
+                return {
+                    "status": "success",
+                    "source": "cache",
+                    "individual_prompts": cached_result["result"]["individual_prompts"],
+                    "collection_theme": cached_result["result"].get("collection_theme"),
+                    "processing_time": time.time() - start_time
+                }
+            
             # Обработка изображений для API
             processed_products = []
             for img in product_images:
@@ -53,10 +79,12 @@ class BatchProcessor:
             
             processed_logo = self.image_processor.optimize_for_api(logo_image)
             
-            # Создание промпта для анализа коллекции
-            collection_prompt = self._create_collection_analysis_prompt(
-                product_color, collection_style, len(product_images)
-            )
+            # Большая коллекция: части анализируются параллельно (ответ на всю коллекцию обрывается)
+            if len(processed_products) > COLLECTION_ANALYSIS_CHUNK_SIZE:
+                return self._analyze_in_chunks(
+                    product_images, processed_products, processed_logo,
+                    product_color, collection_style, cache_key, start_time
+                )
             
             # Отправка запроса в Gemini для анализа коллекции
             print(f"Анализируем коллекцию из {len(processed_products)} товаров...")
@@ -64,8 +92,14 @@ class BatchProcessor:
                 processed_products, processed_logo, collection_prompt
             )
             
-            if analysis_result and "individual_prompts" in analysis_result:
+            if analysis_result and analysis_result.get("individual_prompts"):
                 print(f"✅ AI анализ успешен, получено {len(analysis_result['individual_prompts'])} промптов")
+                complete = self._is_complete_analysis(analysis_result, len(product_images))
+                analysis_result["individual_prompts"] = self._complete_prompts(
+                    analysis_result["individual_prompts"], product_images, product_color, collection_style
+                )
+                if complete:
+                    self._save_analysis_to_cache(cache_key, analysis_result)
                 return {
                     "status": "success",
                     "individual_prompts": analysis_result["individual_prompts"],
@@ -78,12 +112,18 @@ class BatchProcessor:
                     len(product_images), collection_prompt
                 )
                 
-                if text_analysis_result and "individual_prompts" in text_analysis_result:
+                if text_analysis_result and text_analysis_result.get("individual_prompts"):
                     print(f"✅ Текстовый AI анализ успешен, получено {len(text_analysis_result['individual_prompts'])} промптов")
+                    complete = self._is_complete_analysis(text_analysis_result, len(product_images))
+                    text_analysis_result["individual_prompts"] = self._complete_prompts(
+                        text_analysis_result["individual_prompts"], product_images, product_color, collection_style
+                    )
+                    if complete:
+                        self._save_analysis_to_cache(cache_key, text_analysis_result)
                     return {
                         "status": "success",
                         "individual_prompts": text_analysis_result["individual_prompts"],
-                        "collection_theme": text_analysis_result.get("collection_theme", collection_theme),
+                        "collection_theme": text_analysis_result.get("collection_theme"),
                         "processing_time": time.time() - start_time
                     }
                 else:
@@ -101,6 +141,128 @@ class BatchProcessor:
                 "processing_time": time.time() - start_time
             }
     
+    def _analyze_in_chunks(self, product_images: List[Image.Image], processed_products: List[Image.Image],
+                           processed_logo: Image.Image, product_color: str, collection_style: str,
+                           cache_key: str, start_time: float) -> Dict:
+        """
+        Анализ коллекции частями по COLLECTION_ANALYSIS_CHUNK_SIZE товаров
+        
+        Первая часть задает тему коллекции (collection_theme), остальные
+        отправляются параллельно с общим брифом стиля и этой темой; ответы
+        объединяются в один список промптов в исходном порядке, товары
+        неудавшихся частей получают базовые промпты.
+        """
+        total = len(processed_products)
+        chunks = [(start, processed_products[start:start + COLLECTION_ANALYSIS_CHUNK_SIZE])
+                  for start in range(0, total, COLLECTION_ANALYSIS_CHUNK_SIZE)]
+        print(f"Анализируем коллекцию из {total} товаров по частям (частей: {len(chunks)}, параллельно)...")
+        
+        async def analyze_chunk(start: int, chunk: List[Image.Image], collection_theme: Optional[str] = None):
+            return await self.async_gemini_client.analyze_collection(
+                chunk, processed_logo,
+                self._create_collection_analysis_prompt(product_color, collection_style, len(chunk)) +
+                self._create_chunk_brief(product_color, collection_style, start, len(chunk), total,
+                                         collection_theme)
+            )
+        
+        async def analyze_chunks():
+            first_result = await analyze_chunk(*chunks[0])
+            collection_theme = (first_result or {}).get("collection_theme")
+            other_results = await asyncio.gather(*[
+                analyze_chunk(start, chunk, collection_theme) for start, chunk in chunks[1:]
+            ])
+            return [first_result, *other_results], collection_theme
+        
+        chunk_results, collection_theme = run_async(analyze_chunks())
+        
+        individual_prompts = []
+        failed_chunks = 0
+        complete = True
+        for (start, chunk), chunk_result in zip(chunks, chunk_results):
+            chunk_prompts = (chunk_result or {}).get("individual_prompts") or []
+            if not chunk_prompts:
+                failed_chunks += 1
+                print(f"⚠️ Часть с товара {start + 1} не проанализирована, используем базовые промпты")
+            complete = complete and self._is_complete_analysis(chunk_result or {}, len(chunk))
+            # Позиции части фиксированы: недостающие промпты дополняются базовыми
+            individual_prompts.extend((chunk_prompts + [{}] * len(chunk))[:len(chunk)])
+        
+        individual_prompts = self._complete_prompts(individual_prompts, product_images,
+                                                    product_color, collection_style)
+        if failed_chunks == len(chunks):
+            return self._create_fallback_prompts(product_images, product_color, collection_style)
+        
+        analysis_result = {"individual_prompts": individual_prompts, "collection_theme": collection_theme}
+        if complete:
+            self._save_analysis_to_cache(cache_key, analysis_result)
+        print(f"✅ AI анализ по частям: {len(chunks) - failed_chunks}/{len(chunks)} частей успешно")
+        return {
+            "status": "success",
+            "individual_prompts": individual_prompts,
+            "collection_theme": collection_theme,
+            "processing_time": time.time() - start_time
+        }
+    
+    def _create_chunk_brief(self, product_color: str, collection_style: str,
+                            start: int, count: int, total: int,
+                            collection_theme: Optional[str] = None) -> str:
+        """Общий бриф коллекции для части: одинаковые правила и тема во всех частях"""
+        theme_line = f"\n- Тема коллекции (соблюдай во всех промптах): {collection_theme}" if collection_theme else ""
+        return f"""
+
+ЧАСТЬ КОЛЛЕКЦИИ: товары {start + 1}-{start + count} из {total} (остальные части анализируются отдельно)
+ОБЩИЙ БРИФ КОЛЛЕКЦИИ (одинаковый для всех частей):{theme_line}
+- Стиль всех товаров: {collection_style}
+- Цвет товаров: {product_color}
+- Нанесение: embroidery для текстиля, printing для гладких твердых поверхностей, sublimation для светлой синтетики
+- Размер логотипа: средний, если форма товара не требует иного
+- Цвет логотипа: как на фото
+Верни individual_prompts ровно для {count} товаров этой части в порядке изображений."""
+
+    def _complete_prompts(self, individual_prompts: List[Dict], product_images: List[Image.Image],
+                          product_color: str, collection_style: str) -> List[Dict]:
+        """
+        Промпты по числу товаров: при оборванном ответе недостающие товары и
+        поля дополняются базовыми промптами, лишние промпты отбрасываются
+        """
+        if len(individual_prompts) < len(product_images):
+            print(f"⚠️ Получено {len(individual_prompts)} промптов из {len(product_images)}, "
+                  f"остальные дополнены базовыми")
+        fallback = self._create_fallback_prompts(product_images, product_color, collection_style)
+        return [{**fallback_prompt, **prompt_data} for fallback_prompt, prompt_data
+                in zip(fallback["individual_prompts"], individual_prompts + [{}] * len(product_images))]
+    
+    def _is_complete_analysis(self, analysis_result: Dict, count: int) -> bool:
+        """
+        Анализ можно кэшировать: ответ не восстанавливался и содержит полный
+        промпт для каждого товара (без дополнения базовыми промптами)
+        """
+        prompts = analysis_result.get("individual_prompts") or []
+        return not analysis_result.get("repaired") and len(prompts) >= count and all(prompts[:count])
+    
+    def _get_analysis_cache_key(self, product_images: List[Image.Image], logo_image: Image.Image,
+                                product_color: str, collection_style: str,
+                                collection_prompt: str) -> str:
+        """Ключ кэша анализа коллекции: хеши товаров по порядку, логотипа и параметров промпта"""
+        product_hashes = [self.image_processor.generate_image_hash(img) for img in product_images]
+        logo_hash = self.image_processor.generate_image_hash(logo_image)
+        
+        return self.cache_manager.generate_cache_key(
+            ",".join(product_hashes), logo_hash, collection_style, {
+                "kind": "collection_analysis",
+                "product_color": product_color,
+                # Изменение текста промпта инвалидирует сохраненные анализы
+                "prompt_hash": hashlib.md5(collection_prompt.encode()).hexdigest()
+            }
+        )
+    
+    def _save_analysis_to_cache(self, cache_key: str, analysis_result: Dict):
+        """Сохранение разобранного анализа коллекции в кэш"""
+        self.cache_manager.save_to_cache(cache_key, {
+            "individual_prompts": analysis_result["individual_prompts"],
+            "collection_theme": analysis_result.get("collection_theme")
+        }, api_kind="collection_analysis")
+    
     def process_batch(self, product_images: List[Image.Image], 
                      logo_image: Image.Image, 
                      individual_prompts: List[Dict],
@@ -118,49 +280,40 @@ class BatchProcessor:
             Словарь с результатами обработки
         """
         
+        return run_async(self.process_batch_async(
+            product_images, logo_image, individual_prompts, collection_settings
+        ))
+    
+    async def process_batch_async(self, product_images: List[Image.Image],
+                                  logo_image: Image.Image,
+                                  individual_prompts: List[Dict],
+                                  collection_settings: Dict) -> Dict:
+        """
+        Пакетная обработка (см. process_batch): товары генерируются параллельно,
+        одновременно не более MAX_CONCURRENT_REQUESTS запросов к Gemini
+        """
+        
         start_time = time.time()
         results = []
+        # Вызовы пакета попадают в журнал использования под этой коллекцией
+        collection_id = collection_settings.get("collection_id") or f"collection_{int(start_time)}"
         
         try:
-            for i, (product_img, prompt_data) in enumerate(zip(product_images, individual_prompts)):
-                print(f"Обработка товара {i+1}/{len(product_images)}: Товар {i+1}")
-                
-                # Используем ОРИГИНАЛЬНОЕ изображение товара (не обработанное)
-                # Обрабатываем только для API (сжатие), но не меняем сам товар
-                processed_product = self.image_processor.optimize_for_api(product_img)
-                processed_logo = self.image_processor.optimize_for_api(logo_image)
-                
-                # Генерация мокапа с рекомендациями из анализа (используем промпт из одиночной генерации)
-                mockup_result = self.gemini_client.generate_mockup_with_analysis(
-                    processed_product, processed_logo, prompt_data, ""
-                )
-                
-                if mockup_result and len(mockup_result) > 0:
-                    mockup = mockup_result[0]
-                    results.append({
-                        "index": i,
-                        "product_name": product_name,
-                        "original_image": product_img,
-                        "mockup": mockup,
-                        "prompt_data": prompt_data,
-                        "status": "success"
-                    })
-                else:
-                    results.append({
-                        "index": i,
-                        "product_name": product_name,
-                        "original_image": product_img,
-                        "mockup": None,
-                        "prompt_data": prompt_data,
-                        "status": "failed",
-                        "error": "Не удалось сгенерировать мокап"
-                    })
-                
-                # Небольшая пауза между запросами
-                time.sleep(1)
+            logo_hash = self.image_processor.generate_image_hash(logo_image)
+            # Логотип одинаков для всех товаров - готовим его для API один раз
+            processed_logo = await asyncio.to_thread(self.image_processor.prepare_for_api, logo_image)
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+            
+            # Расход пакета копится по мере завершения вызовов - журнал не перечитывается
+            with usage_context(collection=collection_id), usage_tally() as usage:
+                results = list(await asyncio.gather(*[
+                    self._process_item_async(i, product_img, prompt_data, processed_logo,
+                                             logo_hash, len(product_images), semaphore)
+                    for i, (product_img, prompt_data) in enumerate(zip(product_images, individual_prompts))
+                ]))
             
             # Сохранение результатов
-            saved_paths = self._save_batch_results(results, collection_settings)
+            saved_paths = await asyncio.to_thread(self._save_batch_results, results, collection_settings)
             
             return {
                 "status": "success",
@@ -168,6 +321,8 @@ class BatchProcessor:
                 "saved_paths": saved_paths,
                 "total_processed": len(results),
                 "successful": len([r for r in results if r["status"] == "success"]),
+                "collection_id": collection_id,
+                "usage": usage,
                 "processing_time": time.time() - start_time
             }
             
@@ -180,6 +335,137 @@ class BatchProcessor:
                 "processing_time": time.time() - start_time
             }
     
+    async def _process_item_async(self, i: int, product_img: Image.Image, prompt_data: Dict,
+                                  processed_logo: PreparedImage, logo_hash: str, total: int,
+                                  semaphore: asyncio.Semaphore) -> Dict:
+        """Генерация мокапа одного товара пакета"""
+        product_name = f"Товар {i+1}"
+        
+        # Негативный кэш: пропускаем товары, генерация которых недавно не удалась
+        cache_key = await asyncio.to_thread(self._get_item_cache_key, product_img, logo_hash, prompt_data)
+        failure = await asyncio.to_thread(self.cache_manager.get_failure, cache_key)
+        if failure:
+            retry_in = max(0, int(failure["retry_after"] - time.time()))
+            print(f"Пропуск {product_name}: недавняя неудача ({failure['failure_type']}), повтор через {retry_in} с")
+            return {
+                "index": i,
+                "product_name": product_name,
+                "original_image": product_img,
+                "mockup": None,
+                "prompt_data": prompt_data,
+                "status": "failed",
+                "error": f"Генерация недавно не удалась, повторите через {retry_in} с"
+            }
+        
+        # Используем ОРИГИНАЛЬНОЕ изображение товара (не обработанное)
+        # Обрабатываем только для API (сжатие), но не меняем сам товар
+        processed_product = await asyncio.to_thread(self.image_processor.prepare_for_api, product_img)
+        
+        # Генерация мокапа с рекомендациями из анализа (используем промпт из одиночной генерации)
+        async with semaphore:
+            print(f"Обработка товара {i+1}/{total}: {product_name}")
+            try:
+                mockup_result = await self.async_gemini_client.generate_mockup_with_analysis(
+                    processed_product, processed_logo, prompt_data, ""
+                )
+            except Exception as e:
+                print(f"Ошибка генерации {product_name}: {e}")
+                error_type = classify_error(e)
+                if is_cacheable_failure(error_type):
+                    await asyncio.to_thread(self.cache_manager.record_failure, cache_key, error_type, str(e))
+                mockup_result = []
+            else:
+                if mockup_result and "image_data" in mockup_result[0]:
+                    await asyncio.to_thread(self.cache_manager.clear_failure, cache_key)
+                # Временные ошибки (лимиты, сбои API) не блокируют товар при следующем запуске
+                elif mockup_result and is_cacheable_failure(mockup_result[0].get("error_type", "no_images")):
+                    await asyncio.to_thread(
+                        self.cache_manager.record_failure,
+                        cache_key, mockup_result[0].get("error_type", "no_images"),
+                        mockup_result[0].get("error") or mockup_result[0].get("text", "")
+                    )
+        
+        if mockup_result and "image_data" in mockup_result[0]:
+            return {
+                "index": i,
+                "product_name": product_name,
+                "original_image": product_img,
+                "mockup": mockup_result[0],
+                "prompt_data": prompt_data,
+                "status": "success"
+            }
+        
+        return {
+            "index": i,
+            "product_name": product_name,
+            "original_image": product_img,
+            "mockup": None,
+            "prompt_data": prompt_data,
+            "status": "failed",
+            "error": "Не удалось сгенерировать мокап",
+            "error_type": mockup_result[0].get("error_type") if mockup_result else None,
+            "attempts": mockup_result[0].get("attempts", 0) if mockup_result else 0
+        }
+    
+    def estimate_batch_cost(self, product_images: List[Image.Image], logo_image: Image.Image,
+                            individual_prompts: List[Dict],
+                            pattern_image: Optional[Image.Image] = None,
+                            skip_cached: bool = False) -> Dict:
+        """
+        Оценка токенов и стоимости пакета до запуска process_batch
+        
+        Считается по размерам изображений после подготовки для API и длине
+        промпта каждого товара. process_batch кэш результатов не читает, поэтому
+        по умолчанию учитываются все товары; skip_cached исключает товары с
+        готовым результатом в кэше - только для вызывающих, которые его используют.
+        
+        Returns:
+            {items, cached_items, prompt_tokens, output_tokens, total_tokens, cost_usd}
+        """
+        logo_hash = self.image_processor.generate_image_hash(logo_image)
+        extra_sizes = [logo_image.size] + ([pattern_image.size] if pattern_image is not None else [])
+        
+        estimate = {"items": 0, "cached_items": 0, "prompt_tokens": 0, "output_tokens": 0,
+                    "total_tokens": 0, "cost_usd": 0.0}
+        for product_img, prompt_data in zip(product_images, individual_prompts):
+            if skip_cached and self.cache_manager.is_cached(
+                    self._get_item_cache_key(product_img, logo_hash, prompt_data)):
+                estimate["cached_items"] += 1
+                continue
+            
+            args = analysis_to_mockup_args(prompt_data)
+            prompt = render_mockup_prompt(
+                "fabric", args["logo_application"], args["mockup_style"], args["logo_position"],
+                args["logo_size"], args["product_color"], args["product_angle"], args["logo_color"],
+                args["custom_prompt"], pattern_image is not None
+            )
+            call = estimate_mockup_call([product_img.size] + extra_sizes, len(prompt))
+            
+            estimate["items"] += 1
+            for name in ("prompt_tokens", "output_tokens", "total_tokens", "cost_usd"):
+                estimate[name] += call[name]
+        
+        estimate["cost_usd"] = round(estimate["cost_usd"], 4)
+        return estimate
+    
+    def _get_item_cache_key(self, product_image: Image.Image, logo_hash: str,
+                            prompt_data: Dict) -> str:
+        """Ключ товара в пакете - совпадает с ключом одиночной генерации с теми же параметрами"""
+        generation_params = {
+            "logo_application": prompt_data.get("logo_application", "embroidery"),
+            "custom_prompt": prompt_data.get("custom_prompt", "").strip(),
+            "product_color": prompt_data.get("product_color", "как на фото"),
+            "product_angle": prompt_data.get("product_angle", "как на фото"),
+            "logo_position": prompt_data.get("logo_position", "центр"),
+            "logo_size": prompt_data.get("logo_size", "средний"),
+            "logo_color": prompt_data.get("logo_color", "как на фото")
+        }
+        
+        return self.cache_manager.generate_cache_key(
+            self.image_processor.generate_image_hash(product_image), logo_hash,
+            prompt_data.get("style", "modern"), generation_params
+        )
+    
     def _create_collection_analysis_prompt(self, product_color: str, collection_style: str, 
                                          num_products: int) -> str:
         """Создание промпта для анализа коллекции"""
@@ -267,6 +553,7 @@ class BatchProcessor:
         
         individual_prompts = []
         for i, img in enumerate(product_images):
+            product_name = f"Товар {i+1}"
             prompt_data = {
                 "style": collection_style_key,  # Единый стиль для всех
                 "logo_application": applications[i % len(applications)],
@@ -0,0 +1,270 @@
+"""
+Хранилища данных кэша (бэкенды)
+CacheManager хранит в бэкенде содержимое записей и блобов, а индекс
+(сроки жизни, счетчики ссылок, аренды) - в своем SQLite индексе
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Protocol
+from config import CACHE_SQLITE_FILE
+
+# Пространства имен данных в хранилище
+NAMESPACE_ENTRIES = "entries"
+NAMESPACE_BLOBS = "blobs"
+
+# Расширения файлов записей по формату сериализации
+ENTRY_EXTENSIONS = {
+    "binary": ".entry",
+    "json": ".json"
+}
+
+class CacheBackend(Protocol):
+    """Интерфейс хранилища: бинарные данные по паре (пространство имен, ключ)"""
+
+    name: str
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        """Чтение данных, None если ключа нет"""
+        ...
+
+    def put(self, namespace: str, key: str, data: bytes):
+        """Атомарная запись данных (с заменой существующих)"""
+        ...
+
+    def delete(self, namespace: str, key: str):
+        """Удаление данных (отсутствующий ключ не ошибка)"""
+        ...
+
+    def exists(self, namespace: str, key: str) -> bool:
+        """Проверка наличия ключа"""
+        ...
+
+    def iterate(self, namespace: str) -> Iterator[str]:
+        """Перебор ключей пространства имен"""
+        ...
+
+    def stats(self) -> Dict:
+        """Количество и объем данных по пространствам имен"""
+        ...
+
+    def clear(self):
+        """Удаление всех данных"""
+        ...
+
+class FilesystemBackend:
+    """
+    Файлы в CACHE_DIR с двухуровневым шардированием по префиксу ключа
+
+    Записи: cache/aa/bb/<key>.entry (или .json), блобы: cache/blobs/aa/bb/<hash>.blob
+    """
+
+    name = "filesystem"
+
+    def __init__(self, cache_dir: str, serialization: str = "binary"):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+
+        # Файлы записей в другом формате читаются для прозрачной миграции
+        entry_extension = ENTRY_EXTENSIONS[serialization]
+        self.extensions = {
+            NAMESPACE_ENTRIES: [entry_extension] + [ext for ext in ENTRY_EXTENSIONS.values()
+                                                    if ext != entry_extension],
+            NAMESPACE_BLOBS: [".blob"]
+        }
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _base_dir(self, namespace: str) -> str:
+        """Корневая папка пространства имен"""
+        return self.blob_dir if namespace == NAMESPACE_BLOBS else self.cache_dir
+
+    def _path(self, namespace: str, key: str, extension: Optional[str] = None) -> str:
+        """Путь к файлу: двухуровневое шардирование по префиксу ключа"""
+        extension = extension or self.extensions[namespace][0]
+        return os.path.join(self._base_dir(namespace), key[:2], key[2:4], f"{key}{extension}")
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        for extension in self.extensions[namespace]:
+            try:
+                with open(self._path(namespace, key, extension), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                continue
+        return None
+
+    def put(self, namespace: str, key: str, data: bytes):
+        path = self._path(namespace, key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Атомарная запись: временный файл в той же папке и переименование
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        # Файл в другом формате (от прежних настроек) больше не нужен
+        for extension in self.extensions[namespace][1:]:
+            try:
+                os.remove(self._path(namespace, key, extension))
+            except FileNotFoundError:
+                pass
+
+    def delete(self, namespace: str, key: str):
+        for extension in self.extensions[namespace]:
+            try:
+                os.remove(self._path(namespace, key, extension))
+            except FileNotFoundError:
+                pass
+
+    def exists(self, namespace: str, key: str) -> bool:
+        return any(os.path.exists(self._path(namespace, key, extension))
+                   for extension in self.extensions[namespace])
+
+    def iterate(self, namespace: str) -> Iterator[str]:
+        base_dir = self._base_dir(namespace)
+        extensions = tuple(self.extensions[namespace])
+        seen = set()
+
+        # Только папки шардов (две hex-цифры), служебные папки пропускаются
+        for first in self._shard_dirs(base_dir):
+            for second in self._shard_dirs(first):
+                for file in os.listdir(second):
+                    if file.startswith(".") or not file.endswith(extensions):
+                        continue
+                    key = os.path.splitext(file)[0]
+                    if key not in seen:
+                        seen.add(key)
+                        yield key
+
+    def _shard_dirs(self, directory: str) -> Iterator[str]:
+        """Вложенные папки шардов"""
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            if len(name) == 2 and os.path.isdir(path):
+                yield path
+
+    def stats(self) -> Dict:
+        result = {"backend": self.name, "location": self.cache_dir}
+        for namespace in self.extensions:
+            count = 0
+            size = 0
+            for key in self.iterate(namespace):
+                for extension in self.extensions[namespace]:
+                    path = self._path(namespace, key, extension)
+                    if os.path.exists(path):
+                        count += 1
+                        size += os.path.getsize(path)
+                        break
+            result[namespace] = {"count": count, "size_bytes": size}
+        return result
+
+    def clear(self):
+        for base_dir in (self.cache_dir, self.blob_dir):
+            for shard in list(self._shard_dirs(base_dir)):
+                shutil.rmtree(shard, ignore_errors=True)
+
+class SQLiteBackend:
+    """Все записи и блобы в одном файле SQLite (удобно копировать и переносить)"""
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS payloads (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        data BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (namespace, key)
+    );
+    """
+
+    def __init__(self, cache_dir: str, serialization: str = "binary"):
+        self.path = os.path.join(cache_dir, CACHE_SQLITE_FILE)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _connect(self):
+        """Соединение с хранилищем (одна транзакция на блок)"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            # Схема проверяется при каждом соединении: файл мог быть удален
+            # полной очисткой кэша
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM payloads WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def put(self, namespace: str, key: str, data: bytes):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO payloads (namespace, key, data, size) VALUES (?, ?, ?, ?)",
+                (namespace, key, sqlite3.Binary(data), len(data))
+            )
+
+    def delete(self, namespace: str, key: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM payloads WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def exists(self, namespace: str, key: str) -> bool:
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT 1 FROM payloads WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone() is not None
+
+    def iterate(self, namespace: str) -> Iterator[str]:
+        with self._connect() as conn:
+            keys = [row[0] for row in conn.execute(
+                "SELECT key FROM payloads WHERE namespace = ?", (namespace,)
+            )]
+        return iter(keys)
+
+    def stats(self) -> Dict:
+        result = {"backend": self.name, "location": self.path}
+        with self._connect() as conn:
+            for namespace in (NAMESPACE_ENTRIES, NAMESPACE_BLOBS):
+                count, size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM payloads WHERE namespace = ?",
+                    (namespace,)
+                ).fetchone()
+                result[namespace] = {"count": count, "size_bytes": size}
+        return result
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM payloads")
+
+# Доступные хранилища (выбор через CACHE_BACKEND)
+CACHE_BACKENDS = {
+    "filesystem": FilesystemBackend,
+    "sqlite": SQLiteBackend
+}
+
+def create_cache_backend(name: str, cache_dir: str, serialization: str = "binary") -> CacheBackend:
+    """Создание хранилища кэша по имени из конфигурации"""
+    if name not in CACHE_BACKENDS:
+        raise ValueError(f"Неизвестное хранилище кэша: {name}")
+    return CACHE_BACKENDS[name](cache_dir, serialization)
@@ -2,13 +2,282 @@
 Система кэширования для экономии API вызовов
 """
 import os
+import atexit
+import concurrent.futures
 import json
 import time
 import hashlib
-from typing import Optional, Dict, Any
+import shutil
+import socket
+import sqlite3
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Set, Tuple
 from PIL import Image
+import numpy as np
 import io
-from config import CACHE_DIR, CACHE_ENABLED, CACHE_EXPIRY_HOURS
+from config import (CACHE_DIR, CACHE_ENABLED, CACHE_EXPIRY_HOURS, CACHE_INDEX_FILE, CACHE_BACKEND,
+                    CACHE_MAX_SIZE_MB, CACHE_MAX_ENTRIES, CACHE_EVICTION_POLICY,
+                    CACHE_EVICTION_BATCH, CACHE_MEMORY_MAX_MB, CACHE_MEMORY_REVALIDATE_SECONDS,
+                    CACHE_PERCEPTUAL_ENABLED, CACHE_PERCEPTUAL_THRESHOLD,
+                    CACHE_LEASE_SECONDS, CACHE_LEASE_WAIT_SECONDS,
+                    CACHE_SERIALIZATION, CACHE_COMPRESSION, NEGATIVE_CACHE_ENABLED,
+                    NEGATIVE_CACHE_TTL_SECONDS, NEGATIVE_CACHE_MAX_BACKOFF_SECONDS,
+                    GEMINI_CALL_ESTIMATES)
+from cache_backends import (ENTRY_EXTENSIONS, NAMESPACE_ENTRIES, NAMESPACE_BLOBS,
+                            create_cache_backend)
+
+try:
+    import fcntl  # Advisory блокировки (Linux/macOS)
+except ImportError:
+    fcntl = None
+
+# Ключ-маркер ссылки на бинарные данные в JSON записи кэша
+BLOB_REF_KEY = "__blob__"
+
+# Схема индекса кэша
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    ttl REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    size INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_entries_expires_at ON entries(expires_at);
+CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries(last_access);
+CREATE INDEX IF NOT EXISTS idx_entries_hits ON entries(hits, last_access);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS entry_blobs (
+    key TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (key, hash)
+);
+CREATE INDEX IF NOT EXISTS idx_entry_blobs_hash ON entry_blobs(hash);
+
+-- Похожие товары: логотип и параметры совпадают точно (match_hash), товар - по перцептивному хешу
+CREATE TABLE IF NOT EXISTS similar_products (
+    key TEXT PRIMARY KEY,
+    match_hash TEXT NOT NULL,
+    product_phash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_similar_products_match ON similar_products(match_hash);
+
+CREATE TABLE IF NOT EXISTS failures (
+    key TEXT PRIMARY KEY,
+    failure_type TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last_error TEXT,
+    last_failure REAL NOT NULL,
+    retry_after REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+# Компактный формат записи: MAGIC | flags (1 байт) | длина тела (4 байта, BE) | тело
+# Тело - JSON без отступов, при флаге ENTRY_FLAG_ZLIB сжатый zlib
+ENTRY_MAGIC = b"MCE1"
+ENTRY_HEADER = struct.Struct(">BI")
+ENTRY_FLAG_ZLIB = 0x01
+ENTRY_COMPRESS_MIN_BYTES = 512  # Мелкие записи не сжимаем
+
+def encode_entry(cache_data: Dict, serialization: str = "binary", compress: bool = True) -> bytes:
+    """Сериализация записи кэша в выбранный формат"""
+    if serialization == "json":
+        return json.dumps(cache_data, ensure_ascii=False, indent=2).encode('utf-8')
+    
+    body = json.dumps(cache_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    flags = 0
+    if compress and len(body) >= ENTRY_COMPRESS_MIN_BYTES:
+        body = zlib.compress(body, 6)
+        flags |= ENTRY_FLAG_ZLIB
+    
+    return ENTRY_MAGIC + ENTRY_HEADER.pack(flags, len(body)) + body
+
+def decode_entry(data: bytes) -> Dict:
+    """Десериализация записи кэша: компактный формат или JSON старого формата"""
+    if not data.startswith(ENTRY_MAGIC):
+        return json.loads(data.decode('utf-8'))
+    
+    offset = len(ENTRY_MAGIC)
+    flags, body_length = ENTRY_HEADER.unpack_from(data, offset)
+    offset += ENTRY_HEADER.size
+    body = data[offset:offset + body_length]
+    if len(body) != body_length:
+        raise ValueError("запись кэша обрезана")
+    
+    if flags & ENTRY_FLAG_ZLIB:
+        body = zlib.decompress(body)
+    return json.loads(body.decode('utf-8'))
+
+# Политики вытеснения: порядок, в котором записи становятся кандидатами
+EVICTION_POLICIES = {
+    "lru": "last_access ASC",          # давно не использовавшиеся
+    "lfu": "hits ASC, last_access ASC"  # редко использовавшиеся
+}
+
+# Перцептивный хеш: dHash 16x16 (256 бит) + средний цвет
+PHASH_SIZE = 16
+PHASH_COLOR_TOLERANCE = 24  # Макс. отличие среднего цвета по каналу (0-255)
+
+def compute_perceptual_hash(image: Image.Image) -> str:
+    """
+    Перцептивный хеш изображения, устойчивый к пересохранению, ресайзу и сжатию
+    
+    Returns:
+        Hex-строка: 64 символа dHash + 6 символов среднего цвета RGB
+    """
+    # Хеш запоминается на объекте изображения (как и хеш содержимого)
+    signature = (image.mode, image.size)
+    memo = getattr(image, "_perceptual_hash", None)
+    if memo is not None and memo[0] == signature:
+        return memo[1]
+    source = image
+    
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
+    
+    # Уменьшаем до сравнения цветов: reducing_gap ускоряет ресайз больших фото
+    small = image.resize((PHASH_SIZE + 1, PHASH_SIZE), Image.LANCZOS, reducing_gap=3.0)
+    
+    if small.mode in ('RGBA', 'LA'):
+        # Прозрачные области считаем белым фоном
+        background = Image.new('RGB', small.size, (255, 255, 255))
+        background.paste(small, mask=small.split()[-1])
+        small = background
+    elif small.mode != 'RGB':
+        small = small.convert('RGB')
+    
+    gray = np.asarray(small.convert('L'), dtype=np.int16)
+    bits = np.packbits((gray[:, 1:] > gray[:, :-1]).flatten())
+    mean_color = np.asarray(small, dtype=np.float32).reshape(-1, 3).mean(axis=0)
+    
+    perceptual_hash = bits.tobytes().hex() + bytes(int(round(c)) for c in mean_color).hex()
+    source._perceptual_hash = (signature, perceptual_hash)
+    return perceptual_hash
+
+def perceptual_distance(hash_a: str, hash_b: str) -> int:
+    """
+    Расстояние Хэмминга между перцептивными хешами
+    
+    Если средние цвета заметно отличаются, изображения считаются разными
+    (возвращается расстояние больше любого порога).
+    """
+    bits_count = PHASH_SIZE * PHASH_SIZE
+    dhash_len = bits_count // 4
+    
+    color_a = bytes.fromhex(hash_a[dhash_len:])
+    color_b = bytes.fromhex(hash_b[dhash_len:])
+    if any(abs(a - b) > PHASH_COLOR_TOLERANCE for a, b in zip(color_a, color_b)):
+        return bits_count + 1
+    
+    return bin(int(hash_a[:dhash_len], 16) ^ int(hash_b[:dhash_len], 16)).count("1")
+
+# Отложенная запись обращений к записям в индекс (попаданий и last_access)
+TOUCH_FLUSH_SIZE = 50       # сброс после стольких обращений
+TOUCH_FLUSH_INTERVAL = 5.0  # или через столько секунд
+
+# Накопительные метрики эффективности кэша (хранятся в индексе)
+CACHE_METRICS = (
+    "hits",               # найдено в кэше
+    "misses",             # не найдено (включая устаревшие)
+    "stale_hits",         # запись была, но срок жизни истек
+    "evictions",          # вытеснено при превышении лимитов
+    "bytes_served",       # отдано байт из кэша (записи + блобы)
+    "api_calls_avoided",  # сэкономлено вызовов Gemini
+    "tokens_avoided",     # сэкономлено токенов (оценка)
+    "cost_saved_usd",     # сэкономлено денег (оценка)
+    "coalesced_calls"     # одинаковых одновременных запросов объединено с уже выполняемым
+)
+
+# Генерации, выполняемые в этом процессе (single-flight): ключ -> Future с результатом.
+# Общие для всех экземпляров CacheManager, одинаковые одновременные запросы ждут один вызов
+_in_flight: Dict[str, concurrent.futures.Future] = {}
+_in_flight_lock = threading.Lock()
+
+def payload_size(value: Any) -> int:
+    """Объем бинарных данных в результате (для учета отданных байт)"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(payload_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+    return 0
+
+class MemoryCache:
+    """Потокобезопасный LRU кэш в памяти процесса с лимитом по объему"""
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.RLock()
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Получение значения с обновлением позиции в LRU"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+    
+    def put(self, key: str, value: Any, size: int):
+        """Сохранение значения с вытеснением давно не использовавшихся"""
+        if size > self.max_bytes:
+            return
+        
+        with self._lock:
+            self.pop(key)
+            self._items[key] = (value, size)
+            self._size_bytes += size
+            while self._size_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size_bytes -= evicted_size
+    
+    def pop(self, key: str):
+        """Удаление значения"""
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self._size_bytes -= item[1]
+    
+    def clear(self):
+        """Полная очистка"""
+        with self._lock:
+            self._items.clear()
+            self._size_bytes = 0
+    
+    def get_stats(self) -> Dict:
+        """Статистика заполнения"""
+        with self._lock:
+            return {
+                "items": len(self._items),
+                "size_mb": round(self._size_bytes / (1024 * 1024), 2),
+                "max_size_mb": round(self.max_bytes / (1024 * 1024), 2)
+            }
 
 class CacheManager:
     def __init__(self):
@@ -16,11 +285,101 @@ class CacheManager:
         self.cache_dir = CACHE_DIR
         self.enabled = CACHE_ENABLED
         self.expiry_hours = CACHE_EXPIRY_HOURS
+        self.max_size_bytes = CACHE_MAX_SIZE_MB * 1024 * 1024
+        self.max_entries = CACHE_MAX_ENTRIES
+        
+        if CACHE_EVICTION_POLICY not in EVICTION_POLICIES:
+            raise ValueError(f"Неизвестная политика вытеснения кэша: {CACHE_EVICTION_POLICY}")
+        self.eviction_policy = CACHE_EVICTION_POLICY
+        if CACHE_SERIALIZATION not in ENTRY_EXTENSIONS:
+            raise ValueError(f"Неизвестный формат сериализации кэша: {CACHE_SERIALIZATION}")
+        self.serialization = CACHE_SERIALIZATION
+        self.compression = CACHE_COMPRESSION
+        
+        self.perceptual_enabled = CACHE_PERCEPTUAL_ENABLED
+        self.perceptual_threshold = CACHE_PERCEPTUAL_THRESHOLD
+        
+        # Уровень кэша в памяти перед диском (метаданные записей и блобы)
+        self.memory = MemoryCache(CACHE_MEMORY_MAX_MB * 1024 * 1024)
+        self._stats_lock = threading.Lock()
+        self.tier_stats = {
+            "memory": {"hits": 0, "misses": 0},
+            "disk": {"hits": 0, "misses": 0}
+        }
+        self._pending_touches = {}
+        self._pending_metrics = {}
+        self._last_touch_flush = time.time()
+        
+        self.index_path = os.path.join(self.cache_dir, CACHE_INDEX_FILE)
+        self.lock_path = os.path.join(self.cache_dir, ".write.lock")
         
         if self.enabled:
             os.makedirs(self.cache_dir, exist_ok=True)
+            # Содержимое записей и блобов хранится в выбранном хранилище
+            self.backend = create_cache_backend(CACHE_BACKEND, self.cache_dir, self.serialization)
+            self._init_index()
+            # Накопленные обращения и метрики не должны теряться при остановке
+            atexit.register(self._flush_touches)
+    
+    def _init_index(self):
+        """Создание SQLite индекса и перенос записей старого формата"""
+        is_new_index = not os.path.exists(self.index_path)
+        
+        with self._connect() as conn:
+            # WAL: читатели не блокируются писателями из других процессов
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(INDEX_SCHEMA)
+            self._migrate_perceptual_index(conn)
+        
+        if is_new_index:
+            self._migrate_flat_cache()
+    
+    @contextmanager
+    def _connect(self):
+        """Соединение с индексом кэша (одна транзакция на блок)"""
+        conn = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+    
+    def _is_current_format(self, data: bytes) -> bool:
+        """Записана ли запись в текущем формате сериализации"""
+        return data.startswith(ENTRY_MAGIC) == (self.serialization == "binary")
     
-    def generate_cache_key(self, product_hash: str, logo_hash: str, 
+    def _upgrade_entry(self, cache_key: str, cache_data: Dict):
+        """Перезапись записи старого формата в текущий (прозрачная миграция)"""
+        try:
+            with self._write_lock():
+                data = encode_entry(cache_data, self.serialization, self.compression)
+                self.backend.put(NAMESPACE_ENTRIES, cache_key, data)
+                with self._connect() as conn:
+                    conn.execute("UPDATE entries SET size = ? WHERE key = ?", (len(data), cache_key))
+        except Exception as e:
+            print(f"Ошибка миграции записи кэша: {e}")
+    
+    @contextmanager
+    def _write_lock(self):
+        """
+        Межпроцессная advisory блокировка записи в кэш
+        
+        Защищает связку "файлы + индекс + счетчики ссылок блобов" от
+        одновременной записи и удаления несколькими воркерами. Чтение
+        выполняется без блокировки: файлы заменяются атомарно.
+        """
+        if fcntl is None:
+            yield
+            return
+        
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    
+    def generate_cache_key(self, product_hash: str, logo_hash: str,
                           style: str, additional_params: Dict = None) -> str:
         """Генерация ключа кэша"""
         params_str = ""
@@ -30,61 +389,754 @@ class CacheManager:
         key_string = f"{product_hash}_{logo_hash}_{style}_{params_str}"
         return hashlib.md5(key_string.encode()).hexdigest()
     
+    def _get_index_row(self, cache_key: str) -> Optional[Tuple[float, float, float]]:
+        """Срок действия, TTL и время создания записи из индекса"""
+        try:
+            with self._connect() as conn:
+                return conn.execute(
+                    "SELECT expires_at, ttl, created_at FROM entries WHERE key = ?", (cache_key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения индекса кэша: {e}")
+            return None
+    
     def is_cached(self, cache_key: str) -> bool:
         """Проверка наличия в кэше"""
         if not self.enabled:
             return False
         
-        cache_file = os.path.join(self.cache_dir, f"{cache_key}.json")
-        if not os.path.exists(cache_file):
-            return False
-        
-        # Проверка времени создания
-        file_time = os.path.getctime(cache_file)
-        current_time = time.time()
-        expiry_seconds = self.expiry_hours * 3600
-        
-        return (current_time - file_time) < expiry_seconds
+        row = self._get_index_row(cache_key)
+        return row is not None and row[0] > time.time()
     
     def get_cached_result(self, cache_key: str) -> Optional[Dict]:
-        """Получение результата из кэша"""
-        if not self.enabled or not self.is_cached(cache_key):
+        """Получение результата из кэша (сначала память, затем диск)"""
+        if not self.enabled:
+            return None
+        
+        now = time.time()
+        
+        # Уровень памяти
+        memory_entry = self.memory.get(f"entry:{cache_key}")
+        if memory_entry is not None:
+            cache_data, expires_at, ttl, size, checked_at = memory_entry
+            # Уровень памяти свой у каждого процесса: другой воркер мог удалить, вытеснить
+            # или перезаписать запись. Раз в CACHE_MEMORY_REVALIDATE_SECONDS запись сверяется
+            # с индексом, в остальное время отдается без обращения к нему
+            valid = expires_at > now
+            if valid and now - checked_at >= CACHE_MEMORY_REVALIDATE_SECONDS:
+                row = self._get_index_row(cache_key)
+                valid = row is not None and row[0] > now and row[2] == cache_data.get("timestamp")
+                checked_at = now
+            if valid:
+                try:
+                    result = self._rehydrate_blobs(cache_data.get("result"))
+                    self.memory.put(f"entry:{cache_key}", (cache_data, now + ttl, ttl, size, checked_at), size)
+                    self._record_tier("memory", hit=True)
+                    self._record_hit(cache_data, result, size)
+                    self._touch(cache_key, now)
+                    return {**cache_data, "result": result}
+                except Exception as e:
+                    print(f"Ошибка чтения кэша из памяти: {e}")
+            self.memory.pop(f"entry:{cache_key}")
+        self._record_tier("memory", hit=False)
+        
+        # Уровень диска
+        row = self._get_index_row(cache_key)
+        if row is None or row[0] <= now:
+            self._record_tier("disk", hit=False)
+            self._record_metrics(misses=1, stale_hits=int(row is not None))
             return None
         
         try:
-            cache_file = os.path.join(self.cache_dir, f"{cache_key}.json")
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            data = self.backend.get(NAMESPACE_ENTRIES, cache_key)
+            if data is None:
+                raise FileNotFoundError(f"данные записи кэша {cache_key} не найдены")
+            cache_data = decode_entry(data)
+            
+            # Подставляем бинарные данные из хранилища блобов
+            result = self._rehydrate_blobs(cache_data.get("result"))
+            
+            if not self._is_current_format(data):
+                self._upgrade_entry(cache_key, cache_data)
+            
+            ttl = row[1]
+            self.memory.put(f"entry:{cache_key}", (cache_data, now + ttl, ttl, len(data), now), len(data))
+            self._record_tier("disk", hit=True)
+            self._record_hit(cache_data, result, len(data))
+            self._touch(cache_key, now)
+            return {**cache_data, "result": result}
+        except FileNotFoundError:
+            # Данные удалены в обход индекса - убираем запись
+            self._remove_entries([cache_key])
+            self._record_tier("disk", hit=False)
+            self._record_metrics(misses=1)
+            return None
         except Exception as e:
             print(f"Ошибка чтения кэша: {e}")
+            self._record_tier("disk", hit=False)
+            self._record_metrics(misses=1)
             return None
     
-    def save_to_cache(self, cache_key: str, result: Dict) -> bool:
-        """Сохранение результата в кэш"""
-        if not self.enabled:
+    def register_perceptual_hashes(self, cache_key: str, match_hash: str, product_phash: str) -> bool:
+        """Добавление перцептивного хеша товара записи в индекс похожих товаров"""
+        if not self.enabled or not self.perceptual_enabled:
             return False
         
         try:
-            # Убеждаемся, что папка кэша существует
-            os.makedirs(self.cache_dir, exist_ok=True)
-            cache_file = os.path.join(self.cache_dir, f"{cache_key}.json")
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO similar_products (key, match_hash, product_phash) VALUES (?, ?, ?)",
+                    (cache_key, match_hash, product_phash)
+                )
+            return True
+        except sqlite3.Error as e:
+            print(f"Ошибка записи перцептивного индекса: {e}")
+            return False
+    
+    def find_similar_entry(self, match_hash: str, product_phash: str) -> Optional[str]:
+        """
+        Поиск записи для почти одинакового изображения товара
+        
+        Логотип, стиль и параметры генерации должны совпадать точно
+        (match_hash); приблизительно сравнивается только товар - расстояние
+        Хэмминга не больше CACHE_PERCEPTUAL_THRESHOLD.
+        
+        Returns:
+            Ключ ближайшей действующей записи или None
+        """
+        if not self.enabled or not self.perceptual_enabled:
+            return None
+        
+        try:
+            with self._connect() as conn:
+                candidates = conn.execute(
+                    "SELECT p.key, p.product_phash FROM similar_products p "
+                    "JOIN entries e ON e.key = p.key "
+                    "WHERE p.match_hash = ? AND e.expires_at > ?",
+                    (match_hash, time.time())
+                ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения перцептивного индекса: {e}")
+            return None
+        
+        best_key = None
+        best_distance = None
+        for key, candidate_product in candidates:
+            distance = perceptual_distance(product_phash, candidate_product)
+            if distance > self.perceptual_threshold:
+                continue
+            if best_distance is None or distance < best_distance:
+                best_key, best_distance = key, distance
+        
+        if best_key:
+            print(f"Найдена похожая запись кэша (расстояние {best_distance})")
+        return best_key
+    
+    def record_failure(self, cache_key: str, failure_type: str, error: str = "") -> Optional[Dict]:
+        """
+        Запоминание неудачной генерации (негативный кэш)
+        
+        Пауза перед повтором растет экспоненциально: NEGATIVE_CACHE_TTL_SECONDS,
+        затем x2 за каждую следующую неудачу, но не больше
+        NEGATIVE_CACHE_MAX_BACKOFF_SECONDS. Если с прошлой неудачи прошло
+        больше максимальной паузы, счетчик начинается заново.
+        
+        Returns:
+            Сохраненная информация о неудаче или None
+        """
+        if not self.enabled or not NEGATIVE_CACHE_ENABLED:
+            return None
+        
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT count, last_failure FROM failures WHERE key = ?", (cache_key,)
+                ).fetchone()
+                count = 1
+                if row is not None and now - row[1] < NEGATIVE_CACHE_MAX_BACKOFF_SECONDS:
+                    count = row[0] + 1
+                
+                backoff = min(NEGATIVE_CACHE_TTL_SECONDS * 2 ** (count - 1),
+                              NEGATIVE_CACHE_MAX_BACKOFF_SECONDS)
+                conn.execute(
+                    "INSERT OR REPLACE INTO failures "
+                    "(key, failure_type, count, last_error, last_failure, retry_after) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cache_key, failure_type, count, (error or "")[:500], now, now + backoff)
+                )
             
-            # Добавление метаданных
-            cache_data = {
-                "timestamp": time.time(),
-                "expiry_hours": self.expiry_hours,
-                "result": result
+            print(f"Неудача генерации запомнена ({failure_type}, №{count}), повтор через {int(backoff)} с")
+            return {
+                "failure_type": failure_type,
+                "count": count,
+                "last_error": error,
+                "retry_after": now + backoff
             }
+        except sqlite3.Error as e:
+            print(f"Ошибка записи негативного кэша: {e}")
+            return None
+    
+    def get_failure(self, cache_key: str) -> Optional[Dict]:
+        """Информация о недавней неудаче, если пауза перед повтором еще не истекла"""
+        if not self.enabled or not NEGATIVE_CACHE_ENABLED:
+            return None
+        
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT failure_type, count, last_error, retry_after FROM failures "
+                    "WHERE key = ? AND retry_after > ?",
+                    (cache_key, time.time())
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения негативного кэша: {e}")
+            return None
+        
+        if row is None:
+            return None
+        
+        return {
+            "failure_type": row[0],
+            "count": row[1],
+            "last_error": row[2],
+            "retry_after": row[3]
+        }
+    
+    def clear_failure(self, cache_key: str):
+        """Сброс негативного кэша после успешной генерации"""
+        if not self.enabled or not NEGATIVE_CACHE_ENABLED:
+            return
+        
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM failures WHERE key = ?", (cache_key,))
+        except sqlite3.Error as e:
+            print(f"Ошибка очистки негативного кэша: {e}")
+    
+    def lease_owner(self, task: Optional[str] = None) -> str:
+        """
+        Идентификатор владельца аренды: хост, процесс и поток
+        
+        Корутины переходят между потоками, поэтому для них передается
+        собственный идентификатор задачи task.
+        """
+        return f"{socket.gethostname()}:{os.getpid()}:{task or threading.get_ident()}"
+    
+    def acquire_lease(self, cache_key: str, owner: Optional[str] = None) -> bool:
+        """
+        Захват аренды "генерация в процессе" для ключа
+        
+        Аренда видна всем процессам, работающим с тем же CACHE_DIR, и
+        истекает через CACHE_LEASE_SECONDS, если владелец упал.
+        
+        Args:
+            cache_key: Ключ записи
+            owner: Владелец аренды (по умолчанию текущий поток)
+        
+        Returns:
+            True, если аренда получена (или кэш выключен)
+        """
+        if not self.enabled:
+            return True
+        
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM leases WHERE key = ? AND expires_at <= ?", (cache_key, now)
+                )
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                    (cache_key, owner or self.lease_owner(), now + CACHE_LEASE_SECONDS)
+                )
+                return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            # Без индекса координация невозможна - генерируем сами
+            print(f"Ошибка захвата аренды кэша: {e}")
+            return True
+    
+    def release_lease(self, cache_key: str, owner: Optional[str] = None):
+        """Освобождение аренды, захваченной этим потоком (или владельцем owner)"""
+        if not self.enabled:
+            return
+        
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM leases WHERE key = ? AND owner = ?",
+                    (cache_key, owner or self.lease_owner())
+                )
+        except sqlite3.Error as e:
+            print(f"Ошибка освобождения аренды кэша: {e}")
+    
+    def join_in_flight(self, cache_key: str, api_kind: str = "mockup") -> Tuple[concurrent.futures.Future, bool]:
+        """
+        Регистрация генерации в процессе (single-flight)
+        
+        Returns:
+            (future, is_leader): первый запрос с ключом становится ведущим и
+            обязан вызвать finish_in_flight; остальные ждут future и получают
+            его результат (учитываются в метрике coalesced_calls)
+        """
+        with _in_flight_lock:
+            flight = _in_flight.get(cache_key)
+            if flight is None:
+                flight = concurrent.futures.Future()
+                _in_flight[cache_key] = flight
+                return flight, True
+        
+        if self.enabled:
+            estimate = GEMINI_CALL_ESTIMATES.get(api_kind, {})
+            self._record_metrics(
+                coalesced_calls=1,
+                api_calls_avoided=1,
+                tokens_avoided=estimate.get("tokens", 0),
+                cost_saved_usd=estimate.get("cost_usd", 0.0)
+            )
+        return flight, False
+    
+    def finish_in_flight(self, cache_key: str, result: Optional[Dict]):
+        """Завершение генерации ведущим запросом: результат передается ожидающим (None - неудача)"""
+        with _in_flight_lock:
+            flight = _in_flight.pop(cache_key, None)
+        if flight is not None and not flight.done():
+            flight.set_result(result)
+    
+    def wait_for_result(self, cache_key: str, timeout: float = CACHE_LEASE_WAIT_SECONDS,
+                        poll_interval: float = 0.5) -> Optional[Dict]:
+        """
+        Ожидание результата, который генерирует другой воркер
+        
+        Returns:
+            Результат из кэша или None, если аренда освобождена без результата
+            (генерация у владельца не удалась) или истек таймаут
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.is_cached(cache_key):
+                return self.get_cached_result(cache_key)
             
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
+            try:
+                with self._connect() as conn:
+                    lease = conn.execute(
+                        "SELECT 1 FROM leases WHERE key = ? AND expires_at > ?",
+                        (cache_key, time.time())
+                    ).fetchone()
+            except sqlite3.Error:
+                lease = None
+            if lease is None:
+                # Владелец мог записать результат перед освобождением аренды
+                return self.get_cached_result(cache_key)
             
+            time.sleep(poll_interval)
+        
+        return None
+    
+    def _record_tier(self, tier: str, hit: bool):
+        """Учет попаданий и промахов по уровням кэша"""
+        with self._stats_lock:
+            self.tier_stats[tier]["hits" if hit else "misses"] += 1
+    
+    def _record_hit(self, cache_data: Dict, result: Any, entry_size: int):
+        """Учет попадания: отданные байты и сэкономленный вызов Gemini"""
+        estimate = GEMINI_CALL_ESTIMATES.get(cache_data.get("api_kind"), {})
+        self._record_metrics(
+            hits=1,
+            bytes_served=entry_size + payload_size(result),
+            api_calls_avoided=1,
+            tokens_avoided=estimate.get("tokens", 0),
+            cost_saved_usd=estimate.get("cost_usd", 0.0)
+        )
+    
+    def _record_metrics(self, **counters: float):
+        """Увеличение накопительных метрик (пишутся в индекс вместе с обращениями)"""
+        now = time.time()
+        with self._stats_lock:
+            for name, value in counters.items():
+                if value:
+                    self._pending_metrics[name] = self._pending_metrics.get(name, 0) + value
+            should_flush = now - self._last_touch_flush >= TOUCH_FLUSH_INTERVAL
+        
+        if should_flush:
+            self._flush_touches()
+    
+    def _touch(self, cache_key: str, now: float):
+        """
+        Учет обращения к записи для LRU/LFU и скользящего срока жизни
+        
+        Обращения копятся в памяти и пишутся в индекс пачкой, чтобы попадание
+        в кэш не требовало записи на диск.
+        """
+        with self._stats_lock:
+            hits, _ = self._pending_touches.get(cache_key, (0, now))
+            self._pending_touches[cache_key] = (hits + 1, now)
+            should_flush = (len(self._pending_touches) >= TOUCH_FLUSH_SIZE or
+                            now - self._last_touch_flush >= TOUCH_FLUSH_INTERVAL)
+        
+        if should_flush:
+            self._flush_touches()
+    
+    def _flush_touches(self):
+        """Запись накопленных обращений и метрик в индекс"""
+        with self._stats_lock:
+            touches = self._pending_touches
+            metrics = self._pending_metrics
+            self._pending_touches = {}
+            self._pending_metrics = {}
+            self._last_touch_flush = time.time()
+        
+        if not touches and not metrics:
+            return
+        
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT INTO metrics (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    list(metrics.items())
+                )
+                conn.executemany(
+                    "UPDATE entries SET hits = hits + ?, "
+                    "last_access = MAX(last_access, ?), "
+                    "expires_at = MAX(expires_at, ? + ttl) WHERE key = ?",
+                    [(hits, last_access, last_access, key)
+                     for key, (hits, last_access) in touches.items()]
+                )
+        except sqlite3.Error as e:
+            print(f"Ошибка записи обращений в индекс кэша: {e}")
+    
+    def save_to_cache(self, cache_key: str, result: Dict, ttl_hours: Optional[float] = None,
+                      api_kind: Optional[str] = None) -> bool:
+        """
+        Сохранение результата в кэш
+        
+        Args:
+            cache_key: Ключ записи
+            result: Данные для сохранения (bytes выносятся в хранилище блобов)
+            ttl_hours: Срок жизни записи (по умолчанию CACHE_EXPIRY_HOURS)
+            api_kind: Тип вызова Gemini, который заменяет запись (ключ GEMINI_CALL_ESTIMATES),
+                для оценки сэкономленных токенов и денег
+        """
+        if not self.enabled:
+            return False
+        
+        try:
+            now = time.time()
+            expiry_hours = ttl_hours if ttl_hours is not None else self.expiry_hours
+            ttl = expiry_hours * 3600
+            
+            with self._write_lock():
+                # Добавление метаданных (bytes выносятся в хранилище блобов)
+                blob_hashes = set()
+                cache_data = {
+                    "timestamp": now,
+                    "expiry_hours": expiry_hours,
+                    "api_kind": api_kind,
+                    "result": self._extract_blobs(result, blob_hashes)
+                }
+                
+                data = encode_entry(cache_data, self.serialization, self.compression)
+                self.backend.put(NAMESPACE_ENTRIES, cache_key, data)
+                
+                with self._connect() as conn:
+                    orphan_candidates = self._unlink_entry_blobs(conn, cache_key)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO entries "
+                        "(key, created_at, last_access, ttl, expires_at, size, hits) "
+                        "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                        (cache_key, now, now, ttl, now + ttl, len(data))
+                    )
+                    for blob_hash in blob_hashes:
+                        conn.execute(
+                            "INSERT INTO entry_blobs (key, hash) VALUES (?, ?)",
+                            (cache_key, blob_hash)
+                        )
+                        conn.execute(
+                            "UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (blob_hash,)
+                        )
+                    orphans = self._collect_orphan_blobs(conn, orphan_candidates)
+                
+                self._delete_blob_files(orphans)
+            
+            # Сквозная запись в уровень памяти
+            memory_entry = (cache_data, now + ttl, ttl, len(data), now)
+            self.memory.put(f"entry:{cache_key}", memory_entry, len(data))
+            
+            self._enforce_limits(protected_key=cache_key)
             return True
         except Exception as e:
             print(f"Ошибка сохранения в кэш: {e}")
             return False
     
-    def save_image_to_cache(self, cache_key: str, image: Image.Image, 
+    def _enforce_limits(self, protected_key: Optional[str] = None) -> int:
+        """
+        Инкрементальное вытеснение записей при превышении лимитов кэша
+        
+        За один вызов удаляется не более CACHE_EVICTION_BATCH записей:
+        сначала устаревшие, затем по выбранной политике (LRU/LFU).
+        
+        Args:
+            protected_key: Ключ, который нельзя вытеснять (только что записан)
+        
+        Returns:
+            Количество удаленных записей
+        """
+        order_by = EVICTION_POLICIES[self.eviction_policy]
+        evicted = 0
+        
+        # Политике нужны актуальные last_access и hits
+        self._flush_touches()
+        
+        try:
+            with self._connect() as conn:
+                expired_keys = [row[0] for row in conn.execute(
+                    "SELECT key FROM entries WHERE expires_at <= ? LIMIT ?",
+                    (time.time(), CACHE_EVICTION_BATCH)
+                )]
+            evicted += self._remove_entries(expired_keys)
+            
+            while evicted < CACHE_EVICTION_BATCH:
+                total_entries, total_size = self._get_totals()
+                if total_entries <= self.max_entries and total_size <= self.max_size_bytes:
+                    break
+                
+                with self._connect() as conn:
+                    victim = conn.execute(
+                        f"SELECT key FROM entries WHERE key != ? ORDER BY {order_by} LIMIT 1",
+                        (protected_key or "",)
+                    ).fetchone()
+                if victim is None:
+                    break
+                
+                evicted += self._remove_entries([victim[0]])
+        except Exception as e:
+            print(f"Ошибка вытеснения записей кэша: {e}")
+        
+        if evicted:
+            print(f"Вытеснено записей кэша ({self.eviction_policy}): {evicted}")
+            self._record_metrics(evictions=evicted)
+        return evicted
+    
+    def _get_totals(self) -> Tuple[int, int]:
+        """Количество записей и общий объем кэша (записи + блобы) в байтах"""
+        with self._connect() as conn:
+            total_entries, entries_size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            blobs_size = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM blobs"
+            ).fetchone()[0]
+        return total_entries, entries_size + blobs_size
+    
+    def save_blob(self, data: bytes) -> Optional[str]:
+        """
+        Сохранение бинарных данных в контентно-адресуемое хранилище
+        
+        Блоб без ссылок из записей может быть удален при сборке мусора,
+        поэтому обычно блобы сохраняются через save_to_cache.
+        """
+        if not self.enabled:
+            return None
+        
+        try:
+            blob_hash = hashlib.sha256(data).hexdigest()
+            
+            # Одинаковые данные хранятся один раз
+            if not self.backend.exists(NAMESPACE_BLOBS, blob_hash):
+                self.backend.put(NAMESPACE_BLOBS, blob_hash, data)
+            self.memory.put(f"blob:{blob_hash}", data, len(data))
+            
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO blobs (hash, size, refs) VALUES (?, ?, 0)",
+                    (blob_hash, len(data))
+                )
+            
+            return blob_hash
+        except Exception as e:
+            print(f"Ошибка сохранения блоба в кэш: {e}")
+            return None
+    
+    def load_blob(self, blob_hash: str) -> Optional[bytes]:
+        """Загрузка бинарных данных из хранилища блобов"""
+        if not self.enabled:
+            return None
+        
+        data = self.memory.get(f"blob:{blob_hash}")
+        if data is not None:
+            return data
+        
+        try:
+            data = self.backend.get(NAMESPACE_BLOBS, blob_hash)
+            if data is None:
+                print(f"Блоб {blob_hash} не найден в хранилище кэша")
+                return None
+            self.memory.put(f"blob:{blob_hash}", data, len(data))
+            return data
+        except Exception as e:
+            print(f"Ошибка чтения блоба из кэша: {e}")
+            return None
+    
+    def _extract_blobs(self, value: Any, blob_hashes: Set[str]) -> Any:
+        """Замена bytes на ссылки на блобы для сериализации в JSON"""
+        if isinstance(value, (bytes, bytearray)):
+            blob_hash = self.save_blob(bytes(value))
+            if blob_hash is None:
+                raise IOError("не удалось сохранить бинарные данные")
+            blob_hashes.add(blob_hash)
+            return {BLOB_REF_KEY: blob_hash}
+        if isinstance(value, dict):
+            return {k: self._extract_blobs(v, blob_hashes) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._extract_blobs(v, blob_hashes) for v in value]
+        return value
+    
+    def _rehydrate_blobs(self, value: Any) -> Any:
+        """Подстановка bytes вместо ссылок на блобы"""
+        if isinstance(value, dict):
+            if set(value.keys()) == {BLOB_REF_KEY}:
+                data = self.load_blob(value[BLOB_REF_KEY])
+                if data is None:
+                    raise IOError(f"блоб {value[BLOB_REF_KEY]} не найден")
+                return data
+            return {k: self._rehydrate_blobs(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._rehydrate_blobs(v) for v in value]
+        return value
+    
+    def _unlink_entry_blobs(self, conn: sqlite3.Connection, cache_key: str) -> List[str]:
+        """Снятие ссылок записи на блобы, возвращает затронутые хеши"""
+        hashes = [row[0] for row in conn.execute(
+            "SELECT hash FROM entry_blobs WHERE key = ?", (cache_key,)
+        )]
+        conn.execute("DELETE FROM entry_blobs WHERE key = ?", (cache_key,))
+        for blob_hash in hashes:
+            conn.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (blob_hash,))
+        return hashes
+    
+    def _collect_orphan_blobs(self, conn: sqlite3.Connection, hashes: List[str]) -> List[str]:
+        """Удаление из индекса блобов без ссылок, возвращает их хеши"""
+        orphans = []
+        for blob_hash in set(hashes):
+            row = conn.execute("SELECT refs FROM blobs WHERE hash = ?", (blob_hash,)).fetchone()
+            if row is not None and row[0] <= 0:
+                conn.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+                orphans.append(blob_hash)
+        return orphans
+    
+    def _delete_blob_files(self, hashes: List[str]):
+        """Удаление данных блобов из хранилища"""
+        for blob_hash in hashes:
+            self.memory.pop(f"blob:{blob_hash}")
+            self.backend.delete(NAMESPACE_BLOBS, blob_hash)
+    
+    def _remove_entries(self, cache_keys: List[str]) -> int:
+        """Удаление записей из индекса и хранилища вместе с осиротевшими блобами"""
+        if not cache_keys:
+            return 0
+        
+        with self._write_lock():
+            with self._connect() as conn:
+                orphan_candidates = []
+                for cache_key in cache_keys:
+                    orphan_candidates.extend(self._unlink_entry_blobs(conn, cache_key))
+                    conn.execute("DELETE FROM entries WHERE key = ?", (cache_key,))
+                    conn.execute("DELETE FROM similar_products WHERE key = ?", (cache_key,))
+                orphans = self._collect_orphan_blobs(conn, orphan_candidates)
+            
+            for cache_key in cache_keys:
+                self.memory.pop(f"entry:{cache_key}")
+                self.backend.delete(NAMESPACE_ENTRIES, cache_key)
+            self._delete_blob_files(orphans)
+        
+        return len(cache_keys)
+    
+    def _migrate_perceptual_index(self, conn: sqlite3.Connection):
+        """Удаление перцептивного индекса старого формата (заменен таблицей similar_products)"""
+        if conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'perceptual_index'"
+        ).fetchone():
+            conn.execute("DROP TABLE perceptual_index")
+            print("Удален перцептивный индекс старого формата")
+    
+    def _migrate_flat_cache(self):
+        """Перенос записей из плоской папки кэша в хранилище с индексом"""
+        try:
+            legacy_files = [f for f in os.listdir(self.cache_dir) if f.endswith('.json')]
+        except OSError:
+            return
+        
+        flat_blob_dir = os.path.join(self.cache_dir, "blobs")
+        migrated = 0
+        for file in legacy_files:
+            cache_key = file[:-len('.json')]
+            legacy_path = os.path.join(self.cache_dir, file)
+            
+            try:
+                with open(legacy_path, 'rb') as f:
+                    data = f.read()
+                cache_data = decode_entry(data)
+                
+                # Переносим блобы из плоской папки
+                blob_sizes = {}
+                blob_hashes = set()
+                self._collect_blob_refs(cache_data.get("result"), blob_hashes)
+                for blob_hash in blob_hashes:
+                    flat_blob = os.path.join(flat_blob_dir, f"{blob_hash}.blob")
+                    if os.path.exists(flat_blob):
+                        with open(flat_blob, 'rb') as f:
+                            blob_data = f.read()
+                        self.backend.put(NAMESPACE_BLOBS, blob_hash, blob_data)
+                        os.remove(flat_blob)
+                        blob_sizes[blob_hash] = len(blob_data)
+                
+                created_at = cache_data.get("timestamp", os.path.getctime(legacy_path))
+                ttl = cache_data.get("expiry_hours", self.expiry_hours) * 3600
+                
+                # Формат данных не меняем - перезапись произойдет при первом чтении
+                self.backend.put(NAMESPACE_ENTRIES, cache_key, data)
+                os.remove(legacy_path)
+                
+                with self._connect() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO entries "
+                        "(key, created_at, last_access, ttl, expires_at, size, hits) "
+                        "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                        (cache_key, created_at, created_at, ttl, created_at + ttl, len(data))
+                    )
+                    for blob_hash, blob_size in blob_sizes.items():
+                        conn.execute(
+                            "INSERT OR IGNORE INTO blobs (hash, size, refs) VALUES (?, ?, 0)",
+                            (blob_hash, blob_size)
+                        )
+                        conn.execute(
+                            "INSERT OR IGNORE INTO entry_blobs (key, hash) VALUES (?, ?)",
+                            (cache_key, blob_hash)
+                        )
+                        conn.execute(
+                            "UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (blob_hash,)
+                        )
+                migrated += 1
+            except Exception as e:
+                print(f"Ошибка переноса записи кэша {file}: {e}")
+        
+        if migrated:
+            print(f"✅ Перенесено записей кэша в индекс: {migrated}")
+    
+    def _collect_blob_refs(self, value: Any, blob_hashes: Set[str]):
+        """Сбор ссылок на блобы из записи кэша"""
+        if isinstance(value, dict):
+            if set(value.keys()) == {BLOB_REF_KEY}:
+                blob_hashes.add(value[BLOB_REF_KEY])
+                return
+            for v in value.values():
+                self._collect_blob_refs(v, blob_hashes)
+        elif isinstance(value, list):
+            for v in value:
+                self._collect_blob_refs(v, blob_hashes)
+    
+    def save_image_to_cache(self, cache_key: str, image: Image.Image,
                            image_name: str) -> Optional[str]:
         """Сохранение изображения в кэш"""
         if not self.enabled:
@@ -108,45 +1160,82 @@ class CacheManager:
             return {"enabled": False}
         
         try:
-            cache_files = [f for f in os.listdir(self.cache_dir) 
-                          if f.endswith('.json')]
-            
-            total_size = 0
-            for file in cache_files:
-                file_path = os.path.join(self.cache_dir, file)
-                total_size += os.path.getsize(file_path)
+            self._flush_touches()
+            with self._connect() as conn:
+                total_files, entries_size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+                ).fetchone()
+                total_blobs, blobs_size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs"
+                ).fetchone()
             
             return {
                 "enabled": True,
-                "total_files": len(cache_files),
-                "total_size_mb": round(total_size / (1024 * 1024), 2),
+                "total_files": total_files,
+                "total_blobs": total_blobs,
+                "total_size_mb": round((entries_size + blobs_size) / (1024 * 1024), 2),
+                "max_size_mb": round(self.max_size_bytes / (1024 * 1024), 2),
+                "max_entries": self.max_entries,
+                "eviction_policy": self.eviction_policy,
+                "backend": self.backend.name,
+                "memory": self.memory.get_stats(),
+                "tiers": self.get_tier_stats(),
+                "metrics": self.get_metrics(),
                 "cache_dir": self.cache_dir
             }
         except Exception as e:
             return {"enabled": True, "error": str(e)}
     
+    def get_metrics(self) -> Dict:
+        """
+        Накопительные метрики эффективности кэша (сохраняются между перезапусками)
+        
+        Returns:
+            Счетчики CACHE_METRICS и доля попаданий hit_ratio
+        """
+        if not self.enabled:
+            return {}
+        
+        self._flush_touches()
+        metrics = {name: 0 for name in CACHE_METRICS}
+        try:
+            with self._connect() as conn:
+                for name, value in conn.execute("SELECT name, value FROM metrics"):
+                    metrics[name] = value
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения метрик кэша: {e}")
+        
+        for name in CACHE_METRICS:
+            if name != "cost_saved_usd":
+                metrics[name] = int(metrics[name])
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_ratio"] = round(metrics["hits"] / lookups, 4) if lookups else 0.0
+        return metrics
+    
+    def get_tier_stats(self) -> Dict:
+        """Попадания и промахи по уровням кэша (память/диск)"""
+        with self._stats_lock:
+            return {tier: dict(counters) for tier, counters in self.tier_stats.items()}
+    
     def clear_expired_cache(self) -> int:
         """Очистка устаревшего кэша"""
         if not self.enabled:
             return 0
         
-        cleared_count = 0
-        current_time = time.time()
-        expiry_seconds = self.expiry_hours * 3600
-        
         try:
-            for file in os.listdir(self.cache_dir):
-                if file.endswith('.json'):
-                    file_path = os.path.join(self.cache_dir, file)
-                    file_time = os.path.getctime(file_path)
-                    
-                    if (current_time - file_time) > expiry_seconds:
-                        os.remove(file_path)
-                        cleared_count += 1
+            with self._connect() as conn:
+                expired_keys = [row[0] for row in conn.execute(
+                    "SELECT key FROM entries WHERE expires_at <= ?", (time.time(),)
+                )]
+                # Неудачи старше максимальной паузы уже не влияют на backoff
+                conn.execute(
+                    "DELETE FROM failures WHERE last_failure <= ?",
+                    (time.time() - NEGATIVE_CACHE_MAX_BACKOFF_SECONDS,)
+                )
+            return self._remove_entries(expired_keys)
         except Exception as e:
             print(f"Ошибка очистки кэша: {e}")
-        
-        return cleared_count
+            return 0
     
     def clear_all_cache(self) -> bool:
         """Полная очистка кэша"""
@@ -154,13 +1243,34 @@ class CacheManager:
             return False
         
         try:
-            for file in os.listdir(self.cache_dir):
-                file_path = os.path.join(self.cache_dir, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                elif os.path.isdir(file_path):
-                    import shutil
-                    shutil.rmtree(file_path)
+            # Метрики описывают работу кэша за все время - очистка их не сбрасывает
+            metrics = self.get_metrics()
+            
+            # Блокировка записи: одновременный save_to_cache не должен оставить
+            # в новом индексе запись, блоб которой уже удален
+            with self._write_lock():
+                self.memory.clear()
+                with self._stats_lock:
+                    self._pending_touches = {}
+                
+                self.backend.clear()
+                for file in os.listdir(self.cache_dir):
+                    file_path = os.path.join(self.cache_dir, file)
+                    if file_path == self.lock_path:
+                        # Файл блокировки удалять нельзя: другие воркеры заблокировали бы новый файл
+                        continue
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                    elif os.path.isdir(file_path):
+                        shutil.rmtree(file_path)
+                
+                # Пересоздаем пустой индекс
+                self._init_index()
+                with self._connect() as conn:
+                    conn.executemany(
+                        "INSERT INTO metrics (name, value) VALUES (?, ?)",
+                        [(name, metrics[name]) for name in CACHE_METRICS]
+                    )
             return True
         except Exception as e:
             print(f"Ошибка полной очистки кэша: {e}")
@@ -54,11 +54,13 @@ FTP_PASSWORD = os.getenv('FTP_PASSWORD', '')
 FTP_REMOTE_PATH = os.getenv('FTP_REMOTE_PATH', '/mockups')
 GEMINI_MODEL = 'gemini-2.5-flash-image-preview'  # Официальная модель для генерации изображений
 GEMINI_ANALYSIS_MODEL = 'gemini-2.0-flash-exp'  # Современная модель для анализа коллекций
+GEMINI_DEBUG = os.getenv('GEMINI_DEBUG', 'false').lower() == 'true'  # Полные промпты и ответы Gemini в лог
 
 # Настройки изображений (ОПТИМИЗИРОВАННЫЕ для экономии API токенов)
 MAX_IMAGE_SIZE = (384, 384)  # Оптимизированный размер для экономии API токенов (-25% токенов)
 COMPRESSION_QUALITY = 60  # Более агрессивное сжатие (-15% токенов)
 LOGO_MAX_SIZE = (128, 128)  # Оптимизированный размер логотипа (-30% токенов)
+PREPARED_IMAGE_CACHE_SIZE = 64  # Изображений, подготовленных для API (байты запроса), в памяти процесса
 
 # Стандартные размеры для генерации
 STANDARD_MOCKUP_SIZE = (1024, 1024)  # Стандартный размер для всех мокапов
@@ -73,6 +75,43 @@ TEMPLATES_DIR = 'templates'
 # Кэширование
 CACHE_ENABLED = True
 CACHE_EXPIRY_HOURS = 24
+CACHE_INDEX_FILE = 'index.db'  # SQLite индекс записей кэша (внутри CACHE_DIR)
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'filesystem')  # Хранилище данных кэша: filesystem или sqlite
+CACHE_SQLITE_FILE = 'store.db'  # Файл хранилища sqlite (внутри CACHE_DIR)
+CACHE_MAX_SIZE_MB = int(os.getenv('CACHE_MAX_SIZE_MB', '1024'))  # Лимит объема кэша на диске
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))  # Лимит количества записей
+CACHE_EVICTION_POLICY = os.getenv('CACHE_EVICTION_POLICY', 'lru')  # lru или lfu
+CACHE_EVICTION_BATCH = 20  # Максимум вытесняемых записей за одну запись в кэш
+CACHE_MEMORY_MAX_MB = int(os.getenv('CACHE_MEMORY_MAX_MB', '64'))  # Лимит кэша в памяти процесса
+CACHE_MEMORY_REVALIDATE_SECONDS = 5  # Как часто запись из памяти сверяется с индексом (изменения других воркеров)
+CACHE_PERCEPTUAL_ENABLED = os.getenv('CACHE_PERCEPTUAL_ENABLED', 'false').lower() == 'true'  # Поиск почти одинаковых товаров (включается явно; логотип - только точно)
+CACHE_PERCEPTUAL_THRESHOLD = int(os.getenv('CACHE_PERCEPTUAL_THRESHOLD', '6'))  # Макс. расстояние Хэмминга из 256 бит: 6 - пересохранение JPEG (качество от 70) и ресайз того же фото (мелкие отличия принта не различаются)
+CACHE_LEASE_SECONDS = 120  # Срок аренды "генерация в процессе" (защита от упавших воркеров)
+CACHE_LEASE_WAIT_SECONDS = 90  # Сколько ждать результат генерации другого воркера
+CACHE_SERIALIZATION = os.getenv('CACHE_SERIALIZATION', 'binary')  # binary (компактный) или json
+CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', 'true').lower() == 'true'  # zlib для бинарных записей
+BRAND_CACHE_TTL_HOURS = int(os.getenv('BRAND_CACHE_TTL_HOURS', '168'))  # Срок жизни анализа бренда по логотипу
+NEGATIVE_CACHE_ENABLED = True  # Запоминать неудачные генерации, чтобы не повторять их сразу
+NEGATIVE_CACHE_TTL_SECONDS = 60  # Пауза после первой неудачи (удваивается с каждой следующей)
+NEGATIVE_CACHE_MAX_BACKOFF_SECONDS = 1800  # Максимальная пауза
+
+# Оценка стоимости вызовов Gemini для метрик кэша (токены на вызов и цена в USD)
+GEMINI_CALL_ESTIMATES = {
+    "mockup": {"tokens": 2400, "cost_usd": 0.039},               # 2 изображения + промпт, 1 изображение на выходе
+    "collection_analysis": {"tokens": 4000, "cost_usd": 0.001},  # изображения коллекции + JSON ответ
+    "brand_analysis": {"tokens": 1500, "cost_usd": 0.0005},      # логотип + текстовый анализ
+    "files_analysis": {"tokens": 6000, "cost_usd": 0.002}        # брендбук (файлы) + текстовый ответ
+}
+
+# Журнал использования Gemini (токены и стоимость каждого вызова, JSON Lines)
+USAGE_LEDGER_ENABLED = os.getenv('USAGE_LEDGER_ENABLED', 'true').lower() == 'true'
+USAGE_LEDGER_FILE = os.getenv('USAGE_LEDGER_FILE', os.path.join('usage', 'gemini_usage.jsonl'))
+
+# Цены Gemini, USD за 1 млн токенов (вход, текстовый выход, выход изображениями)
+GEMINI_PRICING = {
+    "gemini-2.5-flash-image-preview": {"input": 0.30, "output": 2.50, "image_output": 30.00},
+    "gemini-2.0-flash-exp": {"input": 0.10, "output": 0.40, "image_output": 30.00}
+}
 
 # Веб-интерфейс
 STREAMLIT_PORT = 8501
@@ -80,7 +119,36 @@ STREAMLIT_HOST = 'localhost'
 
 # Экономичные настройки (МАКСИМАЛЬНО ЭКОНОМНЫЕ)
 BATCH_SIZE = 1  # Только один вариант за запрос для экономии
-MAX_CONCURRENT_REQUESTS = 1  # Только один запрос одновременно
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', '1'))  # Только один запрос одновременно (больше - через окружение)
+REGENERATE_CANDIDATES = int(os.getenv('REGENERATE_CANDIDATES', '3'))  # Вариантов за одно пересоздание (лишние ждут в пуле)
+REGENERATE_POOL_MAX_RESULTS = 32  # Результатов, для которых хранится пул вариантов
+COLLECTION_ANALYSIS_CHUNK_SIZE = int(os.getenv('COLLECTION_ANALYSIS_CHUNK_SIZE', '8'))  # Товаров в одном запросе анализа коллекции
+
+# Ограничение частоты запросов к Gemini (общее для всех клиентов процесса)
+GEMINI_RPM_LIMIT = int(os.getenv('GEMINI_RPM_LIMIT', '60'))  # Запросов в минуту
+GEMINI_TPM_LIMIT = int(os.getenv('GEMINI_TPM_LIMIT', '1000000'))  # Токенов в минуту
+GEMINI_MIN_CONCURRENCY = 1  # Нижняя граница параллелизма после ответов 429 (верхняя - MAX_CONCURRENT_REQUESTS)
+
+# HTTP соединения с Gemini (один клиент на процесс, соединения переиспользуются)
+GEMINI_HTTP_POOL_SIZE = int(os.getenv('GEMINI_HTTP_POOL_SIZE', '16'))  # Максимум соединений в пуле
+GEMINI_HTTP_KEEPALIVE_SECONDS = 120  # Сколько держать простаивающее соединение открытым
+
+# Повторы запросов к Gemini (429, таймауты, 5xx) и предохранитель
+GEMINI_RETRY_ATTEMPTS = int(os.getenv('GEMINI_RETRY_ATTEMPTS', '3'))  # Всего попыток на запрос
+GEMINI_RETRY_BASE_DELAY = 1.0  # Базовая пауза перед повтором, секунды (удваивается)
+GEMINI_RETRY_MAX_DELAY = 20.0  # Максимальная пауза перед повтором
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = 5  # Ошибок API подряд до размыкания предохранителя
+GEMINI_CIRCUIT_COOLDOWN_SECONDS = 30  # Пауза, в течение которой запросы сразу отклоняются
+
+# Офлайн-заглушка Gemini (fake_gemini.py) для бенчмарков и нагрузочных тестов без сети и квоты
+GEMINI_FAKE_ENABLED = os.getenv('GEMINI_FAKE_ENABLED', 'false').lower() == 'true'
+GEMINI_FAKE_LATENCY = os.getenv('GEMINI_FAKE_LATENCY', 'lognormal')  # fixed, uniform, normal или lognormal
+GEMINI_FAKE_LATENCY_MEAN = float(os.getenv('GEMINI_FAKE_LATENCY_MEAN', '2.0'))  # Средняя задержка ответа, секунды
+GEMINI_FAKE_LATENCY_SPREAD = float(os.getenv('GEMINI_FAKE_LATENCY_SPREAD', '0.5'))  # Разброс (для lognormal - сигма)
+GEMINI_FAKE_ERROR_RATE = float(os.getenv('GEMINI_FAKE_ERROR_RATE', '0.0'))  # Доля ответов 503
+GEMINI_FAKE_RATE_LIMIT_RATE = float(os.getenv('GEMINI_FAKE_RATE_LIMIT_RATE', '0.0'))  # Вероятность начала серии 429
+GEMINI_FAKE_RATE_LIMIT_BURST = int(os.getenv('GEMINI_FAKE_RATE_LIMIT_BURST', '5'))  # Ответов 429 в серии
+GEMINI_FAKE_SEED = int(os.getenv('GEMINI_FAKE_SEED', '0'))  # Зерно случайных задержек и ошибок
 
 # Оптимизации (можно отключить для отладки)
 UNIFIED_ANALYSIS_ENABLED = True  # Объединенный анализ в креативном генераторе
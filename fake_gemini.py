@@ -0,0 +1,283 @@
+"""
+Офлайн-заглушка Gemini API для бенчмарков и нагрузочных тестов
+FakeGeminiClient повторяет используемую часть genai.Client (models и
+aio.models.generate_content): детерминированные изображения мокапов и JSON
+анализа коллекций, задержки по заданному распределению, доля ошибок 503 и
+серии ответов 429. Включается GEMINI_FAKE_ENABLED=true (см. GeminiClient).
+
+Запуск бенчмарка пакетной генерации: GEMINI_FAKE_ENABLED=true python fake_gemini.py 20
+"""
+import asyncio
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from PIL import Image, ImageDraw
+from google.genai import errors, types
+from config import (GEMINI_MODEL, STANDARD_MOCKUP_SIZE, GEMINI_FAKE_LATENCY, GEMINI_FAKE_LATENCY_MEAN,
+                    GEMINI_FAKE_LATENCY_SPREAD, GEMINI_FAKE_ERROR_RATE, GEMINI_FAKE_RATE_LIMIT_RATE,
+                    GEMINI_FAKE_RATE_LIMIT_BURST, GEMINI_FAKE_SEED)
+
+# Распределения задержки ответа: (генератор, среднее, разброс) -> секунды
+LATENCY_DISTRIBUTIONS = {
+    "fixed": lambda rng, mean, spread: mean,
+    "uniform": lambda rng, mean, spread: rng.uniform(mean - spread, mean + spread),
+    "normal": lambda rng, mean, spread: rng.gauss(mean, spread),
+    # Длинный хвост, как у реального API; spread - сигма логарифма
+    "lognormal": lambda rng, mean, spread: mean * math.exp(rng.gauss(-spread ** 2 / 2, spread))
+}
+
+# Токены (как считает Gemini): изображение на входе и изображение на выходе
+IMAGE_INPUT_TOKENS = 258
+IMAGE_OUTPUT_TOKENS = 1290
+
+# Допустимые значения рекомендаций (из промпта анализа коллекции)
+ANALYSIS_CHOICES = {
+    "logo_application": ["embroidery", "printing", "sublimation"],
+    "logo_position": ["центр", "верхний левый угол", "верхний правый угол", "левый бок", "верх"],
+    "logo_size": ["маленький", "средний", "большой"],
+    "product_angle": ["как на фото", "спереди", "в полуоборот", "сверху", "сбоку"]
+}
+
+class FakeGeminiBackend:
+    """
+    Общее состояние заглушки процесса: генератор случайных чисел для
+    задержек и ошибок, текущая серия 429 и счетчики вызовов
+    """
+    
+    def __init__(self, latency: str = GEMINI_FAKE_LATENCY, latency_mean: float = GEMINI_FAKE_LATENCY_MEAN,
+                 latency_spread: float = GEMINI_FAKE_LATENCY_SPREAD, error_rate: float = GEMINI_FAKE_ERROR_RATE,
+                 rate_limit_rate: float = GEMINI_FAKE_RATE_LIMIT_RATE,
+                 rate_limit_burst: int = GEMINI_FAKE_RATE_LIMIT_BURST, seed: int = GEMINI_FAKE_SEED):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Неизвестное распределение задержки: {latency}")
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_spread = latency_spread
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rate_limit_burst = rate_limit_burst
+        self.burst_remaining = 0
+        self.stats = {"calls": 0, "server_errors": 0, "rate_limited": 0, "latency_seconds": 0.0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+    
+    def next_call(self) -> Tuple[float, Optional[Exception]]:
+        """Задержка очередного вызова и ошибка, которой он завершится (None - успех)"""
+        with self._lock:
+            self.stats["calls"] += 1
+            delay = max(0.0, LATENCY_DISTRIBUTIONS[self.latency](
+                self._rng, self.latency_mean, self.latency_spread))
+            self.stats["latency_seconds"] += delay
+            
+            if self.burst_remaining == 0 and self._rng.random() < self.rate_limit_rate:
+                self.burst_remaining = self.rate_limit_burst
+            if self.burst_remaining > 0:
+                # Квота исчерпана: 429 отвечают быстро
+                self.burst_remaining -= 1
+                self.stats["rate_limited"] += 1
+                return delay / 10, errors.ClientError(429, {"error": {
+                    "code": 429, "status": "RESOURCE_EXHAUSTED",
+                    "message": "Resource has been exhausted (fake quota)"
+                }})
+            
+            if self._rng.random() < self.error_rate:
+                self.stats["server_errors"] += 1
+                return delay, errors.ServerError(503, {"error": {
+                    "code": 503, "status": "UNAVAILABLE",
+                    "message": "The model is overloaded (fake)"
+                }})
+            return delay, None
+    
+    def get_stats(self) -> Dict:
+        """Счетчики вызовов заглушки"""
+        with self._lock:
+            return {**self.stats, "latency_seconds": round(self.stats["latency_seconds"], 2)}
+
+_fake_backend = None
+_fake_backend_lock = threading.Lock()
+
+def get_fake_backend() -> FakeGeminiBackend:
+    """Состояние заглушки процесса (общее для всех FakeGeminiClient, как квота API)"""
+    global _fake_backend
+    
+    with _fake_backend_lock:
+        if _fake_backend is None:
+            _fake_backend = FakeGeminiBackend()
+        return _fake_backend
+
+def _split_contents(contents: Any) -> Tuple[str, List[bytes]]:
+    """Текст и байты вложений запроса (строки, PIL, types.Part, словари inline_data)"""
+    texts, blobs = [], []
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, Image.Image):
+            blobs.append(item.tobytes())
+        elif isinstance(item, types.Part):
+            if item.text:
+                texts.append(item.text)
+            elif item.inline_data and item.inline_data.data:
+                blobs.append(item.inline_data.data)
+        elif isinstance(item, dict) and "inline_data" in item:
+            data = item["inline_data"]["data"]
+            blobs.append(data.encode() if isinstance(data, str) else data)
+    return "\n".join(texts), blobs
+
+def _first_image(contents: Any) -> Optional[Image.Image]:
+    """Первое изображение запроса (товар) для основы синтетического мокапа"""
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, Image.Image):
+            return item
+        if isinstance(item, types.Part) and item.inline_data and item.inline_data.data:
+            try:
+                return Image.open(io.BytesIO(item.inline_data.data))
+            except Exception:
+                return None
+    return None
+
+def _synthetic_mockup(contents: Any, digest: bytes) -> bytes:
+    """PNG мокапа: товар запроса, тонированный цветом хеша, с меткой логотипа"""
+    color = tuple(digest[:3])
+    base = _first_image(contents)
+    if base is not None:
+        image = Image.blend(base.convert("RGB").resize(STANDARD_MOCKUP_SIZE), Image.new("RGB", STANDARD_MOCKUP_SIZE, color), 0.3)
+    else:
+        image = Image.new("RGB", STANDARD_MOCKUP_SIZE, color)
+    
+    width, height = STANDARD_MOCKUP_SIZE
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([width * 3 // 8, height * 3 // 8, width * 5 // 8, height * 5 // 8],
+                   outline=tuple(255 - c for c in color), width=8)
+    
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def _synthetic_analysis(text: str, image_count: int, digest: bytes) -> str:
+    """JSON анализа коллекции: по рекомендации на каждый товар (изображения после логотипа)"""
+    count = image_count - 1
+    if count < 1:
+        match = re.search(r"из (\d+) товаров", text)
+        count = int(match.group(1)) if match else 1
+    style = re.search(r"стиль: (\w+)", text)
+    color = re.search(r"используй указанный: ([^)]+)\)", text)
+    
+    prompts = []
+    for i in range(count):
+        choice = {name: values[(digest[i % len(digest)] + i) % len(values)]
+                  for name, values in ANALYSIS_CHOICES.items()}
+        prompts.append({
+            "style": style.group(1) if style else "modern",
+            "logo_color": "как на фото",
+            "product_color": color.group(1) if color else "как на фото",
+            "custom_prompt": f"товар {i + 1}",
+            "reasoning": "синтетический ответ офлайн-заглушки",
+            **choice
+        })
+    return json.dumps({"collection_theme": "fake", "individual_prompts": prompts}, ensure_ascii=False)
+
+def fake_response(model: str, contents: Any) -> types.GenerateContentResponse:
+    """Детерминированный ответ на запрос: одинаковые запросы получают одинаковый ответ"""
+    text, blobs = _split_contents(contents)
+    hasher = hashlib.sha256(model.encode() + text.encode())
+    for blob in blobs:
+        hasher.update(blob)
+    digest = hasher.digest()
+    
+    prompt_tokens = IMAGE_INPUT_TOKENS * len(blobs) + len(text) // 4
+    if model == GEMINI_MODEL:
+        parts = [types.Part.from_text(text="Мокап готов (офлайн-заглушка)"),
+                 types.Part.from_bytes(data=_synthetic_mockup(contents, digest), mime_type="image/png")]
+        output_tokens = IMAGE_OUTPUT_TOKENS + 10
+        details = [types.ModalityTokenCount(modality="IMAGE", token_count=IMAGE_OUTPUT_TOKENS)]
+    else:
+        if "individual_prompts" in text:
+            answer = _synthetic_analysis(text, len(blobs), digest)
+        else:
+            answer = f"Анализ бренда (офлайн-заглушка, {digest.hex()[:8]}): современный минималистичный стиль."
+        parts = [types.Part.from_text(text=answer)]
+        output_tokens = len(answer) // 4
+        details = None
+    
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=parts),
+                                    finish_reason=types.FinishReason.STOP)],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens, candidates_tokens_details=details
+        )
+    )
+
+class FakeModels:
+    """Заглушка client.models"""
+    
+    def generate_content(self, model: str, contents: Any, config: Any = None) -> types.GenerateContentResponse:
+        delay, error = get_fake_backend().next_call()
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return fake_response(model, contents)
+
+class FakeAsyncModels:
+    """Заглушка client.aio.models"""
+    
+    async def generate_content(self, model: str, contents: Any, config: Any = None) -> types.GenerateContentResponse:
+        delay, error = get_fake_backend().next_call()
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return await asyncio.to_thread(fake_response, model, contents)
+
+class FakeAsyncClient:
+    """Заглушка client.aio"""
+    
+    def __init__(self):
+        self.models = FakeAsyncModels()
+
+class FakeGeminiClient:
+    """Замена genai.Client без сети и API ключа"""
+    
+    def __init__(self, **kwargs):
+        self.models = FakeModels()
+        self.aio = FakeAsyncClient()
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import config
+    # Кэш, результаты и журнал использования бенчмарка - во временном каталоге,
+    # запросы - только в заглушку (до импорта модулей, читающих настройки)
+    config.CACHE_DIR = config.OUTPUT_DIR = tempfile.mkdtemp()
+    config.USAGE_LEDGER_FILE = os.path.join(config.CACHE_DIR, "usage_ledger.jsonl")
+    config.GEMINI_FAKE_ENABLED = True
+    from batch_processor import BatchProcessor
+    from gemini_client import get_genai_client
+    # Состояние модуля, которым пользуется GeminiClient (не __main__)
+    from fake_gemini import get_fake_backend, FakeGeminiClient as SharedFakeClient
+    from rate_limiter import get_rate_limiter
+    from retry_policy import get_circuit_breaker
+    
+    if not isinstance(get_genai_client(), SharedFakeClient):
+        # Бенчмарк не должен расходовать квоту реального API
+        sys.exit("❌ Бенчмарк запускается только с офлайн-заглушкой")
+    
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    products = [Image.new("RGB", (800, 800), (i * 37 % 256, i * 91 % 256, 128)) for i in range(count)]
+    logo = Image.new("RGB", (200, 200), "black")
+    prompts = [{"style": "modern"}] * count
+    
+    started = time.time()
+    result = BatchProcessor().process_batch(products, logo, prompts, {"collection_id": "fake_benchmark"})
+    elapsed = time.time() - started
+    print(f"📊 Пакет: {result.get('successful', 0)}/{count} за {elapsed:.1f} с ({count / elapsed:.2f} товаров/с)")
+    
+    print(f"📊 Заглушка: {get_fake_backend().get_stats()}")
+    print(f"📊 Лимитер: {get_rate_limiter().get_stats()}")
+    print(f"📊 Предохранитель: {get_circuit_breaker().get_stats()}")
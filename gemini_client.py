@@ -1,35 +1,225 @@
 """
 Клиент для работы с Gemini 2.5 Flash API (Nano Banana)
 Использует новый официальный API для генерации изображений
+GeminiClient - синхронный клиент, AsyncGeminiClient - корутины поверх client.aio
 """
 from google import genai
 from google.genai import types
+import asyncio
 import base64
+import concurrent.futures
 import io
+import threading
+import httpx
 from PIL import Image
 import json
 import time
-from typing import List, Dict, Optional
-from config import get_config, GEMINI_MODEL, GEMINI_ANALYSIS_MODEL, MAX_IMAGE_SIZE, COMPRESSION_QUALITY, PDF_COMPRESSION_ENABLED
+from typing import Any, Awaitable, List, Dict, Optional, Tuple, Union
+from config import get_config, GEMINI_MODEL, GEMINI_ANALYSIS_MODEL, MAX_IMAGE_SIZE, COMPRESSION_QUALITY, PDF_COMPRESSION_ENABLED, GEMINI_DEBUG, GEMINI_CALL_ESTIMATES, GEMINI_RETRY_ATTEMPTS, GEMINI_FAKE_ENABLED, GEMINI_HTTP_POOL_SIZE, GEMINI_HTTP_KEEPALIVE_SECONDS
+from image_processor import PreparedImage, invalidate_image_hash
+from fake_gemini import FakeGeminiClient
+from prompt_templates import render_mockup_prompt
+from rate_limiter import get_rate_limiter
+from usage_ledger import record_call
+from retry_policy import classify_error, is_retryable, backoff_delay, get_circuit_breaker, SAFETY_MARKERS
+
+def estimate_request_tokens(request: Dict) -> int:
+    """Оценка токенов запроса для лимитера (по типу вызова, см. GEMINI_CALL_ESTIMATES)"""
+    return GEMINI_CALL_ESTIMATES.get(request.get("api_kind"), {}).get("tokens", 0)
+
+def response_total_tokens(response) -> Optional[int]:
+    """Фактический расход токенов из usage_metadata ответа"""
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
+
+# Изображение для генерации мокапа: исходное или подготовленное (ImageProcessor.prepare_for_api)
+ImageInput = Union[Image.Image, PreparedImage]
+
+def attempt_info(request: Optional[Dict]) -> Dict:
+    """Число попыток и общее время вызова для записи в результат"""
+    request = request or {}
+    return {
+        "attempts": request.get("attempts", 0),
+        "latency_seconds": round(request.get("latency_seconds", 0.0), 2)
+    }
+
+def error_result(error: Exception, request: Optional[Dict]) -> Dict:
+    """Результат-fallback для ошибки вызова с ее типом и статистикой попыток"""
+    return {
+        "fallback_needed": True,
+        "error": str(error),
+        "error_type": classify_error(error),
+        **attempt_info(request)
+    }
+
+def analysis_to_mockup_args(analysis_recommendations: Dict, custom_prompt: str = "") -> Dict:
+    """Параметры generate_mockup из рекомендаций анализа коллекции"""
+    # Объединяем custom_prompt с рекомендациями
+    analysis_custom = analysis_recommendations.get("custom_prompt", "")
+    
+    return {
+        "mockup_style": analysis_recommendations.get("style", "modern"),
+        "logo_application": analysis_recommendations.get("logo_application", "embroidery"),
+        "custom_prompt": f"{analysis_custom} {custom_prompt}".strip(),
+        "product_color": analysis_recommendations.get("product_color", "как на фото"),
+        "product_angle": analysis_recommendations.get("product_angle", "как на фото"),
+        "logo_position": analysis_recommendations.get("logo_position", "центр"),
+        "logo_size": analysis_recommendations.get("logo_size", "средний"),
+        "logo_color": analysis_recommendations.get("logo_color", "как на фото")
+    }
+
+# Схема ответа анализа коллекции (structured output: response_schema)
+COLLECTION_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "collection_theme": {"type": "STRING"},
+        "individual_prompts": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "style": {"type": "STRING"},
+                    "logo_application": {"type": "STRING", "enum": ["embroidery", "printing", "sublimation"]},
+                    "logo_position": {"type": "STRING"},
+                    "logo_size": {"type": "STRING"},
+                    "logo_color": {"type": "STRING"},
+                    "product_color": {"type": "STRING"},
+                    "product_angle": {"type": "STRING"},
+                    "custom_prompt": {"type": "STRING"},
+                    "reasoning": {"type": "STRING"}
+                },
+                "required": ["style", "logo_application", "logo_position", "logo_size",
+                             "product_color", "product_angle", "custom_prompt"],
+                "propertyOrdering": ["style", "logo_application", "logo_position", "logo_size", "logo_color",
+                                     "product_color", "product_angle", "custom_prompt", "reasoning"]
+            }
+        }
+    },
+    "required": ["individual_prompts"],
+    "propertyOrdering": ["collection_theme", "individual_prompts"]
+}
+
+# Закрывающие скобки для открытых контейнеров JSON
+JSON_CLOSERS = {"{": "}", "[": "]"}
+
+def repair_json(text: str) -> Optional[Any]:
+    """
+    Разбор JSON из ответа модели с исправлением типичных дефектов
+    
+    Убирает обрамление ```json и текст вокруг, висячие запятые, переводы
+    строк внутри строк; оборванный ответ (max_output_tokens) обрезается
+    до последнего целиком полученного элемента - недописанные значения
+    не сохраняются.
+    
+    Returns:
+        Разобранное значение или None, если JSON восстановить не удалось
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return None
+    text = text[min(starts):]
+    
+    try:
+        return json.JSONDecoder().raw_decode(text)[0]
+    except json.JSONDecodeError:
+        pass
+    
+    # Посимвольный проход: стек открытых контейнеров и точки, где можно оборвать ответ
+    out = []
+    stack = []
+    cuts = []
+    in_string = escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            elif char == "\n":
+                char = "\\n"
+            out.append(char)
+            continue
+        
+        if char == '"':
+            in_string = True
+        elif char in JSON_CLOSERS:
+            stack.append(JSON_CLOSERS[char])
+        elif char in "}]":
+            if not stack:
+                break
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            out.append(stack.pop())
+            if not stack:
+                break
+            cuts.append((len(out), tuple(stack)))
+            continue
+        elif char == ",":
+            cuts.append((len(out), tuple(stack)))
+        out.append(char)
+    
+    for position, open_stack in reversed(cuts):
+        try:
+            return json.loads("".join(out[:position]) + "".join(reversed(open_stack)))
+        except json.JSONDecodeError:
+            continue
+    return None
+
+_genai_client = None
+_genai_client_lock = threading.Lock()
+
+def _create_genai_client():
+    """genai.Client с общим пулом keep-alive соединений (синхронный и асинхронный транспорт)"""
+    # Получаем актуальную конфигурацию
+    config = get_config()
+    api_key = config['GEMINI_API_KEY']
+    
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY не найден в переменных окружения")
+    
+    limits = httpx.Limits(max_connections=GEMINI_HTTP_POOL_SIZE,
+                          max_keepalive_connections=GEMINI_HTTP_POOL_SIZE,
+                          keepalive_expiry=GEMINI_HTTP_KEEPALIVE_SECONDS)
+    try:
+        # Явный транспорт httpx: SDK не переключается на aiohttp, пул задается здесь
+        return genai.Client(api_key=api_key, http_options=types.HttpOptions(
+            client_args={"transport": httpx.HTTPTransport(limits=limits)},
+            async_client_args={"transport": httpx.AsyncHTTPTransport(limits=limits)}
+        ))
+    except (TypeError, ValueError) as e:
+        # Старые версии SDK без client_args - транспорт по умолчанию
+        print(f"⚠️ Gemini: пул соединений не настроен ({e}), используется клиент по умолчанию")
+        return genai.Client(api_key=api_key)
+
+def get_genai_client():
+    """Клиент Gemini API процесса (создается при первом вызове, соединения общие для всех GeminiClient)"""
+    global _genai_client
+    
+    with _genai_client_lock:
+        if _genai_client is None:
+            if GEMINI_FAKE_ENABLED:
+                # Офлайн-заглушка для бенчмарков: без сети и API ключа
+                print("🧪 Gemini: используется офлайн-заглушка (GEMINI_FAKE_ENABLED)")
+                _genai_client = FakeGeminiClient()
+            else:
+                _genai_client = _create_genai_client()
+        return _genai_client
 
 class GeminiClient:
     def __init__(self):
-        """Инициализация клиента Gemini 2.5 Flash"""
-        # Получаем актуальную конфигурацию
-        config = get_config()
-        api_key = config['GEMINI_API_KEY']
-        
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY не найден в переменных окружения")
-        
-        # Инициализация нового клиента
-        self.client = genai.Client(api_key=api_key)
+        """Инициализация клиента Gemini 2.5 Flash (общий клиент API процесса, см. get_genai_client)"""
+        self.client = get_genai_client()
         
     def compress_image(self, image: Image.Image) -> Image.Image:
         """Сжатие изображения для экономии токенов"""
         # Ресайз если нужно
         if image.size[0] > MAX_IMAGE_SIZE[0] or image.size[1] > MAX_IMAGE_SIZE[1]:
             image.thumbnail(MAX_IMAGE_SIZE, Image.LANCZOS)
+            invalidate_image_hash(image)
         
         # Конвертация в RGB если нужно
         if image.mode != 'RGB':
@@ -52,226 +242,158 @@ class GeminiClient:
                 return "fabric"   # Остальное - ткань
         return "fabric"
     
-    def generate_mockup(self, product_image: Image.Image, logo_image: Image.Image, 
-                       mockup_style: str = "modern", logo_application: str = "embroidery", 
-                       custom_prompt: str = "", product_color: str = "белый", 
-                       product_angle: str = "спереди", logo_position: str = "центр",
-                       logo_size: str = "средний", logo_color: str = "как на фото",
-                       pattern_image: Optional[Image.Image] = None) -> List[Dict]:
+    def _generate_content(self, request: Dict):
         """
-        Генерация мокапа с логотипом используя Gemini 2.5 Flash
+        Единая точка синхронного вызова Gemini API
         
-        Args:
-            product_image: Изображение товара
-            logo_image: Логотип клиента
-            mockup_style: Стиль мокапа (modern, vintage, minimal, luxury)
-            logo_application: Тип нанесения логотипа
-            custom_prompt: Дополнительные требования к промпту
-            product_color: Цвет товара
-            product_angle: Ракурс товара
-            logo_position: Расположение логотипа
-            logo_size: Размер логотипа
-            logo_color: Цвет логотипа
-            pattern_image: Паттерн для использования (опционально)
+        Общий лимитер частоты, повтор временных ошибок (429, таймауты, 5xx)
+        с экспоненциальной паузой и предохранитель. Число попыток и общее
+        время записываются в request["attempts"] / request["latency_seconds"].
+        """
+        started = time.time()
+        for attempt in range(1, GEMINI_RETRY_ATTEMPTS + 1):
+            estimated_tokens = self._begin_attempt(request, attempt)
+            get_rate_limiter().acquire(estimated_tokens)
+            
+            response = None
+            error = None
+            try:
+                response = self.client.models.generate_content(
+                    model=request["model"], contents=request["contents"], config=request["config"]
+                )
+            except Exception as e:
+                error = e
+            except BaseException:
+                get_rate_limiter().release(estimated_tokens)
+                raise
+            
+            delay = self._finish_attempt(request, attempt, started, estimated_tokens, response, error)
+            if delay is None:
+                return response
+            time.sleep(delay)
+    
+    def _begin_attempt(self, request: Dict, attempt: int) -> int:
+        """Проверка предохранителя перед попыткой; возвращает оценку токенов для лимитера"""
+        request["attempts"] = attempt
+        get_circuit_breaker().check()
+        request["attempt_started"] = time.time()
+        return estimate_request_tokens(request)
+    
+    def _finish_attempt(self, request: Dict, attempt: int, started: float,
+                        estimated_tokens: int, response, error: Optional[Exception]) -> Optional[float]:
+        """
+        Учет результата попытки в лимитере, предохранителе и журнале использования
         
         Returns:
-            Список сгенерированных мокапов
+            None при успехе, паузу перед повтором для временной ошибки;
+            неповторяемая ошибка (или последняя попытка) пробрасывается
         """
+        request["latency_seconds"] = time.time() - started
+        error_type = classify_error(error) if error is not None else None
+        get_rate_limiter().release(estimated_tokens, response_total_tokens(response),
+                                   error_type == "rate_limit")
+        record_call(request["model"], request.get("api_kind"), response,
+                    time.time() - request["attempt_started"], attempt, error_type or "success",
+                    fake=isinstance(self.client, FakeGeminiClient))
+        
+        if error is None:
+            get_circuit_breaker().record_success()
+            return None
         
-        # Подготовка изображений
-        processed_product = self.compress_image(product_image)
-        processed_logo = self.compress_image(logo_image)
-        processed_pattern = self.compress_image(pattern_image) if pattern_image else None
-        
-        # Определение типа продукта
-        product_type = self.detect_product_type(processed_product)
-        
-        # Универсальный промпт для разных материалов и носителей
-        material_adaptations = {
-            "fabric": {
-                "embroidery": "embroidered with raised thread texture, realistic stitching details, and natural fabric integration",
-                "printing": "printed with smooth, flat surface, crisp edges, and fabric-appropriate ink absorption",
-                "woven": "woven into the fabric with integrated texture, natural appearance, and seamless blending",
-                "embossed": "embossed with raised relief effect, realistic depth, and fabric-appropriate texture",
-                "sublimation": "sublimated with vibrant colors, smooth finish, and permanent integration into fabric",
-                "silicone": "silicone application with soft, flexible texture, raised surface, and durable finish",
-                "patch": "patch application with raised edges, fabric backing, and sewn-on appearance",
-                "heat_transfer": "heat transfer with smooth application, vibrant colors, and professional finish",
-                "screen_print": "screen printed with thick ink, matte finish, and durable application",
-                "digital_print": "digitally printed with high resolution, smooth finish, and precise details",
-                "laser_engraving": "laser engraved with subtle texture, permanent marking, and professional appearance"
-            },
-            "textile": {
-                "embroidery": "embroidered with raised thread texture, realistic stitching details, and textile-appropriate integration",
-                "printing": "printed with smooth, flat surface, crisp edges, and textile-appropriate ink absorption",
-                "woven": "woven into the textile with integrated texture, natural appearance, and seamless blending",
-                "embossed": "embossed with raised relief effect, realistic depth, and textile-appropriate texture",
-                "sublimation": "sublimated with vibrant colors, smooth finish, and permanent integration into textile",
-                "silicone": "silicone application with soft, flexible texture, raised surface, and durable finish",
-                "patch": "patch application with raised edges, fabric backing, and sewn-on appearance",
-                "heat_transfer": "heat transfer with smooth application, vibrant colors, and professional finish",
-                "screen_print": "screen printed with thick ink, matte finish, and durable application",
-                "digital_print": "digitally printed with high resolution, smooth finish, and precise details",
-                "laser_engraving": "laser engraved with subtle texture, permanent marking, and professional appearance"
-            },
-            "leather": {
-                "embroidery": "embroidered with raised thread texture, realistic stitching details, and leather-appropriate integration",
-                "printing": "printed with smooth, flat surface, crisp edges, and leather-appropriate ink absorption",
-                "woven": "woven into the leather with integrated texture, natural appearance, and seamless blending",
-                "embossed": "embossed with raised relief effect, realistic depth, and leather-appropriate texture",
-                "sublimation": "sublimated with vibrant colors, smooth finish, and permanent integration into leather",
-                "silicone": "silicone application with soft, flexible texture, raised surface, and durable finish",
-                "patch": "patch application with raised edges, fabric backing, and sewn-on appearance",
-                "heat_transfer": "heat transfer with smooth application, vibrant colors, and professional finish",
-                "screen_print": "screen printed with thick ink, matte finish, and durable application",
-                "digital_print": "digitally printed with high resolution, smooth finish, and precise details",
-                "laser_engraving": "laser engraved with subtle texture, permanent marking, and professional appearance"
-            }
-        }
-        
-        style_descriptions = {
-            "modern": "Modern clean lines, minimalist design, contemporary colors, sleek presentation with bright, clean lighting and sharp contrasts",
-            "luxury": "Premium materials, elegant presentation, sophisticated look, high-end appeal with dramatic lighting and rich textures",
-            "minimal": "Simple design, neutral colors, clean aesthetics, uncluttered presentation with soft, even lighting and subtle shadows",
-            "dynamic": "Energetic, vibrant design with bold colors, dynamic composition, action-oriented presentation with dramatic lighting and movement"
-        }
+        get_circuit_breaker().record_failure(error_type)
+        request["error_type"] = error_type
+        if not is_retryable(error_type) or attempt >= GEMINI_RETRY_ATTEMPTS:
+            raise error
         
-        # Получаем эффект для логотипа с детальной отладкой
-        material_dict = material_adaptations.get(product_type, material_adaptations["fabric"])
-        print(f"Material dict for '{product_type}': {list(material_dict.keys())}")
-        print(f"Looking for logo_application: '{logo_application}'")
+        delay = backoff_delay(attempt)
+        print(f"⚠️ Gemini: ошибка {error_type} (попытка {attempt}/{GEMINI_RETRY_ATTEMPTS}), "
+              f"повтор через {delay:.1f} с: {error}")
+        return delay
+    
+    def _image_content(self, image: ImageInput) -> Tuple[Image.Image, Any]:
+        """Изображение для анализа и часть запроса: готовые байты PreparedImage или сжатое PIL изображение"""
+        if isinstance(image, PreparedImage):
+            return image.image, types.Part.from_bytes(data=image.data, mime_type=image.mime_type)
+        processed = self.compress_image(image)
+        return processed, processed
+    
+    def _build_mockup_request(self, product_image: ImageInput, logo_image: ImageInput,
+                              mockup_style: str, logo_application: str, custom_prompt: str,
+                              product_color: str, product_angle: str, logo_position: str,
+                              logo_size: str, logo_color: str,
+                              pattern_image: Optional[ImageInput]) -> Dict:
+        """
+        Подготовка запроса генерации мокапа (общая для синхронного и асинхронного клиента)
         
-        if logo_application in material_dict:
-            logo_effect = material_dict[logo_application]
-            print(f"✅ Found logo_effect: '{logo_effect}'")
+        Returns:
+            Словарь с model, contents, config и метаданными для разбора ответа
+        """
+        # Подготовка изображений (подготовленные заранее передаются готовыми байтами)
+        processed_product, product_part = self._image_content(product_image)
+        _, logo_part = self._image_content(logo_image)
+        pattern_part = self._image_content(pattern_image)[1] if pattern_image else None
+        
+        # Определение типа продукта (для подготовленного изображения - один раз)
+        if isinstance(product_image, PreparedImage):
+            if product_image.product_type is None:
+                product_image.product_type = self.detect_product_type(processed_product)
+            product_type = product_image.product_type
         else:
-            # Если не найден, используем первый доступный (не embroidery)
-            available_methods = [k for k in material_dict.keys() if k != "embroidery"]
-            if available_methods:
-                fallback_method = available_methods[0]
-                logo_effect = material_dict[fallback_method]
-                print(f"⚠️ Logo application '{logo_application}' not found, using fallback: '{fallback_method}' -> '{logo_effect}'")
-            else:
-                logo_effect = material_dict["embroidery"]
-                print(f"⚠️ Only embroidery available, using: '{logo_effect}'")
-        
-        # Двухэтапный промпт: сначала товар, потом логотип
-        # Обработка опций "как на фото"
-        color_instruction = "keep the original color from the product image" if product_color == "как на фото" else f"make the product {product_color}"
-        angle_instruction = "keep the original angle from the product image" if product_angle == "как на фото" else f"photograph from {product_angle} angle"
-        logo_color_instruction = "keep the original color from the logo image" if logo_color == "как на фото" else f"make the logo {logo_color}"
-        
-        # Словари для перевода
-        position_translation = {
-            "центр": "center of the product",
-            "верхний левый угол": "top-left corner of the product",
-            "верхний правый угол": "top-right corner of the product", 
-            "нижний левый угол": "bottom-left corner of the product",
-            "нижний правый угол": "bottom-right corner of the product",
-            "левый бок": "left side of the product",
-            "правый бок": "right side of the product",
-            "верх": "top of the product",
-            "низ": "bottom of the product"
-        }
-        
-        size_translation = {
-            "очень маленький": "very small",
-            "маленький": "small",
-            "средний": "medium",
-            "большой": "large",
-            "очень большой": "very large"
-        }
+            product_type = self.detect_product_type(processed_product)
         
-        position_english = position_translation.get(logo_position, "center")
-        size_english = size_translation.get(logo_size, "medium")
+        # Промпт из предкомпилированных шаблонов (кэшируется по параметрам)
+        prompt = render_mockup_prompt(
+            product_type, logo_application, mockup_style, logo_position, logo_size,
+            product_color, product_angle, logo_color, custom_prompt, pattern_part is not None
+        )
         
-        prompt = f"""🚨 CRITICAL INSTRUCTION: DO NOT CHANGE THE PRODUCT TYPE! 🚨
-
-You must keep the EXACT SAME PRODUCT from the uploaded image. If it's a phone stand, keep it as a phone stand. If it's a car seat cover, keep it as a car seat cover. If it's a car organizer, keep it as a car organizer.
-
-TASK: Add logo to the existing product WITHOUT changing what the product is.
-
-PRODUCT PRESERVATION (MOST IMPORTANT):
-- Keep the EXACT product type from the uploaded image
-- Keep the same design, shape, and features
-- Only change: color (if specified), angle (if specified), and add logo
-- DO NOT transform the product into something else
-- REMOVE ALL EXISTING BRANDING, LOGOS, TEXT from the original product
-- Make the product clean and unbranded before adding the new logo
-
-STYLE AND APPEARANCE:
-- Style: {mockup_style} style with {style_descriptions.get(mockup_style, style_descriptions['modern'])}
-- Color: {color_instruction}
-- Photography: {angle_instruction}
-
-LOGO APPLICATION:
-Apply logo using {logo_application} method: {logo_effect}
-Logo position: {position_english}
-Logo size: {size_english}
-Logo color: {logo_color_instruction}
-Logo must follow product curves and texture naturally.
-
-{f"SPECIAL REQUIREMENTS: {custom_prompt}" if custom_prompt.strip() else ""}
-
-{f"PATTERN APPLICATION: Use the uploaded pattern image to create a repeating pattern across the product surface. The pattern should be seamlessly integrated with the product design." if processed_pattern else ""}
-
-FINAL REQUIREMENTS:
-- Keep the original product exactly as shown in the image
-- Only add the logo to the existing product
-- Professional studio lighting
-- Clean background
-- High quality image
-- Generate a SQUARE image with 1:1 aspect ratio
-
-Generate the mockup image."""
-        
-        # Отладочная информация
-        print(f"Mockup style: '{mockup_style}'")
-        print(f"Product color: '{product_color}'")
-        print(f"Product angle: '{product_angle}'")
-        print(f"Logo application: '{logo_application}'")
-        print(f"Logo position: '{logo_position}' -> '{position_english}'")
-        print(f"Logo size: '{logo_size}' -> '{size_english}'")
-        print(f"Logo color: '{logo_color}'")
-        print(f"Product type: '{product_type}'")
-        print(f"Logo effect: '{logo_effect}'")
-        print(f"Custom prompt: '{custom_prompt}'")
-        print(f"Custom prompt length: {len(custom_prompt.strip()) if custom_prompt else 0}")
-        if custom_prompt.strip():
-            print(f"Final prompt includes custom requirements: {custom_prompt}")
-        
-        # Выводим полный промпт для отладки
-        print("=" * 50)
-        print("ПОЛНЫЙ ПРОМПТ ДЛЯ GEMINI:")
-        print("=" * 50)
-        print(prompt)
-        print("=" * 50)
+        if GEMINI_DEBUG:
+            print(f"Mockup style: '{mockup_style}', product type: '{product_type}', "
+                  f"logo: '{logo_application}' / '{logo_position}' / '{logo_size}' / '{logo_color}'")
+            print("=" * 50)
+            print("ПОЛНЫЙ ПРОМПТ ДЛЯ GEMINI:")
+            print("=" * 50)
+            print(prompt)
+            print("=" * 50)
         
-        try:
-            # Используем новый API Gemini 2.5 Flash
-            contents = [prompt, processed_product, processed_logo]
-            if processed_pattern:
-                contents.append(processed_pattern)
-            
-            # Используем только стандартные параметры generation_config
-            generation_config = {
-                "candidate_count": 1,
-                "max_output_tokens": 8192,
-                "temperature": 0.7,
-            }
-            
-            response = self.client.models.generate_content(
-                model=GEMINI_MODEL,
-                contents=contents,
-                generation_config=generation_config,
-            )
-            
-            # Обработка ответа
-            mockups = []
-            has_images = False
-            text_response = ""
-            
-            # Выводим полный ответ для отладки
+        contents = [prompt, product_part, logo_part]
+        if pattern_part is not None:
+            contents.append(pattern_part)
+        
+        return {
+            "model": GEMINI_MODEL,
+            "api_kind": "mockup",
+            "contents": contents,
+            "config": types.GenerateContentConfig(
+                candidate_count=1,
+                max_output_tokens=8192,
+                temperature=0.7,
+            ),
+            "style": mockup_style,
+            "logo_application": logo_application,
+            "product_type": product_type
+        }
+    
+    def _parse_mockup_response(self, response, request: Dict) -> List[Dict]:
+        """Разбор ответа генерации мокапа: изображения или fallback с текстом"""
+        mockups = []
+        text_response = ""
+        
+        # Пустой ответ: запрос или результат заблокирован фильтрами безопасности
+        candidate = response.candidates[0] if response.candidates else None
+        if candidate is None or candidate.content is None or not candidate.content.parts:
+            prompt_feedback = getattr(response, "prompt_feedback", None)
+            reason = str(getattr(prompt_feedback, "block_reason", None) or getattr(candidate, "finish_reason", None))
+            is_blocked = any(marker in reason for marker in SAFETY_MARKERS)
+            return [{
+                "fallback_needed": True,
+                "error": f"Gemini не вернул результат ({reason})",
+                "error_type": "safety" if is_blocked else "empty_response",
+                **attempt_info(request)
+            }]
+        
+        # Выводим полный ответ для отладки
+        if GEMINI_DEBUG:
             print("=" * 50)
             print("ПОЛНЫЙ ОТВЕТ ОТ GEMINI:")
             print("=" * 50)
@@ -287,40 +409,131 @@ Generate the mockup image."""
                     else:
                         print(f"Неизвестный тип: {type(part)}")
             print("=" * 50)
-            
-            # Сначала собираем все части ответа
-            for part in response.candidates[0].content.parts:
-                if part.text is not None:
-                    text_response += part.text + " "
-                    print(f"Текстовый ответ от Gemini: {part.text}")
-                elif part.inline_data is not None:
-                    has_images = True
-                    # Декодируем изображение
-                    image_data = part.inline_data.data
-                    image = Image.open(io.BytesIO(image_data))
-                    
-                    mockup = {
-                        "image": image,
-                        "image_data": image_data,
-                        "style": mockup_style,
-                        "logo_application": logo_application,
-                        "product_type": product_type,
-                        "source": "gemini_2.5_flash",
-                        "text_response": text_response.strip() if text_response else None
-                    }
-                    mockups.append(mockup)
-            
-            # Если есть изображения - возвращаем их (даже если есть текст)
-            if mockups:
-                print(f"✅ Получено {len(mockups)} изображений от Gemini")
-                return mockups
-            
-            # Если нет изображений - fallback
-            return [{"fallback_needed": True, "text": text_response or "No images generated by Gemini"}]
-            
+        
+        # Сначала собираем все части ответа
+        for part in response.candidates[0].content.parts:
+            if part.text is not None:
+                text_response += part.text + " "
+                print(f"Текстовый ответ от Gemini: {part.text}")
+            elif part.inline_data is not None:
+                # Декодируем изображение
+                image_data = part.inline_data.data
+                image = Image.open(io.BytesIO(image_data))
+                
+                mockups.append({
+                    "image": image,
+                    "image_data": image_data,
+                    "style": request["style"],
+                    "logo_application": request["logo_application"],
+                    "product_type": request["product_type"],
+                    "source": "gemini_2.5_flash",
+                    "text_response": text_response.strip() if text_response else None,
+                    **attempt_info(request)
+                })
+        
+        # Если есть изображения - возвращаем их (даже если есть текст)
+        if mockups:
+            print(f"✅ Получено {len(mockups)} изображений от Gemini")
+            return mockups
+        
+        # Если нет изображений - fallback
+        return [{"fallback_needed": True, "text": text_response or "No images generated by Gemini",
+                 **attempt_info(request)}]
+    
+    def generate_mockup(self, product_image: ImageInput, logo_image: ImageInput, 
+                       mockup_style: str = "modern", logo_application: str = "embroidery", 
+                       custom_prompt: str = "", product_color: str = "белый", 
+                       product_angle: str = "спереди", logo_position: str = "центр",
+                       logo_size: str = "средний", logo_color: str = "как на фото",
+                       pattern_image: Optional[ImageInput] = None) -> List[Dict]:
+        """
+        Генерация мокапа с логотипом используя Gemini 2.5 Flash
+        
+        Args:
+            product_image: Изображение товара (исходное или PreparedImage)
+            logo_image: Логотип клиента (исходный или PreparedImage)
+            mockup_style: Стиль мокапа (modern, vintage, minimal, luxury)
+            logo_application: Тип нанесения логотипа
+            custom_prompt: Дополнительные требования к промпту
+            product_color: Цвет товара
+            product_angle: Ракурс товара
+            logo_position: Расположение логотипа
+            logo_size: Размер логотипа
+            logo_color: Цвет логотипа
+            pattern_image: Паттерн для использования (опционально)
+        
+        Returns:
+            Список сгенерированных мокапов
+        """
+        request = None
+        try:
+            request = self._build_mockup_request(
+                product_image, logo_image, mockup_style, logo_application, custom_prompt,
+                product_color, product_angle, logo_position, logo_size, logo_color, pattern_image
+            )
+            response = self._generate_content(request)
+            return self._parse_mockup_response(response, request)
+        
         except Exception as e:
             print(f"Ошибка генерации через Gemini 2.5 Flash: {e}")
-            return [{"fallback_needed": True, "error": str(e)}]
+            return [error_result(e, request)]
+    
+    def _build_files_request(self, prompt: str, files: List[Dict]) -> Dict:
+        """Подготовка запроса с файлами (изображения и PDF)"""
+        # Подготавливаем содержимое
+        contents = [prompt]
+        
+        # Добавляем файлы
+        for file_info in files:
+            if file_info['mime_type'].startswith('image/'):
+                # Для изображений
+                if hasattr(file_info['data'], 'read'):
+                    # Если это файловый объект
+                    image_data = file_info['data'].read()
+                else:
+                    # Если это bytes
+                    image_data = file_info['data']
+                
+                # Конвертируем в base64
+                image_b64 = base64.b64encode(image_data).decode('utf-8')
+                contents.append({
+                    "inline_data": {
+                        "mime_type": file_info['mime_type'],
+                        "data": image_b64
+                    }
+                })
+            elif file_info['mime_type'] == 'application/pdf':
+                # Для PDF файлов - сжимаем перед отправкой
+                if hasattr(file_info['data'], 'read'):
+                    pdf_data = file_info['data'].read()
+                else:
+                    pdf_data = file_info['data']
+                
+                # Сжимаем PDF для экономии токенов (если включено)
+                if PDF_COMPRESSION_ENABLED:
+                    from image_processor import ImageProcessor
+                    processor = ImageProcessor()
+                    compressed_pdf_data = processor.compress_pdf_for_api(pdf_data, max_size_mb=2.0)
+                else:
+                    compressed_pdf_data = pdf_data
+                
+                pdf_b64 = base64.b64encode(compressed_pdf_data).decode('utf-8')
+                contents.append({
+                    "inline_data": {
+                        "mime_type": file_info['mime_type'],
+                        "data": pdf_b64
+                    }
+                })
+        
+        return {
+            "model": GEMINI_ANALYSIS_MODEL,
+            "api_kind": "files_analysis",
+            "contents": contents,
+            "config": types.GenerateContentConfig(
+                temperature=0.7,
+                max_output_tokens=2048
+            )
+        }
     
     def generate_with_files(self, prompt: str, files: List[Dict]) -> str:
         """
@@ -334,70 +547,21 @@ Generate the mockup image."""
             str: Ответ от Gemini
         """
         try:
-            # Подготавливаем содержимое
-            contents = [prompt]
-            
-            # Добавляем файлы
-            for file_info in files:
-                if file_info['mime_type'].startswith('image/'):
-                    # Для изображений
-                    if hasattr(file_info['data'], 'read'):
-                        # Если это файловый объект
-                        image_data = file_info['data'].read()
-                    else:
-                        # Если это bytes
-                        image_data = file_info['data']
-                    
-                    # Конвертируем в base64
-                    image_b64 = base64.b64encode(image_data).decode('utf-8')
-                    contents.append({
-                        "inline_data": {
-                            "mime_type": file_info['mime_type'],
-                            "data": image_b64
-                        }
-                    })
-                elif file_info['mime_type'] == 'application/pdf':
-                    # Для PDF файлов - сжимаем перед отправкой
-                    if hasattr(file_info['data'], 'read'):
-                        pdf_data = file_info['data'].read()
-                    else:
-                        pdf_data = file_info['data']
-                    
-                    # Сжимаем PDF для экономии токенов (если включено)
-                    if PDF_COMPRESSION_ENABLED:
-                        from image_processor import ImageProcessor
-                        processor = ImageProcessor()
-                        compressed_pdf_data = processor.compress_pdf_for_api(pdf_data, max_size_mb=2.0)
-                    else:
-                        compressed_pdf_data = pdf_data
-                    
-                    pdf_b64 = base64.b64encode(compressed_pdf_data).decode('utf-8')
-                    contents.append({
-                        "inline_data": {
-                            "mime_type": file_info['mime_type'],
-                            "data": pdf_b64
-                        }
-                    })
-            
-            # Отправляем запрос
-            response = self.client.models.generate_content(
-                model=GEMINI_ANALYSIS_MODEL,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    temperature=0.7,
-                    max_output_tokens=2048
-                )
-            )
-            
+            request = self._build_files_request(prompt, files)
+            response = self._generate_content(request)
             return response.text
-            
+        
         except Exception as e:
             print(f"❌ Ошибка генерации с файлами: {e}")
             return ""
-
-    def generate_mockup_with_analysis(self, product_image: Image.Image, logo_image: Image.Image, 
+    
+    def _analysis_to_mockup_args(self, analysis_recommendations: Dict, custom_prompt: str) -> Dict:
+        """Параметры generate_mockup из рекомендаций анализа коллекции"""
+        return analysis_to_mockup_args(analysis_recommendations, custom_prompt)
+    
+    def generate_mockup_with_analysis(self, product_image: ImageInput, logo_image: ImageInput, 
                                     analysis_recommendations: Dict, custom_prompt: str = "", 
-                                    pattern_image: Optional[Image.Image] = None) -> List[Dict]:
+                                    pattern_image: Optional[ImageInput] = None) -> List[Dict]:
         """
         Генерация мокапа с рекомендациями из анализа коллекции
         
@@ -412,24 +576,10 @@ Generate the mockup image."""
             Список с результатами генерации
         """
         
-        # Извлекаем рекомендации из анализа
-        mockup_style = analysis_recommendations.get("style", "modern")
-        logo_application = analysis_recommendations.get("logo_application", "embroidery")
-        logo_position = analysis_recommendations.get("logo_position", "центр")
-        logo_size = analysis_recommendations.get("logo_size", "средний")
-        logo_color = analysis_recommendations.get("logo_color", "как на фото")
-        product_color = analysis_recommendations.get("product_color", "как на фото")
-        product_angle = analysis_recommendations.get("product_angle", "как на фото")
-        
-        # Объединяем custom_prompt с рекомендациями
-        analysis_custom = analysis_recommendations.get("custom_prompt", "")
-        combined_custom = f"{analysis_custom} {custom_prompt}".strip()
-        
         # Используем основной метод генерации с рекомендациями
         return self.generate_mockup(
-            product_image, logo_image, mockup_style, logo_application, 
-            combined_custom, product_color, product_angle, logo_position, 
-            logo_size, logo_color, pattern_image
+            product_image, logo_image, pattern_image=pattern_image,
+            **self._analysis_to_mockup_args(analysis_recommendations, custom_prompt)
         )
     
     def _parse_response(self, response) -> List[Dict]:
@@ -459,6 +609,109 @@ Generate the mockup image."""
             print(f"Ошибка парсинга ответа: {e}")
             return [{"fallback_needed": True, "error": str(e)}]
     
+    def _jpeg_inline_part(self, image: Image.Image) -> Dict:
+        """Изображение как inline_data JPEG (RGBA - на белом фоне)"""
+        buffer = io.BytesIO()
+        
+        # Убеждаемся, что изображение в RGB режиме для JPEG
+        if image.mode == 'RGBA':
+            # Создаем белый фон для RGBA изображений
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        
+        image.save(buffer, format='JPEG', quality=COMPRESSION_QUALITY)
+        return {
+            "inline_data": {
+                "mime_type": "image/jpeg",
+                "data": base64.b64encode(buffer.getvalue()).decode()
+            }
+        }
+    
+    def _build_collection_request(self, product_images: List[Image.Image],
+                                  logo_image: Image.Image, collection_prompt: str) -> Dict:
+        """Подготовка запроса анализа коллекции: промпт, логотип, товары"""
+        # Подготовка изображений
+        compressed_products = [self.compress_image(img) for img in product_images]
+        compressed_logo = self.compress_image(logo_image)
+        
+        # Создание контента для запроса согласно новой документации
+        parts = [collection_prompt, self._jpeg_inline_part(compressed_logo)]
+        parts.extend(self._jpeg_inline_part(img) for img in compressed_products)
+        
+        print(f"Отправляем запрос на анализ коллекции...")
+        print(f"Количество частей контента: {len(parts)}")
+        print(f"1. Текст промпта: {len(collection_prompt)} символов")
+        print(f"2-{len(parts)}. Логотип и товары: {len(compressed_products)} изображений товаров")
+        
+        return {
+            "model": GEMINI_ANALYSIS_MODEL,
+            "api_kind": "collection_analysis",
+            "contents": parts,
+            "config": types.GenerateContentConfig(
+                temperature=0.7,
+                max_output_tokens=2048,
+                response_mime_type="application/json",
+                response_schema=COLLECTION_ANALYSIS_SCHEMA
+            )
+        }
+    
+    def _build_collection_text_request(self, collection_prompt: str) -> Dict:
+        """Подготовка текстового запроса анализа коллекции (без изображений)"""
+        print("Отправляем текстовый запрос на анализ коллекции...")
+        return {
+            "model": GEMINI_ANALYSIS_MODEL,
+            "api_kind": "collection_analysis",
+            "contents": collection_prompt,
+            "config": types.GenerateContentConfig(
+                temperature=0.7,
+                max_output_tokens=2048,
+                response_mime_type="application/json",
+                response_schema=COLLECTION_ANALYSIS_SCHEMA
+            )
+        }
+    
+    def _parse_collection_response(self, response) -> Optional[Dict]:
+        """Разбор JSON ответа анализа коллекции (с восстановлением оборванного или неаккуратного JSON)"""
+        if not (response and response.text):
+            print("Нет текстового ответа от Gemini")
+            return None
+        
+        print(f"Получен ответ от Gemini: {response.text[:200]}...")
+        
+        try:
+            result = json.loads(response.text)
+            repaired = False
+        except json.JSONDecodeError:
+            result = repair_json(response.text)
+            repaired = True
+        if isinstance(result, list):
+            # Модель вернула сам массив промптов
+            result = {"individual_prompts": result}
+        if not isinstance(result, dict) or not isinstance(result.get("individual_prompts"), list):
+            print("Ошибка парсинга JSON: ответ не содержит individual_prompts")
+            print(f"Ответ от Gemini: {response.text}")
+            return None
+        
+        # Промпт без обязательных полей схемы отбрасывается; позиция остается пустой,
+        # чтобы промпты не сдвинулись относительно товаров
+        required = COLLECTION_ANALYSIS_SCHEMA["properties"]["individual_prompts"]["items"]["required"]
+        prompts = [item if isinstance(item, dict) and all(field in item for field in required) else {}
+                   for item in result["individual_prompts"]]
+        if not any(prompts):
+            print("Ошибка парсинга JSON: нет ни одного полного промпта")
+            return None
+        if not all(prompts):
+            print(f"⚠️ Отброшено неполных промптов: {prompts.count({})}")
+        
+        result["individual_prompts"] = prompts
+        # Восстановленный ответ пригоден для работы, но не для кэша
+        result["repaired"] = repaired
+        print(f"Успешно распарсен JSON с {len(prompts) - prompts.count({})} промптами")
+        return result
+    
     def analyze_collection(self, product_images: List[Image.Image], 
                           logo_image: Image.Image, 
                           collection_prompt: str) -> Optional[Dict]:
@@ -473,101 +726,11 @@ Generate the mockup image."""
         Returns:
             Словарь с индивидуальными промптами или None при ошибке
         """
-        
         try:
-            # Подготовка изображений
-            compressed_products = [self.compress_image(img) for img in product_images]
-            compressed_logo = self.compress_image(logo_image)
-            
-            # Создание контента для запроса согласно новой документации
-            parts = []
-            
-            # Добавляем промпт как текст
-            parts.append(collection_prompt)
-            
-            # Добавляем логотип с указанием типа
-            logo_buffer = io.BytesIO()
-            
-            # Убеждаемся, что логотип в RGB режиме для JPEG
-            if compressed_logo.mode == 'RGBA':
-                # Создаем белый фон для RGBA изображений
-                background = Image.new('RGB', compressed_logo.size, (255, 255, 255))
-                background.paste(compressed_logo, mask=compressed_logo.split()[-1])
-                compressed_logo = background
-            elif compressed_logo.mode != 'RGB':
-                compressed_logo = compressed_logo.convert('RGB')
-            
-            compressed_logo.save(logo_buffer, format='JPEG', quality=COMPRESSION_QUALITY)
-            logo_data = logo_buffer.getvalue()
-            parts.append({
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": base64.b64encode(logo_data).decode()
-                }
-            })
-            
-            # Добавляем изображения товаров с указанием типа
-            for i, product_img in enumerate(compressed_products):
-                product_buffer = io.BytesIO()
-                
-                # Убеждаемся, что изображение товара в RGB режиме для JPEG
-                if product_img.mode == 'RGBA':
-                    # Создаем белый фон для RGBA изображений
-                    background = Image.new('RGB', product_img.size, (255, 255, 255))
-                    background.paste(product_img, mask=product_img.split()[-1])
-                    product_img = background
-                elif product_img.mode != 'RGB':
-                    product_img = product_img.convert('RGB')
-                
-                product_img.save(product_buffer, format='JPEG', quality=COMPRESSION_QUALITY)
-                product_data = product_buffer.getvalue()
-                parts.append({
-                    "inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": base64.b64encode(product_data).decode()
-                    }
-                })
-            
-            # Отправка запроса согласно новой документации
-            print(f"Отправляем запрос на анализ коллекции...")
-            print(f"Количество частей контента: {len(parts)}")
-            print(f"1. Текст промпта: {len(collection_prompt)} символов")
-            print(f"2. Логотип: {len(logo_data)} байт")
-            print(f"3-{len(parts)}. Товары: {len(compressed_products)} изображений")
-            
-            response = self.client.models.generate_content(
-                model=GEMINI_ANALYSIS_MODEL,
-                contents=parts,
-                config=types.GenerateContentConfig(
-                    temperature=0.7,
-                    max_output_tokens=2048,
-                )
-            )
-            
-            if response and response.text:
-                print(f"Получен ответ от Gemini: {response.text[:200]}...")
-                
-                # Парсинг JSON ответа
-                try:
-                    # Извлекаем JSON из ответа
-                    response_text = response.text.strip()
-                    if response_text.startswith("```json"):
-                        response_text = response_text[7:]
-                    if response_text.endswith("```"):
-                        response_text = response_text[:-3]
-                    
-                    result = json.loads(response_text)
-                    print(f"Успешно распарсен JSON с {len(result.get('individual_prompts', []))} промптами")
-                    return result
-                    
-                except json.JSONDecodeError as e:
-                    print(f"Ошибка парсинга JSON: {e}")
-                    print(f"Ответ от Gemini: {response.text}")
-                    return None
-            else:
-                print("Нет текстового ответа от Gemini")
-                return None
-            
+            request = self._build_collection_request(product_images, logo_image, collection_prompt)
+            response = self._generate_content(request)
+            return self._parse_collection_response(response)
+        
         except Exception as e:
             print(f"Ошибка анализа коллекции: {e}")
             return None
@@ -583,43 +746,172 @@ Generate the mockup image."""
         Returns:
             Словарь с индивидуальными промптами или None при ошибке
         """
-        
         try:
-            # Отправка запроса только с текстом согласно новой документации
-            print("Отправляем текстовый запрос на анализ коллекции...")
-            response = self.client.models.generate_content(
-                model=GEMINI_ANALYSIS_MODEL,
-                contents=collection_prompt,
-                config=types.GenerateContentConfig(
-                    temperature=0.7,
-                    max_output_tokens=2048,
-                )
-            )
+            request = self._build_collection_text_request(collection_prompt)
+            response = self._generate_content(request)
+            return self._parse_collection_response(response)
+        
+        except Exception as e:
+            print(f"Ошибка текстового анализа коллекции: {e}")
+            return None
+
+class AsyncGeminiClient(GeminiClient):
+    """
+    Асинхронный клиент Gemini (client.aio)
+    
+    Те же методы, что у GeminiClient, но корутины: подготовка запросов и
+    разбор ответов общие, отличается только вызов API. Позволяет держать
+    много запросов в полете в одном цикле событий (см. run_async).
+    """
+    
+    async def _generate_content_async(self, request: Dict):
+        """Единая точка асинхронного вызова Gemini API (лимитер, повторы, предохранитель)"""
+        started = time.time()
+        for attempt in range(1, GEMINI_RETRY_ATTEMPTS + 1):
+            estimated_tokens = self._begin_attempt(request, attempt)
+            await get_rate_limiter().acquire_async(estimated_tokens)
             
-            if response and response.text:
-                print(f"Получен текстовый ответ от Gemini: {response.text[:200]}...")
-                
-                # Парсинг JSON ответа
-                try:
-                    # Извлекаем JSON из ответа
-                    response_text = response.text.strip()
-                    if response_text.startswith("```json"):
-                        response_text = response_text[7:]
-                    if response_text.endswith("```"):
-                        response_text = response_text[:-3]
-                    
-                    result = json.loads(response_text)
-                    print(f"Успешно распарсен JSON с {len(result.get('individual_prompts', []))} промптами")
-                    return result
-                    
-                except json.JSONDecodeError as e:
-                    print(f"Ошибка парсинга JSON: {e}")
-                    print(f"Ответ от Gemini: {response.text}")
-                    return None
-            else:
-                print("Нет текстового ответа от Gemini")
-                return None
+            response = None
+            error = None
+            try:
+                response = await self.client.aio.models.generate_content(
+                    model=request["model"], contents=request["contents"], config=request["config"]
+                )
+            except Exception as e:
+                error = e
+            except BaseException:
+                # Отмена задачи - возвращаем слот лимитера
+                get_rate_limiter().release(estimated_tokens)
+                raise
             
+            delay = self._finish_attempt(request, attempt, started, estimated_tokens, response, error)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+    
+    async def generate_mockup(self, product_image: ImageInput, logo_image: ImageInput,
+                              mockup_style: str = "modern", logo_application: str = "embroidery",
+                              custom_prompt: str = "", product_color: str = "белый",
+                              product_angle: str = "спереди", logo_position: str = "центр",
+                              logo_size: str = "средний", logo_color: str = "как на фото",
+                              pattern_image: Optional[ImageInput] = None) -> List[Dict]:
+        """Асинхронная генерация мокапа (см. GeminiClient.generate_mockup)"""
+        request = None
+        try:
+            request = self._build_mockup_request(
+                product_image, logo_image, mockup_style, logo_application, custom_prompt,
+                product_color, product_angle, logo_position, logo_size, logo_color, pattern_image
+            )
+            response = await self._generate_content_async(request)
+            return self._parse_mockup_response(response, request)
+        
+        except Exception as e:
+            print(f"Ошибка генерации через Gemini 2.5 Flash: {e}")
+            return [error_result(e, request)]
+    
+    async def generate_with_files(self, prompt: str, files: List[Dict]) -> str:
+        """Асинхронная генерация текста с файлами (см. GeminiClient.generate_with_files)"""
+        try:
+            request = self._build_files_request(prompt, files)
+            response = await self._generate_content_async(request)
+            return response.text
+        
+        except Exception as e:
+            print(f"❌ Ошибка генерации с файлами: {e}")
+            return ""
+    
+    async def generate_mockup_with_analysis(self, product_image: ImageInput, logo_image: ImageInput,
+                                            analysis_recommendations: Dict, custom_prompt: str = "",
+                                            pattern_image: Optional[ImageInput] = None) -> List[Dict]:
+        """Асинхронная генерация мокапа с рекомендациями анализа коллекции"""
+        return await self.generate_mockup(
+            product_image, logo_image, pattern_image=pattern_image,
+            **self._analysis_to_mockup_args(analysis_recommendations, custom_prompt)
+        )
+    
+    async def analyze_collection(self, product_images: List[Image.Image],
+                                 logo_image: Image.Image,
+                                 collection_prompt: str) -> Optional[Dict]:
+        """Асинхронный анализ коллекции (см. GeminiClient.analyze_collection)"""
+        try:
+            request = self._build_collection_request(product_images, logo_image, collection_prompt)
+            response = await self._generate_content_async(request)
+            return self._parse_collection_response(response)
+        
+        except Exception as e:
+            print(f"Ошибка анализа коллекции: {e}")
+            return None
+    
+    async def analyze_collection_text_only(self, num_products: int,
+                                           collection_prompt: str) -> Optional[Dict]:
+        """Асинхронный текстовый анализ коллекции (см. GeminiClient.analyze_collection_text_only)"""
+        try:
+            request = self._build_collection_text_request(collection_prompt)
+            response = await self._generate_content_async(request)
+            return self._parse_collection_response(response)
+        
         except Exception as e:
             print(f"Ошибка текстового анализа коллекции: {e}")
-            return None
\ No newline at end of file
+            return None
+
+# Общие экземпляры клиентов процесса (см. get_gemini_client)
+_gemini_clients = {}
+_gemini_clients_lock = threading.Lock()
+
+def _shared_client(client_class: type) -> GeminiClient:
+    """Экземпляр клиента указанного класса, общий для процесса"""
+    with _gemini_clients_lock:
+        if client_class not in _gemini_clients:
+            _gemini_clients[client_class] = client_class()
+        return _gemini_clients[client_class]
+
+def get_gemini_client() -> GeminiClient:
+    """Синхронный клиент Gemini процесса (создается при первом вызове)"""
+    return _shared_client(GeminiClient)
+
+def get_async_gemini_client() -> AsyncGeminiClient:
+    """Асинхронный клиент Gemini процесса (создается при первом вызове)"""
+    return _shared_client(AsyncGeminiClient)
+
+# Общий фоновый цикл событий процесса: асинхронный клиент и его соединения
+# привязаны к одному циклу, поэтому все корутины выполняются в нем
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Фоновый цикл событий для асинхронных запросов (создается при первом вызове)"""
+    global _event_loop
+    
+    with _event_loop_lock:
+        if _event_loop is None or _event_loop.is_closed():
+            _event_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_event_loop.run_forever,
+                                      name="gemini-event-loop", daemon=True)
+            thread.start()
+        return _event_loop
+
+def submit_async(coro: Awaitable) -> concurrent.futures.Future:
+    """Запуск корутины в общем цикле событий без ожидания результата"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+def run_async(coro: Awaitable, timeout: Optional[float] = None) -> Any:
+    """
+    Выполнение корутины в общем цикле событий из синхронного кода
+    (скрипт Streamlit, пакетная обработка)
+    """
+    loop = get_event_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        raise RuntimeError("run_async нельзя вызывать внутри общего цикла событий - используйте await")
+    
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+def run_async_all(coros: List[Awaitable], timeout: Optional[float] = None) -> List[Any]:
+    """Параллельное выполнение нескольких корутин в общем цикле событий (результаты по порядку)"""
+    async def gather_all():
+        return await asyncio.gather(*coros)
+    
+    return run_async(gather_all(), timeout)
@@ -5,11 +5,64 @@
 import os
 import hashlib
 import io
+import threading
+from collections import OrderedDict
 from PIL import Image, ImageOps, ImageFilter, ImageDraw
 import cv2
 import numpy as np
 from typing import Tuple, Optional, List
-from config import MAX_IMAGE_SIZE, LOGO_MAX_SIZE, UPLOAD_DIR, STANDARD_MOCKUP_SIZE, STANDARD_PREVIEW_SIZE
+from config import (MAX_IMAGE_SIZE, LOGO_MAX_SIZE, UPLOAD_DIR, STANDARD_MOCKUP_SIZE, STANDARD_PREVIEW_SIZE,
+                    PREPARED_IMAGE_CACHE_SIZE)
+
+def compute_image_hash(image: Image.Image) -> str:
+    """
+    Хеш содержимого изображения для кэширования
+    
+    Хешируются режим, размер и сырые пиксели (BLAKE2) без перекодирования в JPEG.
+    Результат запоминается на самом объекте изображения, поэтому загруженное
+    изображение хешируется один раз за сессию; при изменении размера или
+    режима хеш пересчитывается. Изменение пикселей на месте (paste, thumbnail,
+    ImageDraw) размер может не менять - после него нужен invalidate_image_hash.
+    """
+    signature = (image.mode, image.size)
+    memo = getattr(image, "_content_hash", None)
+    if memo is not None and memo[0] == signature:
+        return memo[1]
+    
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    image_hash = digest.hexdigest()
+    
+    image._content_hash = (signature, image_hash)
+    return image_hash
+
+def invalidate_image_hash(image: Image.Image):
+    """Сброс запомненных хешей изображения (содержимого и перцептивного) после изменения на месте"""
+    for attr in ("_content_hash", "_perceptual_hash"):
+        if hasattr(image, attr):
+            delattr(image, attr)
+
+class PreparedImage:
+    """
+    Изображение, подготовленное для запроса к API
+    
+    Оптимизированная копия (для анализа на стороне клиента) и готовые байты
+    PNG - те же, что SDK получил бы, сериализуя эту копию.
+    """
+    
+    def __init__(self, content_hash: str, image: Image.Image, data: bytes, mime_type: str = "image/png"):
+        self.content_hash = content_hash
+        self.image = image
+        self.data = data
+        self.mime_type = mime_type
+        self.product_type = None  # Тип материала (определяется клиентом Gemini один раз)
+
+# Подготовленные изображения процесса: (хеш исходника, целевой размер) -> PreparedImage.
+# Общие для всех экземпляров ImageProcessor: логотип пакета и повторные генерации
+# используют уже закодированные байты
+_prepared_images: "OrderedDict[Tuple[str, Tuple[int, int]], PreparedImage]" = OrderedDict()
+_prepared_images_lock = threading.Lock()
 
 class ImageProcessor:
     def __init__(self):
@@ -69,9 +122,12 @@ class ImageProcessor:
     
     def optimize_for_api(self, image: Image.Image, target_size: Tuple[int, int] = MAX_IMAGE_SIZE) -> Image.Image:
         """Оптимизация изображения для отправки в API"""
-        # Конвертация в RGB если нужно
+        # Конвертация в RGB если нужно (копия - исходное изображение не меняем,
+        # иначе его хеш и ключ кэша изменятся после первой генерации)
         if image.mode != 'RGB':
             image = image.convert('RGB')
+        else:
+            image = image.copy()
         
         # Ресайз с сохранением пропорций
         image.thumbnail(target_size, Image.LANCZOS)
@@ -81,6 +137,32 @@ class ImageProcessor:
         
         return image
     
+    def prepare_for_api(self, image: Image.Image, target_size: Tuple[int, int] = MAX_IMAGE_SIZE) -> PreparedImage:
+        """
+        Оптимизация и кодирование изображения для API один раз на содержимое
+        
+        Результат кэшируется по хешу исходного изображения, поэтому один и тот
+        же логотип/паттерн/товар не обрабатывается заново для каждого товара
+        пакета и каждой повторной генерации.
+        """
+        key = (compute_image_hash(image), tuple(target_size))
+        with _prepared_images_lock:
+            prepared = _prepared_images.get(key)
+            if prepared is not None:
+                _prepared_images.move_to_end(key)
+                return prepared
+        
+        optimized = self.optimize_for_api(image, target_size)
+        buffer = io.BytesIO()
+        optimized.save(buffer, format="PNG")
+        prepared = PreparedImage(key[0], optimized, buffer.getvalue())
+        
+        with _prepared_images_lock:
+            _prepared_images[key] = prepared
+            while len(_prepared_images) > PREPARED_IMAGE_CACHE_SIZE:
+                _prepared_images.popitem(last=False)
+        return prepared
+    
     def extract_logo_region(self, image: Image.Image) -> Optional[Image.Image]:
         """Автоматическое извлечение логотипа из изображения"""
         try:
@@ -125,12 +207,7 @@ class ImageProcessor:
     
     def generate_image_hash(self, image: Image.Image) -> str:
         """Генерация хеша изображения для кэширования"""
-        # Конвертация в байты для хеширования
-        buffer = io.BytesIO()
-        image.save(buffer, format='JPEG', quality=95)
-        image_bytes = buffer.getvalue()
-        
-        return hashlib.md5(image_bytes).hexdigest()
+        return compute_image_hash(image)
     
     def batch_process_images(self, images: List[Image.Image]) -> List[Image.Image]:
         """Батчевая обработка изображений"""
@@ -222,6 +299,8 @@ class ImageProcessor:
             mockup.paste(logo, (x, y), mask)
         else:
             mockup.paste(logo, (x, y))
+        # Мокап изменен на месте - запомненный хеш больше не соответствует пикселям
+        invalidate_image_hash(mockup)
         
         # Добавляем эффекты для более реалистичной интеграции
         mockup = self.add_realistic_integration_effects(mockup, x, y, logo.width, logo.height)
@@ -338,6 +417,7 @@ class ImageProcessor:
         
         # Изменяем размер с сохранением пропорций
         image.thumbnail(max_size, Image.LANCZOS)
+        invalidate_image_hash(image)
         
         # Сохраняем в байты с сжатием
         buffer = io.BytesIO()
@@ -8,13 +8,17 @@ import json
 from datetime import datetime, timedelta
 from PIL import Image
 import time
+import uuid
 from typing import Optional
 
 # Импортируем конфигурацию после инициализации Streamlit
-from config import get_config, STREAMLIT_PORT, STREAMLIT_HOST, SERVER_STORAGE_ENABLED, FTP_ENABLED
+from config import get_config, STREAMLIT_PORT, STREAMLIT_HOST, SERVER_STORAGE_ENABLED, FTP_ENABLED, BRAND_CACHE_TTL_HOURS
 from auth import is_authenticated, login_form, logout_button, require_auth, get_user_info
 from mockup_generator import MockupGenerator
 from batch_processor import BatchProcessor
+from cache_manager import CacheManager
+from gemini_client import run_async_all
+from usage_ledger import set_usage_context
 
 # Получаем актуальную конфигурацию
 config = get_config()
@@ -136,6 +140,10 @@ def get_mockup_generator():
 def get_batch_processor():
     return BatchProcessor()
 
+@st.cache_resource
+def get_cache_manager():
+    return CacheManager()
+
 # Очистка кэша для обновления BatchProcessor
 def clear_batch_processor_cache():
     get_batch_processor.clear()
@@ -148,6 +156,11 @@ def main():
         login_form()
         return
     
+    # Вызовы Gemini этой сессии учитываются в журнале использования отдельно
+    if "usage_session_id" not in st.session_state:
+        st.session_state.usage_session_id = uuid.uuid4().hex[:12]
+    set_usage_context(session=st.session_state.usage_session_id)
+    
     # Обработка перегенерации
     if "regenerate_params" in st.session_state:
         regenerate_params = st.session_state.regenerate_params
@@ -242,8 +255,8 @@ def single_generation_interface():
                 logo_size = original_result.get("logo_size", "средний")
                 logo_color = original_result.get("logo_color", "как на фото")
                 
-                # Генерируем новый мокап с теми же параметрами
-                new_result = generator.generate_mockup(
+                # Новый вариант с теми же параметрами (из пула вариантов или новым запросом)
+                new_result = generator.regenerate_mockup(
                     st.session_state.product_image, st.session_state.logo_image,
                     mockup_style, logo_application, custom_prompt, product_color,
                     product_angle, logo_position, logo_size, logo_color
@@ -848,7 +861,6 @@ def regenerate_mockup_dynamically(mockup_index: int, original_mockup: dict, orig
             # Обновляем статус
             status_text.text("🔄 Подключение к Gemini...")
             progress_bar.progress(20)
-            time.sleep(0.5)
             
             # Получаем генератор
             generator = get_mockup_generator()
@@ -866,10 +878,9 @@ def regenerate_mockup_dynamically(mockup_index: int, original_mockup: dict, orig
             # Обновляем статус
             status_text.text("🎨 Генерация нового мокапа...")
             progress_bar.progress(50)
-            time.sleep(0.5)
             
-            # Генерируем новый мокап с теми же параметрами
-            new_result = generator.generate_mockup(
+            # Новый вариант с теми же параметрами (из пула вариантов или новым запросом)
+            new_result = generator.regenerate_mockup(
                 st.session_state.product_image, st.session_state.logo_image,
                 mockup_style, logo_application, custom_prompt, product_color,
                 product_angle, logo_position, logo_size, logo_color
@@ -878,7 +889,6 @@ def regenerate_mockup_dynamically(mockup_index: int, original_mockup: dict, orig
             # Обновляем статус
             status_text.text("✅ Обработка результата...")
             progress_bar.progress(80)
-            time.sleep(0.5)
             
             # Заменяем только выбранный мокап в оригинальном результате
             if new_result and "mockups" in new_result and "gemini_mockups" in new_result["mockups"]:
@@ -902,9 +912,8 @@ def regenerate_mockup_dynamically(mockup_index: int, original_mockup: dict, orig
                     st.session_state.last_generation_result = original_result
                     
                     # Обновляем статус
-                    status_text.text("🎉 Мокап успешно пересоздан!")
+                    status_text.text(f"🎉 Мокап успешно пересоздан! Готовых вариантов: {new_result.get('variants_left', 0)}")
                     progress_bar.progress(100)
-                    time.sleep(1)
                     
                     # Очищаем прогресс-бар и статус
                     progress_bar.empty()
@@ -1129,13 +1138,10 @@ def creative_generation_interface():
 def search_brand_info_online(logo_image):
     """Ищет информацию о бренде в интернете на основе логотипа"""
     try:
-        # Конвертируем логотип в base64 для отправки в Gemini
         import io
         import base64
-        
-        logo_buffer = io.BytesIO()
-        logo_image.save(logo_buffer, format='JPEG', quality=95)
-        logo_base64 = base64.b64encode(logo_buffer.getvalue()).decode()
+        import hashlib
+        from image_processor import compute_image_hash
         
         # Создаем промпт для анализа логотипа
         logo_analysis_prompt = """
@@ -1152,9 +1158,25 @@ def search_brand_info_online(logo_image):
         Ответь структурированно, чтобы эту информацию можно было использовать для создания концепций товара.
         """
         
+        # Профиль бренда кэшируется по содержимому логотипа
+        cache_manager = get_cache_manager()
+        cache_key = cache_manager.generate_cache_key(
+            compute_image_hash(logo_image), "", "brand_profile",
+            {"prompt_hash": hashlib.md5(logo_analysis_prompt.encode()).hexdigest()}
+        )
+        cached_result = cache_manager.get_cached_result(cache_key)
+        if cached_result and cached_result["result"].get("brand_analysis"):
+            print("Использован кэшированный анализ бренда")
+            return cached_result["result"]["brand_analysis"]
+        
+        # Конвертируем логотип в base64 для отправки в Gemini
+        logo_buffer = io.BytesIO()
+        logo_image.save(logo_buffer, format='JPEG', quality=95)
+        logo_base64 = base64.b64encode(logo_buffer.getvalue()).decode()
+        
         # Отправляем в Gemini для анализа
-        from gemini_client import GeminiClient
-        gemini_client = GeminiClient()
+        from gemini_client import get_gemini_client
+        gemini_client = get_gemini_client()
         
         # Создаем файл для анализа
         files_for_analysis = [{
@@ -1166,6 +1188,10 @@ def search_brand_info_online(logo_image):
         brand_analysis = gemini_client.generate_with_files(logo_analysis_prompt, files_for_analysis)
         
         if brand_analysis:
+            cache_manager.save_to_cache(
+                cache_key, {"brand_analysis": brand_analysis}, ttl_hours=BRAND_CACHE_TTL_HOURS,
+                api_kind="brand_analysis"
+            )
             return brand_analysis
         else:
             return None
@@ -1255,8 +1281,8 @@ def generate_creative_concepts_optimized(brandbook_files):
             })
         
         # Отправляем объединенный запрос
-        from gemini_client import GeminiClient
-        gemini_client = GeminiClient()
+        from gemini_client import get_gemini_client
+        gemini_client = get_gemini_client()
         
         concepts_response = gemini_client.generate_with_files(unified_prompt, files_to_analyze)
         
@@ -1281,18 +1307,16 @@ def generate_creative_concepts_optimized(brandbook_files):
         # Генерируем мокапы для каждой концепции
         st.info(f"Создаем {len(concepts)} концепций...")
         
-        generated_concepts = []
         for i, concept in enumerate(concepts):
             st.write(f"🎨 Концепция {i+1}: {concept}")
-            
-            # Используем первое изображение товара для генерации мокапа
-            main_product_image = product_images[0]
-            
-            # Генерируем мокап
-            from mockup_generator import get_mockup_generator
-            generator = get_mockup_generator()
-            
-            result = generator.generate_mockups(
+        
+        # Используем первое изображение товара для генерации мокапа
+        main_product_image = product_images[0]
+        generator = get_mockup_generator()
+        
+        # Генерируем мокапы всех концепций параллельно
+        results = run_async_all([
+            generator.generate_mockups_async(
                 product_image=main_product_image,
                 logo_image=logo_image,
                 style="modern",
@@ -1303,8 +1327,11 @@ def generate_creative_concepts_optimized(brandbook_files):
                 logo_position="центр",
                 logo_size="средний",
                 logo_color="как на фото"
-            )
-            
+            ) for concept in concepts
+        ])
+        
+        generated_concepts = []
+        for i, (concept, result) in enumerate(zip(concepts, results)):
             if result["status"] == "success" and result["mockups"]["gemini_mockups"]:
                 mockup = result["mockups"]["gemini_mockups"][0]
                 generated_concepts.append({
@@ -1490,8 +1517,8 @@ def generate_creative_concepts(brandbook_files):
         """
         
         # Отправляем в анализатор
-        from gemini_client import GeminiClient
-        gemini_client = GeminiClient()
+        from gemini_client import get_gemini_client
+        gemini_client = get_gemini_client()
         
         # Конвертируем все изображения товара в bytes для анализа
         import io
@@ -1637,13 +1664,8 @@ def generate_creative_concepts(brandbook_files):
         from mockup_generator import MockupGenerator
         generator = MockupGenerator()
         
-        # Генерируем изображения
-        generated_concepts = []
-        for i, concept in enumerate(concepts[:5], 1):
-            st.info(f"Генерируем концепцию {i}...")
-            
-            # Создаем промпт для генерации
-            generation_prompt = f"""
+        # Создаем промпты для генерации
+        generation_prompts = [f"""
             {concept}
             
             Создай реалистичный мокап товара с этой концепцией.
@@ -1651,13 +1673,15 @@ def generate_creative_concepts(brandbook_files):
             Сгенерируй КВАДРАТНОЕ изображение с пропорцией 1:1.
             
             {custom_prompt}
-            """
-            
-            # Используем первое изображение товара для генерации мокапа
-            main_product_image = product_images[0]
-            
-            # Генерируем мокап
-            result = generator.generate_mockups(
+            """ for concept in concepts[:5]]
+        
+        # Используем первое изображение товара для генерации мокапа
+        main_product_image = product_images[0]
+        
+        # Генерируем мокапы всех концепций параллельно
+        st.info(f"Генерируем {len(generation_prompts)} концепций...")
+        results = run_async_all([
+            generator.generate_mockups_async(
                 product_image=main_product_image,
                 logo_image=logo_image,
                 style="modern",
@@ -1668,8 +1692,12 @@ def generate_creative_concepts(brandbook_files):
                 logo_position="центр",
                 logo_size="средний",
                 logo_color="как на фото"
-            )
-            
+            ) for generation_prompt in generation_prompts
+        ])
+        
+        # Обрабатываем результаты
+        generated_concepts = []
+        for i, (concept, result) in enumerate(zip(concepts[:5], results), 1):
             if result and "mockups" in result and "gemini_mockups" in result["mockups"]:
                 mockups = result["mockups"]["gemini_mockups"]
                 if mockups:
@@ -1850,8 +1878,11 @@ def batch_processing_interface():
                 
                 # Генерируем новый мокап с теми же параметрами
                 pattern_image = st.session_state.get("batch_pattern_image", None)
+                # Подготовленные изображения берутся из кэша процесса (без повторного сжатия)
+                prepare = generator.image_processor.prepare_for_api
                 new_result = generator.gemini_client.generate_mockup_with_analysis(
-                    original_image, st.session_state.batch_logo_image, prompt_data, "", pattern_image
+                    prepare(original_image), prepare(st.session_state.batch_logo_image), prompt_data, "",
+                    prepare(pattern_image) if pattern_image else None
                 )
                 
                 if new_result and len(new_result) > 0:
@@ -2128,6 +2159,16 @@ def batch_processing_interface():
                                 
                                 prompt_data["custom_prompt"] = extended_prompt
                             
+                            # Оценка стоимости до запуска; вызовы коллекции отмечаются в журнале использования
+                            batch_estimate = batch_processor.estimate_batch_cost(
+                                st.session_state.batch_product_images, st.session_state.batch_logo_image,
+                                analysis_result["individual_prompts"],
+                                st.session_state.get("batch_pattern_image", None), skip_cached=False
+                            )
+                            st.caption(f"💰 Оценка: ~${batch_estimate['cost_usd']:.2f} "
+                                       f"(~{batch_estimate['total_tokens']} токенов, {batch_estimate['items']} генераций)")
+                            set_usage_context(collection=f"collection_{int(time.time())}")
+                            
                             # Обрабатываем каждый товар с обновлением прогресса
                             total_items = len(st.session_state.batch_product_images)
                             results = []
@@ -2145,8 +2186,10 @@ def batch_processing_interface():
                                 try:
                                     generator = get_mockup_generator()
                                     pattern_image = st.session_state.get("batch_pattern_image", None)
+                                    prepare = generator.image_processor.prepare_for_api
                                     mockup_result = generator.gemini_client.generate_mockup_with_analysis(
-                                        product_img, st.session_state.batch_logo_image, prompt_data, "", pattern_image
+                                        prepare(product_img), prepare(st.session_state.batch_logo_image),
+                                        prompt_data, "", prepare(pattern_image) if pattern_image else None
                                     )
                                     
                                     if mockup_result and len(mockup_result) > 0:
@@ -2232,6 +2275,16 @@ def batch_processing_interface():
                                 
                                 prompt_data["custom_prompt"] = extended_prompt
                             
+                            # Оценка стоимости до запуска; вызовы коллекции отмечаются в журнале использования
+                            batch_estimate = batch_processor.estimate_batch_cost(
+                                st.session_state.batch_product_images, st.session_state.batch_logo_image,
+                                analysis_result["individual_prompts"],
+                                st.session_state.get("batch_pattern_image", None), skip_cached=False
+                            )
+                            st.caption(f"💰 Оценка: ~${batch_estimate['cost_usd']:.2f} "
+                                       f"(~{batch_estimate['total_tokens']} токенов, {batch_estimate['items']} генераций)")
+                            set_usage_context(collection=f"collection_{int(time.time())}")
+                            
                             # Обрабатываем каждый товар с обновлением прогресса
                             total_items = len(st.session_state.batch_product_images)
                             results = []
@@ -2249,8 +2302,10 @@ def batch_processing_interface():
                                 try:
                                     generator = get_mockup_generator()
                                     pattern_image = st.session_state.get("batch_pattern_image", None)
+                                    prepare = generator.image_processor.prepare_for_api
                                     mockup_result = generator.gemini_client.generate_mockup_with_analysis(
-                                        product_img, st.session_state.batch_logo_image, prompt_data, "", pattern_image
+                                        prepare(product_img), prepare(st.session_state.batch_logo_image),
+                                        prompt_data, "", prepare(pattern_image) if pattern_image else None
                                     )
                                     
                                     if mockup_result and len(mockup_result) > 0:
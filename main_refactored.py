@@ -15,7 +15,8 @@ from ui.single_generation import single_generation_interface
 from ui.batch_processing import batch_processing_interface
 from ui.image_upload import image_upload_interface, batch_image_upload_interface
 from ui.display_results import display_results
-from ui.gallery_stats import show_storage_info, get_all_mockups_data, show_gallery_statistics
+from usage_ledger import get_usage_summary, get_current_session
+from ui.gallery_stats import show_storage_info, get_all_mockups_data, show_gallery_statistics, show_cache_statistics, show_usage_statistics
 from services.upload_services import upload_to_server, upload_to_ftp, get_server_mockups, get_ftp_mockups
 
 # Импорты для генераторов
@@ -117,6 +118,23 @@ def main():
         
         st.markdown("---")
         
+        # Эффективность кэша
+        try:
+            show_cache_statistics(get_mockup_generator().get_generation_stats())
+        except Exception as e:
+            st.warning(f"⚠️ Статистика кэша недоступна: {e}")
+        
+        # Расход Gemini по журналу использования
+        try:
+            show_usage_statistics(
+                get_usage_summary("day"),
+                get_usage_summary("session").get(get_current_session())
+            )
+        except Exception as e:
+            st.warning(f"⚠️ Журнал использования недоступен: {e}")
+        
+        st.markdown("---")
+        
         # Статистика галереи
         all_mockups = get_all_mockups_data()
         if all_mockups:
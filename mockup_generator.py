@@ -4,20 +4,58 @@
 """
 import os
 import time
+import uuid
+import asyncio
+import concurrent.futures
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Optional, Tuple
 from PIL import Image
 import io
 import base64
 
-from gemini_client import GeminiClient
+from gemini_client import get_gemini_client, get_async_gemini_client, run_async
 from image_processor import ImageProcessor
-from cache_manager import CacheManager
-from config import OUTPUT_DIR, BATCH_SIZE
+from cache_manager import CacheManager, compute_perceptual_hash
+from retry_policy import classify_error, is_cacheable_failure
+from config import (OUTPUT_DIR, BATCH_SIZE, CACHE_LEASE_WAIT_SECONDS, REGENERATE_CANDIDATES,
+                    REGENERATE_POOL_MAX_RESULTS)
+
+# Пул вариантов пересоздания: ключ кэша генерации -> еще не показанные мокапы
+# (общий для процесса, давно не использовавшиеся ключи вытесняются)
+_variant_pool = OrderedDict()
+_variant_pool_lock = threading.Lock()
+
+def copy_result_containers(value):
+    """
+    Копия вложенных словарей и списков результата
+    
+    Данные изображений остаются общими; списки мокапов у каждого получателя
+    свои, поэтому замена мокапа в одной сессии не меняет результат другой.
+    """
+    if isinstance(value, dict):
+        return {key: copy_result_containers(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_result_containers(item) for item in value]
+    return value
+
+def generation_params_to_mockup_args(generation_params: Dict) -> Dict:
+    """Параметры генерации (ключ кэша) как аргументы GeminiClient.generate_mockup"""
+    return {
+        "logo_application": generation_params["logo_application"],
+        "custom_prompt": generation_params["custom_prompt"],
+        "product_color": generation_params["product_color"],
+        "product_angle": generation_params["product_angle"],
+        "logo_position": generation_params["logo_position"],
+        "logo_size": generation_params["logo_size"],
+        "logo_color": generation_params["logo_color"]
+    }
 
 class MockupGenerator:
     def __init__(self):
         """Инициализация генератора мокапов"""
-        self.gemini_client = GeminiClient()
+        self.gemini_client = get_gemini_client()
+        self.async_gemini_client = get_async_gemini_client()
         self.image_processor = ImageProcessor()
         self.cache_manager = CacheManager()
         
@@ -56,131 +94,553 @@ class MockupGenerator:
         """
         
         start_time = time.time()
+        generation_params = self._build_generation_params(
+            logo_application, custom_prompt, product_color, product_angle,
+            logo_position, logo_size, logo_color
+        )
+        
+        context = self._prepare_generation(product_image, logo_image, pattern_image,
+                                           style, generation_params, start_time)
+        if "result" in context:
+            return context["result"]
+        if "flight" in context:
+            try:
+                shared_result = context["flight"].result(timeout=CACHE_LEASE_WAIT_SECONDS)
+            except concurrent.futures.TimeoutError:
+                shared_result = None
+            return self._coalesced_result(shared_result, context["cache_key"], start_time)
+        
+        result = None
+        try:
+            result = self._generate_and_cache(
+                product_image, logo_image, pattern_image, style, generation_params,
+                context, start_time
+            )
+            return result
+        finally:
+            self._release_generation(context, result)
+    
+    async def generate_mockups_async(self, product_image: Image.Image,
+                                     logo_image: Image.Image,
+                                     style: str = "modern",
+                                     logo_application: str = "embroidery",
+                                     custom_prompt: str = "",
+                                     product_color: str = "белый",
+                                     product_angle: str = "спереди",
+                                     logo_position: str = "центр",
+                                     logo_size: str = "средний",
+                                     logo_color: str = "как на фото",
+                                     pattern_image: Optional[Image.Image] = None) -> Dict:
+        """
+        Асинхронная генерация мокапов (параметры и результат как у generate_mockups)
+        
+        Работа с кэшем, хешами и файлами выполняется в пуле потоков, запрос
+        к Gemini - в цикле событий, поэтому несколько генераций могут
+        выполняться одновременно (см. gemini_client.run_async).
+        """
+        start_time = time.time()
+        generation_params = self._build_generation_params(
+            logo_application, custom_prompt, product_color, product_angle,
+            logo_position, logo_size, logo_color
+        )
+        
+        # Корутина может продолжиться в другом потоке - аренда привязывается к задаче
+        lease_owner = self.cache_manager.lease_owner(task=f"task-{uuid.uuid4().hex[:12]}")
+        context = await asyncio.to_thread(
+            self._prepare_generation, product_image, logo_image, pattern_image,
+            style, generation_params, start_time, lease_owner
+        )
+        if "result" in context:
+            return context["result"]
+        if "flight" in context:
+            try:
+                # shield: таймаут ожидающего не должен отменять общий результат
+                shared_result = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(context["flight"])), CACHE_LEASE_WAIT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                shared_result = None
+            return self._coalesced_result(shared_result, context["cache_key"], start_time)
+        
+        result = None
+        try:
+            processed_product, processed_logo, processed_pattern = await asyncio.to_thread(
+                self._optimize_images, product_image, logo_image, pattern_image
+            )
+            
+            try:
+                gemini_results = await self.async_gemini_client.generate_mockup(
+                    processed_product, processed_logo, style, pattern_image=processed_pattern,
+                    **generation_params_to_mockup_args(generation_params)
+                )
+                result = await asyncio.to_thread(
+                    self._store_generation, gemini_results, style, generation_params,
+                    context["cache_key"], context["perceptual_hashes"], start_time
+                )
+            except Exception as e:
+                result = await asyncio.to_thread(self._generation_error, e, context["cache_key"], start_time)
+            return result
+        finally:
+            await asyncio.to_thread(self._release_generation, context, result)
+    
+    def regenerate_mockup(self, product_image: Image.Image,
+                          logo_image: Image.Image,
+                          style: str = "modern",
+                          logo_application: str = "embroidery",
+                          custom_prompt: str = "",
+                          product_color: str = "белый",
+                          product_angle: str = "спереди",
+                          logo_position: str = "центр",
+                          logo_size: str = "средний",
+                          logo_color: str = "как на фото",
+                          pattern_image: Optional[Image.Image] = None,
+                          candidates: int = REGENERATE_CANDIDATES) -> Dict:
+        """
+        Новый вариант мокапа с теми же параметрами (кнопка "Пересоздать")
+        
+        Кэш не используется: первый вариант из пула этого результата
+        возвращается сразу, а если пул пуст - параллельно запрашиваются
+        candidates вариантов, один возвращается, остальные ждут следующих
+        пересозданий.
+        
+        Returns:
+            Словарь как у generate_mockups с одним мокапом в gemini_mockups,
+            source: variant_pool или regenerated, variants_left - остаток пула
+        """
+        return run_async(self.regenerate_mockup_async(
+            product_image, logo_image, style, logo_application, custom_prompt,
+            product_color, product_angle, logo_position, logo_size, logo_color,
+            pattern_image, candidates
+        ))
+    
+    async def regenerate_mockup_async(self, product_image: Image.Image,
+                                      logo_image: Image.Image,
+                                      style: str = "modern",
+                                      logo_application: str = "embroidery",
+                                      custom_prompt: str = "",
+                                      product_color: str = "белый",
+                                      product_angle: str = "спереди",
+                                      logo_position: str = "центр",
+                                      logo_size: str = "средний",
+                                      logo_color: str = "как на фото",
+                                      pattern_image: Optional[Image.Image] = None,
+                                      candidates: int = REGENERATE_CANDIDATES) -> Dict:
+        """Асинхронное пересоздание мокапа (см. regenerate_mockup)"""
+        start_time = time.time()
+        generation_params = self._build_generation_params(
+            logo_application, custom_prompt, product_color, product_angle,
+            logo_position, logo_size, logo_color
+        )
+        pool_key = await asyncio.to_thread(
+            self._generation_cache_key, product_image, logo_image, pattern_image, style, generation_params
+        )
         
-        # Генерация хешей для кэширования
+        variant, variants_left = self._take_variant(pool_key)
+        source = "variant_pool"
+        if variant is None:
+            processed_product, processed_logo, processed_pattern = await asyncio.to_thread(
+                self._optimize_images, product_image, logo_image, pattern_image
+            )
+            # Одна модель изображений не возвращает несколько кандидатов в ответе -
+            # варианты запрашиваются параллельными вызовами (общий лимитер)
+            candidate_results = await asyncio.gather(*[
+                self.async_gemini_client.generate_mockup(
+                    processed_product, processed_logo, style, pattern_image=processed_pattern,
+                    **generation_params_to_mockup_args(generation_params)
+                )
+                for _ in range(max(1, candidates))
+            ])
+            variants = [mockup for results in candidate_results for mockup in results if "image_data" in mockup]
+            if not variants:
+                failed = candidate_results[0][0] if candidate_results[0] else {}
+                return {
+                    "status": "error",
+                    "source": "regenerate_failed",
+                    "mockups": {"gemini_mockups": [], "fallback_used": True},
+                    "error": failed.get("error") or "Gemini не сгенерировал изображения",
+                    "error_type": failed.get("error_type", "no_images"),
+                    "processing_time": time.time() - start_time
+                }
+            
+            variant = variants[0]
+            variants_left = self._store_variants(pool_key, variants[1:])
+            source = "regenerated"
+            print(f"Пересоздание: получено {len(variants)} вариантов, {variants_left} в пуле")
+        else:
+            print(f"Пересоздание: вариант из пула, осталось {variants_left}")
+        
+        history_path = await asyncio.to_thread(
+            self._save_mockup_to_history, variant, style, logo_application,
+            custom_prompt, product_color, product_angle
+        )
+        return {
+            "status": "success",
+            "source": source,
+            "mockups": {"gemini_mockups": [variant], "fallback_used": False},
+            "history_paths": [history_path],
+            "variants_left": variants_left,
+            "processing_time": time.time() - start_time,
+            "cache_key": pool_key
+        }
+    
+    def _take_variant(self, pool_key: str) -> Tuple[Optional[Dict], int]:
+        """Очередной вариант из пула результата и остаток пула"""
+        with _variant_pool_lock:
+            variants = _variant_pool.get(pool_key)
+            if not variants:
+                return None, 0
+            _variant_pool.move_to_end(pool_key)
+            variant = variants.pop(0)
+            if not variants:
+                del _variant_pool[pool_key]
+            return variant, len(variants)
+    
+    def _store_variants(self, pool_key: str, variants: List[Dict]) -> int:
+        """Добавление вариантов в пул результата; возвращает размер пула"""
+        if not variants:
+            return 0
+        with _variant_pool_lock:
+            pool = _variant_pool.setdefault(pool_key, [])
+            pool.extend(variants)
+            _variant_pool.move_to_end(pool_key)
+            while len(_variant_pool) > REGENERATE_POOL_MAX_RESULTS:
+                _variant_pool.popitem(last=False)
+            return len(pool)
+    
+    def _build_generation_params(self, logo_application: str, custom_prompt: str,
+                                 product_color: str, product_angle: str, logo_position: str,
+                                 logo_size: str, logo_color: str) -> Dict:
+        """Параметры генерации, входящие в ключ кэша"""
+        return {
+            "logo_application": logo_application, 
+            "custom_prompt": custom_prompt, 
+            "product_color": product_color, 
+            "product_angle": product_angle,
+            "logo_position": logo_position,
+            "logo_size": logo_size,
+            "logo_color": logo_color
+        }
+    
+    def _generation_cache_key(self, product_image: Image.Image, logo_image: Image.Image,
+                              pattern_image: Optional[Image.Image], style: str,
+                              generation_params: Dict) -> str:
+        """Ключ кэша генерации: хеши изображений, стиль и параметры"""
         product_hash = self._generate_image_hash(product_image)
         logo_hash = self._generate_image_hash(logo_image)
+        if pattern_image is not None:
+            generation_params["pattern_hash"] = self._generate_image_hash(pattern_image)
+        return self.cache_manager.generate_cache_key(product_hash, logo_hash, style, generation_params)
+    
+    def _prepare_generation(self, product_image: Image.Image, logo_image: Image.Image,
+                            pattern_image: Optional[Image.Image], style: str,
+                            generation_params: Dict, start_time: float,
+                            lease_owner: Optional[str] = None) -> Dict:
+        """
+        Поиск в кэше и захват аренды генерации
         
+        Returns:
+            {"result": ...}, если ответ уже известен (кэш, похожая запись,
+            результат другого воркера, негативный кэш); {"flight": ...}, если
+            такая же генерация уже выполняется в этом процессе; иначе контекст
+            генерации: cache_key, perceptual_hashes, lease_acquired, lease_owner
+            (после него обязателен вызов _release_generation)
+        """
         # Проверка кэша
-        cache_key = self.cache_manager.generate_cache_key(
-            product_hash, logo_hash, style, {
-                "logo_application": logo_application, 
-                "custom_prompt": custom_prompt, 
-                "product_color": product_color, 
-                "product_angle": product_angle,
-                "logo_position": logo_position,
-                "logo_size": logo_size,
-                "logo_color": logo_color
-            }
-        )
+        cache_key = self._generation_cache_key(product_image, logo_image, pattern_image,
+                                               style, generation_params)
         
         cached_result = self.cache_manager.get_cached_result(cache_key)
-        if cached_result:
+        cached_mockups = self._rehydrate_cached_mockups(cached_result)
+        if cached_mockups:
             print("Использован кэшированный результат")
-            return {
+            return {"result": {
                 "status": "success",
                 "source": "cache",
-                "mockups": cached_result["result"]["mockups"],
+                "mockups": cached_mockups,
+                "processing_time": time.time() - start_time,
+                "cache_key": cache_key
+            }}
+        
+        # Поиск почти одинакового товара (пересохраненные/сжатые копии): логотип,
+        # стиль и параметры сравниваются точно - чужой логотип не должен попасть в ответ
+        perceptual_hashes = None
+        if self.cache_manager.perceptual_enabled:
+            match_hash = self.cache_manager.generate_cache_key(
+                "", self._generate_image_hash(logo_image), style, generation_params
+            )
+            perceptual_hashes = (match_hash, compute_perceptual_hash(product_image))
+            similar_key = self.cache_manager.find_similar_entry(*perceptual_hashes)
+            if similar_key:
+                cached_mockups = self._rehydrate_cached_mockups(
+                    self.cache_manager.get_cached_result(similar_key)
+                )
+                if cached_mockups:
+                    print("Использован кэшированный результат для похожих изображений")
+                    return {"result": {
+                        "status": "success",
+                        "source": "cache_similar",
+                        "mockups": cached_mockups,
+                        "processing_time": time.time() - start_time,
+                        "cache_key": similar_key
+                    }}
+        
+        # Негативный кэш: не повторяем запрос, который недавно завершился неудачей
+        failure = self.cache_manager.get_failure(cache_key)
+        if failure:
+            return {"result": self._failure_result(failure, cache_key, start_time)}
+        
+        # Single-flight: такой же запрос уже выполняется в этом процессе - ждем его результат
+        flight, is_leader = self.cache_manager.join_in_flight(cache_key)
+        if not is_leader:
+            print("Такая же генерация уже выполняется в этом процессе, ожидаем результат...")
+            return {"flight": flight, "cache_key": cache_key}
+        
+        try:
+            # Межпроцессная координация: если ту же генерацию уже выполняет
+            # другой воркер, ждем его результат вместо повторного вызова API
+            lease_acquired = self.cache_manager.acquire_lease(cache_key, owner=lease_owner)
+            if not lease_acquired:
+                print("Такая же генерация уже выполняется, ожидаем результат...")
+                cached_mockups = self._rehydrate_cached_mockups(
+                    self.cache_manager.wait_for_result(cache_key)
+                )
+                if cached_mockups:
+                    return self._finish_early(cache_key, {
+                        "status": "success",
+                        "source": "cache_wait",
+                        "mockups": cached_mockups,
+                        "processing_time": time.time() - start_time,
+                        "cache_key": cache_key
+                    })
+                # Другой воркер мог завершиться неудачей - не повторяем его запрос
+                failure = self.cache_manager.get_failure(cache_key)
+                if failure:
+                    return self._finish_early(cache_key, self._failure_result(failure, cache_key, start_time))
+                lease_acquired = self.cache_manager.acquire_lease(cache_key, owner=lease_owner)
+        except BaseException:
+            self.cache_manager.finish_in_flight(cache_key, None)
+            raise
+        
+        return {
+            "cache_key": cache_key,
+            "perceptual_hashes": perceptual_hashes,
+            "lease_acquired": lease_acquired,
+            "lease_owner": lease_owner
+        }
+    
+    def _finish_early(self, cache_key: str, result: Dict) -> Dict:
+        """Результат, полученный без генерации, передается и ожидающим одинаковым запросам"""
+        self.cache_manager.finish_in_flight(cache_key, result)
+        return {"result": result}
+    
+    def _coalesced_result(self, shared_result: Optional[Dict], cache_key: str,
+                          start_time: float) -> Dict:
+        """Результат запроса, объединенного с одновременным таким же запросом"""
+        if shared_result is None:
+            return {
+                "status": "error",
+                "source": "coalesced",
+                "mockups": {"gemini_mockups": [], "fallback_used": True},
+                "error": "Одновременная такая же генерация не удалась",
                 "processing_time": time.time() - start_time,
                 "cache_key": cache_key
             }
         
+        return {
+            **copy_result_containers(shared_result),
+            "source": "coalesced",
+            "processing_time": time.time() - start_time
+        }
+    
+    def _release_generation(self, context: Dict, result: Optional[Dict] = None):
+        """Освобождение аренды генерации и передача результата ожидающим запросам"""
+        if context["lease_acquired"]:
+            self.cache_manager.release_lease(context["cache_key"], owner=context["lease_owner"])
+        self.cache_manager.finish_in_flight(context["cache_key"], result)
+    
+    def _optimize_images(self, product_image: Image.Image, logo_image: Image.Image,
+                         pattern_image: Optional[Image.Image]) -> Tuple:
+        """Подготовка изображений для API (кэшируется по содержимому, см. ImageProcessor.prepare_for_api)"""
+        processed_product = self.image_processor.prepare_for_api(product_image)
+        processed_logo = self.image_processor.prepare_for_api(logo_image)
+        processed_pattern = self.image_processor.prepare_for_api(pattern_image) if pattern_image else None
+        return processed_product, processed_logo, processed_pattern
+    
+    def _generate_and_cache(self, product_image: Image.Image, logo_image: Image.Image,
+                            pattern_image: Optional[Image.Image], style: str,
+                            generation_params: Dict, context: Dict,
+                            start_time: float) -> Dict:
+        """Генерация мокапов через Gemini API и сохранение результата в кэш"""
         # Обработка изображений
-        processed_product = self.image_processor.optimize_for_api(product_image)
-        processed_logo = self.image_processor.optimize_for_api(logo_image)
-        processed_pattern = self.image_processor.optimize_for_api(pattern_image) if pattern_image else None
+        processed_product, processed_logo, processed_pattern = self._optimize_images(
+            product_image, logo_image, pattern_image
+        )
         
         # Генерация через Gemini API
         try:
             gemini_results = self.gemini_client.generate_mockup(
-                processed_product, processed_logo, style, logo_application, custom_prompt, product_color, product_angle, logo_position, logo_size, logo_color, processed_pattern
+                processed_product, processed_logo, style, pattern_image=processed_pattern,
+                **generation_params_to_mockup_args(generation_params)
             )
-            
-            # Проверка, есть ли изображения от Gemini
-            gemini_has_images = any("image_data" in mockup for mockup in gemini_results)
-            
-            if not gemini_has_images:
-                # Если нет изображений от Gemini - возвращаем ошибку
-                return {
-                    "status": "error",
-                    "source": "gemini_no_images",
-                    "mockups": {"gemini_mockups": [], "fallback_used": True},
-                    "error": "Gemini не сгенерировал изображения",
-                    "processing_time": time.time() - start_time
-                }
-            
-            # Создаем результат только с Gemini мокапами
-            all_mockups = {
-                "gemini_mockups": gemini_results,
-                "fallback_used": False
+            return self._store_generation(
+                gemini_results, style, generation_params,
+                context["cache_key"], context["perceptual_hashes"], start_time
+            )
+        except Exception as e:
+            return self._generation_error(e, context["cache_key"], start_time)
+    
+    def _store_generation(self, gemini_results: List[Dict], style: str, generation_params: Dict,
+                          cache_key: str, perceptual_hashes: Optional[Tuple[str, str]],
+                          start_time: float) -> Dict:
+        """Обработка ответа Gemini: кэш, файлы, история или запоминание неудачи"""
+        logo_application = generation_params["logo_application"]
+        custom_prompt = generation_params["custom_prompt"]
+        product_color = generation_params["product_color"]
+        product_angle = generation_params["product_angle"]
+        
+        # Проверка, есть ли изображения от Gemini
+        gemini_has_images = any("image_data" in mockup for mockup in gemini_results)
+        
+        if not gemini_has_images:
+            # Если нет изображений от Gemini - запоминаем устойчивую неудачу и возвращаем ошибку
+            failure_text = next(
+                (mockup.get("error") or mockup.get("text") for mockup in gemini_results
+                 if mockup.get("error") or mockup.get("text")),
+                ""
+            )
+            # Тип ошибки от клиента (safety, bad_request, ...) или просто "нет изображений"
+            failure_type = gemini_results[0].get("error_type", "no_images") if gemini_results else "no_images"
+            if is_cacheable_failure(failure_type):
+                self.cache_manager.record_failure(cache_key, failure_type, failure_text)
+            return {
+                "status": "error",
+                "source": "gemini_no_images",
+                "mockups": {"gemini_mockups": [], "fallback_used": True},
+                "error": "Gemini не сгенерировал изображения",
+                "error_type": failure_type,
+                "attempts": gemini_results[0].get("attempts", 0) if gemini_results else 0,
+                "processing_time": time.time() - start_time
             }
-            
-            # Создаем версию для кэша без PIL Image объектов
-            cache_data = {
+        
+        # Создаем результат только с Gemini мокапами
+        all_mockups = {
+            "gemini_mockups": gemini_results,
+            "fallback_used": False
+        }
+        
+        # Создаем версию для кэша без PIL Image объектов
+        # (байты изображения CacheManager сохраняет в хранилище блобов)
+        cache_data = {
+            "mockups": {
                 "gemini_mockups": [
                     {
+                        "image_data": mockup.get("image_data"),
                         "style": mockup.get("style"),
                         "logo_application": mockup.get("logo_application"),
                         "product_type": mockup.get("product_type"),
                         "source": mockup.get("source"),
                         "text_response": mockup.get("text_response")
-                    } for mockup in gemini_results if "image" in mockup
+                    } for mockup in gemini_results if "image_data" in mockup
                 ],
                 "fallback_used": False
             }
+        }
+        
+        # Сохранение в кэш
+        self.cache_manager.clear_failure(cache_key)
+        if self.cache_manager.save_to_cache(cache_key, cache_data, api_kind="mockup") and perceptual_hashes:
+            self.cache_manager.register_perceptual_hashes(cache_key, *perceptual_hashes)
+        
+        # Сохранение изображений
+        saved_paths = self._save_mockups(all_mockups, cache_key)
+        
+        # Сохранение в историю проекта
+        history_paths = []
+        for mockup in gemini_results:
+            if "image_data" in mockup:
+                history_path = self._save_mockup_to_history(mockup, style, logo_application, custom_prompt, product_color, product_angle)
+                history_paths.append(history_path)
+        
+        return {
+            "status": "success",
+            "source": "generated",
+            "mockups": all_mockups,
+            "saved_paths": saved_paths,
+            "history_paths": history_paths,
+            "attempts": gemini_results[0].get("attempts", 0),
+            "api_latency": gemini_results[0].get("latency_seconds", 0.0),
+            "processing_time": time.time() - start_time,
+            "cache_key": cache_key
+        }
+    
+    def _generation_error(self, error: Exception, cache_key: str, start_time: float) -> Dict:
+        """Результат при исключении во время генерации (устойчивая ошибка - в негативный кэш)"""
+        print(f"Ошибка генерации: {error}")
+        error_type = classify_error(error)
+        if is_cacheable_failure(error_type):
+            self.cache_manager.record_failure(cache_key, error_type, str(error))
+        
+        return {
+            "status": "error",
+            "source": "generation_failed",
+            "mockups": {"gemini_mockups": [], "fallback_used": True},
+            "error": str(error),
+            "processing_time": time.time() - start_time
+        }
+    
+    def _failure_result(self, failure: Dict, cache_key: str, start_time: float) -> Dict:
+        """Результат для запроса, который находится в негативном кэше"""
+        retry_in = max(0, int(failure["retry_after"] - time.time()))
+        print(f"Запрос недавно завершился неудачей ({failure['failure_type']}), повтор через {retry_in} с")
+        
+        return {
+            "status": "error",
+            "source": "negative_cache",
+            "mockups": {"gemini_mockups": [], "fallback_used": True},
+            "error": (f"Генерация с такими параметрами недавно не удалась "
+                      f"({failure['count']} раз), повторите через {retry_in} с. "
+                      f"{failure.get('last_error') or ''}").strip(),
+            "retry_after": failure["retry_after"],
+            "processing_time": time.time() - start_time,
+            "cache_key": cache_key
+        }
+    
+    def _rehydrate_cached_mockups(self, cached_result: Optional[Dict]) -> Optional[Dict]:
+        """Восстановление мокапов из кэша (байты изображений + PIL Image)"""
+        if not cached_result:
+            return None
+        
+        mockups = (cached_result.get("result") or {}).get("mockups")
+        if not mockups:
+            return None
+        
+        gemini_mockups = []
+        for mockup in mockups.get("gemini_mockups", []):
+            image_data = mockup.get("image_data")
+            # Записи старого формата не содержат изображений - считаем промахом
+            if not image_data:
+                return None
             
-            # Сохранение в кэш
-            self.cache_manager.save_to_cache(cache_key, cache_data)
-            
-            # Сохранение изображений
-            saved_paths = self._save_mockups(all_mockups, cache_key)
-            
-            # Сохранение в историю проекта
-            history_paths = []
-            for mockup in gemini_results:
-                if "image_data" in mockup:
-                    history_path = self._save_mockup_to_history(mockup, style, logo_application, custom_prompt, product_color, product_angle)
-                    history_paths.append(history_path)
-            
-            return {
-                "status": "success",
-                "source": "generated",
-                "mockups": all_mockups,
-                "saved_paths": saved_paths,
-                "history_paths": history_paths,
-                "processing_time": time.time() - start_time,
-                "cache_key": cache_key
-            }
-            
-        except Exception as e:
-            print(f"Ошибка генерации: {e}")
+            try:
+                image = Image.open(io.BytesIO(image_data))
+                image.load()
+            except Exception as e:
+                print(f"Ошибка восстановления изображения из кэша: {e}")
+                return None
             
-            return {
-                "status": "error",
-                "source": "generation_failed",
-                "mockups": {"gemini_mockups": [], "fallback_used": True},
-                "error": str(e),
-                "processing_time": time.time() - start_time
-            }
+            gemini_mockups.append({**mockup, "image": image})
+        
+        if not gemini_mockups:
+            return None
+        
+        return {
+            "gemini_mockups": gemini_mockups,
+            "fallback_used": mockups.get("fallback_used", False)
+        }
     
     def _generate_image_hash(self, image: Image.Image) -> str:
         """Генерация хеша изображения"""
-        buffer = io.BytesIO()
-        
-        # Убеждаемся, что изображение в RGB режиме для JPEG
-        if image.mode == 'RGBA':
-            # Создаем белый фон для RGBA изображений
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        image.save(buffer, format='JPEG', quality=95)
-        image_bytes = buffer.getvalue()
-        
-        import hashlib
-        return hashlib.md5(image_bytes).hexdigest()
+        return self.image_processor.generate_image_hash(image)
     
     def _create_local_mockups(self, product_image: Image.Image, 
                              logo_image: Image.Image,
@@ -0,0 +1,198 @@
+"""
+Шаблоны промптов для генерации мокапов
+Справочники и шаблон собираются один раз при импорте, готовые промпты кэшируются
+"""
+from functools import lru_cache
+from typing import Tuple
+
+# Эффекты нанесения логотипа для разных материалов
+MATERIAL_ADAPTATIONS = {
+    "fabric": {
+        "embroidery": "embroidered with raised thread texture, realistic stitching details, and natural fabric integration",
+        "printing": "printed with smooth, flat surface, crisp edges, and fabric-appropriate ink absorption",
+        "woven": "woven into the fabric with integrated texture, natural appearance, and seamless blending",
+        "embossed": "embossed with raised relief effect, realistic depth, and fabric-appropriate texture",
+        "sublimation": "sublimated with vibrant colors, smooth finish, and permanent integration into fabric",
+        "silicone": "silicone application with soft, flexible texture, raised surface, and durable finish",
+        "patch": "patch application with raised edges, fabric backing, and sewn-on appearance",
+        "heat_transfer": "heat transfer with smooth application, vibrant colors, and professional finish",
+        "screen_print": "screen printed with thick ink, matte finish, and durable application",
+        "digital_print": "digitally printed with high resolution, smooth finish, and precise details",
+        "laser_engraving": "laser engraved with subtle texture, permanent marking, and professional appearance"
+    },
+    "textile": {
+        "embroidery": "embroidered with raised thread texture, realistic stitching details, and textile-appropriate integration",
+        "printing": "printed with smooth, flat surface, crisp edges, and textile-appropriate ink absorption",
+        "woven": "woven into the textile with integrated texture, natural appearance, and seamless blending",
+        "embossed": "embossed with raised relief effect, realistic depth, and textile-appropriate texture",
+        "sublimation": "sublimated with vibrant colors, smooth finish, and permanent integration into textile",
+        "silicone": "silicone application with soft, flexible texture, raised surface, and durable finish",
+        "patch": "patch application with raised edges, fabric backing, and sewn-on appearance",
+        "heat_transfer": "heat transfer with smooth application, vibrant colors, and professional finish",
+        "screen_print": "screen printed with thick ink, matte finish, and durable application",
+        "digital_print": "digitally printed with high resolution, smooth finish, and precise details",
+        "laser_engraving": "laser engraved with subtle texture, permanent marking, and professional appearance"
+    },
+    "leather": {
+        "embroidery": "embroidered with raised thread texture, realistic stitching details, and leather-appropriate integration",
+        "printing": "printed with smooth, flat surface, crisp edges, and leather-appropriate ink absorption",
+        "woven": "woven into the leather with integrated texture, natural appearance, and seamless blending",
+        "embossed": "embossed with raised relief effect, realistic depth, and leather-appropriate texture",
+        "sublimation": "sublimated with vibrant colors, smooth finish, and permanent integration into leather",
+        "silicone": "silicone application with soft, flexible texture, raised surface, and durable finish",
+        "patch": "patch application with raised edges, fabric backing, and sewn-on appearance",
+        "heat_transfer": "heat transfer with smooth application, vibrant colors, and professional finish",
+        "screen_print": "screen printed with thick ink, matte finish, and durable application",
+        "digital_print": "digitally printed with high resolution, smooth finish, and precise details",
+        "laser_engraving": "laser engraved with subtle texture, permanent marking, and professional appearance"
+    }
+}
+
+STYLE_DESCRIPTIONS = {
+    "modern": "Modern clean lines, minimalist design, contemporary colors, sleek presentation with bright, clean lighting and sharp contrasts",
+    "luxury": "Premium materials, elegant presentation, sophisticated look, high-end appeal with dramatic lighting and rich textures",
+    "minimal": "Simple design, neutral colors, clean aesthetics, uncluttered presentation with soft, even lighting and subtle shadows",
+    "dynamic": "Energetic, vibrant design with bold colors, dynamic composition, action-oriented presentation with dramatic lighting and movement"
+}
+
+# Словари для перевода
+POSITION_TRANSLATION = {
+    "центр": "center of the product",
+    "верхний левый угол": "top-left corner of the product",
+    "верхний правый угол": "top-right corner of the product",
+    "нижний левый угол": "bottom-left corner of the product",
+    "нижний правый угол": "bottom-right corner of the product",
+    "левый бок": "left side of the product",
+    "правый бок": "right side of the product",
+    "верх": "top of the product",
+    "низ": "bottom of the product"
+}
+
+SIZE_TRANSLATION = {
+    "очень маленький": "very small",
+    "маленький": "small",
+    "средний": "medium",
+    "большой": "large",
+    "очень большой": "very large"
+}
+
+AS_IN_PHOTO = "как на фото"
+
+PATTERN_INSTRUCTION = ("PATTERN APPLICATION: Use the uploaded pattern image to create a repeating pattern "
+                       "across the product surface. The pattern should be seamlessly integrated with the product design.")
+
+# Двухэтапный промпт: сначала товар, потом логотип
+MOCKUP_PROMPT_TEMPLATE = """🚨 CRITICAL INSTRUCTION: DO NOT CHANGE THE PRODUCT TYPE! 🚨
+
+You must keep the EXACT SAME PRODUCT from the uploaded image. If it's a phone stand, keep it as a phone stand. If it's a car seat cover, keep it as a car seat cover. If it's a car organizer, keep it as a car organizer.
+
+TASK: Add logo to the existing product WITHOUT changing what the product is.
+
+PRODUCT PRESERVATION (MOST IMPORTANT):
+- Keep the EXACT product type from the uploaded image
+- Keep the same design, shape, and features
+- Only change: color (if specified), angle (if specified), and add logo
+- DO NOT transform the product into something else
+- REMOVE ALL EXISTING BRANDING, LOGOS, TEXT from the original product
+- Make the product clean and unbranded before adding the new logo
+
+STYLE AND APPEARANCE:
+- Style: {style_line}
+- Color: {color_instruction}
+- Photography: {angle_instruction}
+
+LOGO APPLICATION:
+{logo_block}
+Logo color: {logo_color_instruction}
+Logo must follow product curves and texture naturally.
+
+{special_requirements}
+
+{pattern_instruction}
+
+FINAL REQUIREMENTS:
+- Keep the original product exactly as shown in the image
+- Only add the logo to the existing product
+- Professional studio lighting
+- Clean background
+- High quality image
+- Generate a SQUARE image with 1:1 aspect ratio
+
+Generate the mockup image."""
+
+
+@lru_cache(maxsize=None)
+def resolve_logo_effect(product_type: str, logo_application: str) -> Tuple[str, str]:
+    """
+    Эффект нанесения логотипа для материала
+    
+    Returns:
+        Кортеж (фактический метод нанесения, описание эффекта)
+    """
+    material_dict = MATERIAL_ADAPTATIONS.get(product_type, MATERIAL_ADAPTATIONS["fabric"])
+    
+    if logo_application in material_dict:
+        return logo_application, material_dict[logo_application]
+    
+    # Если не найден, используем первый доступный (не embroidery)
+    available_methods = [k for k in material_dict.keys() if k != "embroidery"]
+    fallback_method = available_methods[0] if available_methods else "embroidery"
+    print(f"⚠️ Logo application '{logo_application}' not found, using fallback: '{fallback_method}'")
+    return fallback_method, material_dict[fallback_method]
+
+
+@lru_cache(maxsize=1024)
+def _render_static_block(product_type: str, logo_application: str, style: str,
+                         position: str, size: str) -> Tuple[str, str]:
+    """Строка стиля и блок нанесения логотипа по ключу (тип товара, нанесение, стиль, позиция, размер)"""
+    _, logo_effect = resolve_logo_effect(product_type, logo_application)
+    style_line = f"{style} style with {STYLE_DESCRIPTIONS.get(style, STYLE_DESCRIPTIONS['modern'])}"
+    logo_block = (f"Apply logo using {logo_application} method: {logo_effect}\n"
+                  f"Logo position: {POSITION_TRANSLATION.get(position, 'center')}\n"
+                  f"Logo size: {SIZE_TRANSLATION.get(size, 'medium')}")
+    return style_line, logo_block
+
+
+@lru_cache(maxsize=512)
+def render_mockup_prompt(product_type: str, logo_application: str, style: str,
+                         position: str, size: str, product_color: str = AS_IN_PHOTO,
+                         product_angle: str = AS_IN_PHOTO, logo_color: str = AS_IN_PHOTO,
+                         custom_prompt: str = "", has_pattern: bool = False) -> str:
+    """
+    Готовый промпт для генерации мокапа
+    
+    Args:
+        product_type: Тип материала товара (fabric, textile, leather)
+        logo_application: Тип нанесения логотипа
+        style: Стиль мокапа
+        position: Расположение логотипа
+        size: Размер логотипа
+        product_color: Цвет товара
+        product_angle: Ракурс товара
+        logo_color: Цвет логотипа
+        custom_prompt: Дополнительные требования
+        has_pattern: Передается ли изображение паттерна
+    
+    Returns:
+        Текст промпта
+    """
+    style_line, logo_block = _render_static_block(product_type, logo_application, style, position, size)
+    
+    # Обработка опций "как на фото"
+    color_instruction = ("keep the original color from the product image" if product_color == AS_IN_PHOTO
+                         else f"make the product {product_color}")
+    angle_instruction = ("keep the original angle from the product image" if product_angle == AS_IN_PHOTO
+                         else f"photograph from {product_angle} angle")
+    logo_color_instruction = ("keep the original color from the logo image" if logo_color == AS_IN_PHOTO
+                              else f"make the logo {logo_color}")
+    
+    return MOCKUP_PROMPT_TEMPLATE.format(
+        style_line=style_line,
+        color_instruction=color_instruction,
+        angle_instruction=angle_instruction,
+        logo_block=logo_block,
+        logo_color_instruction=logo_color_instruction,
+        special_requirements=f"SPECIAL REQUIREMENTS: {custom_prompt}" if custom_prompt.strip() else "",
+        pattern_instruction=PATTERN_INSTRUCTION if has_pattern else ""
+    )
+
@@ -0,0 +1,175 @@
+"""
+Ограничение частоты запросов к Gemini API
+Один лимитер на процесс: бюджеты запросов и токенов в минуту (token bucket)
+и адаптивный параллелизм (AIMD) по ответам 429 / RESOURCE_EXHAUSTED
+"""
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+from config import GEMINI_RPM_LIMIT, GEMINI_TPM_LIMIT, GEMINI_MIN_CONCURRENCY, MAX_CONCURRENT_REQUESTS
+
+# Как часто проверять освобождение слота параллелизма
+SLOT_POLL_SECONDS = 0.05
+
+# Признаки превышения квоты в ошибках SDK
+RATE_LIMIT_MARKERS = ("429", "RESOURCE_EXHAUSTED", "rate limit", "quota")
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Ошибка превышения квоты Gemini (429 / RESOURCE_EXHAUSTED)"""
+    if getattr(error, "code", None) == 429:
+        return True
+    message = str(error)
+    return any(marker.lower() in message.lower() for marker in RATE_LIMIT_MARKERS)
+
+class TokenBucket:
+    """Ведро токенов с пополнением capacity единиц в минуту"""
+    
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        """Пополнение по прошедшему времени"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        """Сколько ждать, пока в ведре наберется amount (0 - можно сразу)"""
+        self._refill(now)
+        # Запрос больше емкости ведра ждет полного ведра, а не бесконечно
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+    
+    def consume(self, amount: float):
+        """Списание (может уйти в минус при уточнении фактического расхода)"""
+        self.tokens -= min(amount, self.capacity)
+    
+    def drain(self, now: float):
+        """Опустошение ведра: пауза до пополнения после ответа 429"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+class RateLimiter:
+    """
+    Общий лимитер вызовов Gemini
+    
+    Перед вызовом acquire / acquire_async ждут слот параллелизма и бюджет
+    RPM/TPM, после вызова release возвращает слот, уточняет расход токенов
+    по usage_metadata и подстраивает параллелизм: +1/limit за успешный
+    ответ, уменьшение вдвое при 429.
+    """
+    
+    def __init__(self, rpm: int = GEMINI_RPM_LIMIT, tpm: int = GEMINI_TPM_LIMIT,
+                 min_concurrency: int = GEMINI_MIN_CONCURRENCY,
+                 max_concurrency: int = MAX_CONCURRENT_REQUESTS):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.rate_limited_count = 0
+        self.waited_seconds = 0.0
+        self._lock = threading.Lock()
+    
+    def _try_acquire(self, estimated_tokens: int) -> float:
+        """Попытка занять слот и бюджет; возвращает паузу перед повтором (0 - занято)"""
+        with self._lock:
+            if self.in_flight >= int(self.concurrency):
+                return SLOT_POLL_SECONDS
+            
+            now = time.monotonic()
+            wait = max(self.requests.wait_time(1, now),
+                       self.tokens.wait_time(estimated_tokens, now))
+            if wait > 0:
+                return wait
+            
+            self.requests.consume(1)
+            self.tokens.consume(estimated_tokens)
+            self.in_flight += 1
+            return 0.0
+    
+    def acquire(self, estimated_tokens: int = 0):
+        """Ожидание разрешения на вызов (синхронный код)"""
+        started = time.monotonic()
+        while True:
+            wait = self._try_acquire(estimated_tokens)
+            if wait == 0:
+                break
+            time.sleep(wait)
+        self._record_wait(time.monotonic() - started)
+    
+    async def acquire_async(self, estimated_tokens: int = 0):
+        """Ожидание разрешения на вызов без блокировки цикла событий"""
+        started = time.monotonic()
+        while True:
+            wait = self._try_acquire(estimated_tokens)
+            if wait == 0:
+                break
+            await asyncio.sleep(wait)
+        self._record_wait(time.monotonic() - started)
+    
+    def _record_wait(self, waited: float):
+        """Учет времени ожидания для статистики"""
+        if waited > 0:
+            with self._lock:
+                self.waited_seconds += waited
+    
+    def release(self, estimated_tokens: int = 0, actual_tokens: Optional[int] = None,
+                rate_limited: bool = False):
+        """
+        Завершение вызова
+        
+        Args:
+            estimated_tokens: Оценка токенов, списанная при acquire
+            actual_tokens: Фактический расход из usage_metadata (если известен)
+            rate_limited: Вызов завершился ответом 429 / RESOURCE_EXHAUSTED
+        """
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            
+            if actual_tokens is not None:
+                self.tokens.consume(actual_tokens - estimated_tokens)
+            
+            if rate_limited:
+                # Мультипликативное уменьшение и пауза до пополнения бюджета
+                self.rate_limited_count += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                self.requests.drain(time.monotonic())
+                print(f"⚠️ Gemini: превышена квота, параллелизм снижен до {int(self.concurrency)}")
+            else:
+                # Аддитивное увеличение: +1 за "окно" из concurrency успешных ответов
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+    
+    def get_stats(self) -> Dict:
+        """Текущее состояние лимитера"""
+        with self._lock:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            return {
+                "concurrency": int(self.concurrency),
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "requests_available": int(self.requests.tokens),
+                "tokens_available": int(self.tokens.tokens),
+                "rate_limited": self.rate_limited_count,
+                "waited_seconds": round(self.waited_seconds, 2)
+            }
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> RateLimiter:
+    """Лимитер процесса (общий для всех экземпляров GeminiClient)"""
+    global _rate_limiter
+    
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
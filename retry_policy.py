@@ -0,0 +1,168 @@
+"""
+Повторы запросов к Gemini API
+Классификация ошибок, экспоненциальная пауза со случайным разбросом (jitter)
+и предохранитель (circuit breaker), который сразу отклоняет запросы,
+пока API недоступен
+"""
+import asyncio
+import concurrent.futures
+import random
+import threading
+import time
+from typing import Dict
+from config import (GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY,
+                    GEMINI_CIRCUIT_FAILURE_THRESHOLD, GEMINI_CIRCUIT_COOLDOWN_SECONDS)
+from rate_limiter import is_rate_limit_error
+
+try:
+    import httpx
+    TIMEOUT_ERRORS = (TimeoutError, asyncio.TimeoutError, concurrent.futures.TimeoutError,
+                      httpx.TimeoutException)
+    NETWORK_ERRORS = (ConnectionError, httpx.TransportError)
+except ImportError:
+    TIMEOUT_ERRORS = (TimeoutError, asyncio.TimeoutError, concurrent.futures.TimeoutError)
+    NETWORK_ERRORS = (ConnectionError,)
+
+# Типы ошибок, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = {"rate_limit", "timeout", "network", "server"}
+
+# Типы ошибок, после которых тот же запрос позже может пройти - в негативный кэш
+# не записываются (unknown: причина не установлена, блокировать повтор нельзя)
+TRANSIENT_FAILURES = RETRYABLE_ERRORS | {"circuit_open", "unknown"}
+
+# Типы ошибок, которые говорят о проблемах API (считаются предохранителем)
+CIRCUIT_ERRORS = {"timeout", "network", "server"}
+
+# Признаки блокировки фильтрами безопасности в тексте ошибки
+SAFETY_MARKERS = ("SAFETY", "blocked", "BLOCKLIST", "PROHIBITED_CONTENT", "RECITATION")
+
+class CircuitOpenError(Exception):
+    """Запрос отклонен: предохранитель разомкнут после серии ошибок API"""
+
+def classify_error(error: Exception) -> str:
+    """
+    Тип ошибки вызова Gemini
+    
+    Returns:
+        rate_limit, timeout, network, server, safety, bad_request,
+        circuit_open или unknown
+    """
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, TIMEOUT_ERRORS):
+        return "timeout"
+    if is_rate_limit_error(error):
+        return "rate_limit"
+    if isinstance(error, NETWORK_ERRORS):
+        return "network"
+    
+    message = str(error)
+    if any(marker in message for marker in SAFETY_MARKERS):
+        return "safety"
+    
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        if code >= 500:
+            return "server"
+        if code == 408:
+            return "timeout"
+        if 400 <= code < 500:
+            return "bad_request"
+    return "unknown"
+
+def is_retryable(error_type: str) -> bool:
+    """Можно ли повторить запрос с ошибкой такого типа"""
+    return error_type in RETRYABLE_ERRORS
+
+def is_cacheable_failure(error_type: str) -> bool:
+    """Запоминать ли неудачу в негативном кэше (только устойчивые: safety, bad_request, нет изображений)"""
+    return error_type not in TRANSIENT_FAILURES
+
+def backoff_delay(attempt: int) -> float:
+    """Пауза перед повтором: экспонента от номера попытки со случайным разбросом (full jitter)"""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    """
+    Предохранитель вызовов Gemini
+    
+    После failure_threshold подряд ошибок API (таймауты, сеть, 5xx) размыкается
+    на cooldown секунд: запросы сразу получают CircuitOpenError. По истечении
+    паузы пропускает один пробный запрос: успех замыкает цепь, ошибка
+    размыкает ее снова.
+    """
+    
+    def __init__(self, failure_threshold: int = GEMINI_CIRCUIT_FAILURE_THRESHOLD,
+                 cooldown_seconds: float = GEMINI_CIRCUIT_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+    
+    def check(self):
+        """Разрешение на вызов (CircuitOpenError, если предохранитель разомкнут)"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            
+            now = time.monotonic()
+            remaining = self.opened_at + self.cooldown_seconds - now
+            if remaining <= 0:
+                # Пауза истекла (или пробный запрос так и не завершился) -
+                # пропускаем один пробный запрос
+                self.state = "half_open"
+                self.opened_at = now
+                return
+            
+            raise CircuitOpenError(
+                f"Gemini API временно недоступен, повтор через {int(remaining) + 1} с"
+            )
+    
+    def record_success(self):
+        """Успешный вызов замыкает цепь"""
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+    
+    def record_failure(self, error_type: str):
+        """Учет ошибки вызова (ошибки запроса, а не API, не учитываются)"""
+        with self._lock:
+            if error_type not in CIRCUIT_ERRORS:
+                if self.state == "half_open":
+                    # Пробный запрос дошел до API - API отвечает
+                    self.state = "closed"
+                    self.failures = 0
+                return
+            
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                    print(f"⚠️ Gemini API: {self.failures} ошибок подряд, "
+                          f"запросы приостановлены на {self.cooldown_seconds} с")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+    
+    def get_stats(self) -> Dict:
+        """Текущее состояние предохранителя"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "trips": self.trips
+            }
+
+_circuit_breaker = None
+_circuit_breaker_lock = threading.Lock()
+
+def get_circuit_breaker() -> CircuitBreaker:
+    """Предохранитель процесса (общий для всех экземпляров GeminiClient)"""
+    global _circuit_breaker
+    
+    with _circuit_breaker_lock:
+        if _circuit_breaker is None:
+            _circuit_breaker = CircuitBreaker()
+        return _circuit_breaker
@@ -217,7 +217,6 @@ def regenerate_mockup_dynamically(mockup_index: int, original_mockup: dict, orig
             # Обновляем статус
             status_text.text("🔄 Подключение к Gemini...")
             progress_bar.progress(20)
-            time.sleep(0.5)
             
             # Получаем генератор
             from mockup_generator import MockupGenerator
@@ -236,10 +235,9 @@ def regenerate_mockup_dynamically(mockup_index: int, original_mockup: dict, orig
             # Обновляем статус
             status_text.text("🎨 Генерация нового мокапа...")
             progress_bar.progress(50)
-            time.sleep(0.5)
             
-            # Генерируем новый мокап с теми же параметрами
-            new_result = generator.generate_mockup(
+            # Новый вариант с теми же параметрами (из пула вариантов или новым запросом)
+            new_result = generator.regenerate_mockup(
                 st.session_state.product_image, st.session_state.logo_image,
                 mockup_style, logo_application, custom_prompt, product_color,
                 product_angle, logo_position, logo_size, logo_color
@@ -248,16 +246,14 @@ def regenerate_mockup_dynamically(mockup_index: int, original_mockup: dict, orig
             # Обновляем статус
             status_text.text("✅ Обработка результата...")
             progress_bar.progress(80)
-            time.sleep(0.5)
             
-            if new_result and "mockups" in new_result and new_result["mockups"]:
+            if new_result and new_result.get("mockups", {}).get("gemini_mockups"):
                 # Обновляем отображение
-                update_mockup_display(mockup_index, new_result["mockups"][0], new_result, container_key)
+                update_mockup_display(mockup_index, new_result["mockups"]["gemini_mockups"][0], new_result, container_key)
                 
                 # Обновляем статус
-                status_text.text("✅ Мокап успешно пересоздан!")
+                status_text.text(f"✅ Мокап успешно пересоздан! Готовых вариантов: {new_result.get('variants_left', 0)}")
                 progress_bar.progress(100)
-                time.sleep(1)
                 
                 # Очищаем индикаторы
                 status_text.empty()
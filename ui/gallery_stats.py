@@ -105,3 +105,64 @@ def show_storage_info():
     if storage_info:
         st.info(f"💡 Изображения сохраняются в: {', '.join(storage_info)}")
     
+
+def show_cache_statistics(generation_stats: dict):
+    """Отображение эффективности кэша (из MockupGenerator.get_generation_stats)"""
+    
+    st.subheader("⚡ Эффективность кэша")
+    
+    cache_stats = generation_stats.get("cache_stats", {})
+    if not cache_stats.get("enabled"):
+        st.info("Кэш отключен")
+        return
+    if "error" in cache_stats:
+        st.warning(f"⚠️ Ошибка получения статистики кэша: {cache_stats['error']}")
+        return
+    
+    metrics = cache_stats.get("metrics", {})
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Доля попаданий", f"{metrics.get('hit_ratio', 0) * 100:.1f}%")
+        st.caption(f"Попаданий: {metrics.get('hits', 0)} / промахов: {metrics.get('misses', 0)}")
+    with col2:
+        st.metric("Вызовов Gemini сэкономлено", metrics.get("api_calls_avoided", 0))
+        st.caption(f"Токенов (оценка): {metrics.get('tokens_avoided', 0):,}".replace(",", " "))
+    with col3:
+        st.metric("Сэкономлено (оценка)", f"${metrics.get('cost_saved_usd', 0):.2f}")
+        st.caption(f"Отдано из кэша: {metrics.get('bytes_served', 0) / (1024 * 1024):.1f} MB")
+    with col4:
+        st.metric("Записей в кэше", cache_stats.get("total_files", 0))
+        st.caption(f"{cache_stats.get('total_size_mb', 0)} / {cache_stats.get('max_size_mb', 0)} MB")
+    
+    st.caption(
+        f"Устаревших попаданий: {metrics.get('stale_hits', 0)} • "
+        f"объединено одновременных запросов: {metrics.get('coalesced_calls', 0)} • "
+        f"вытеснено: {metrics.get('evictions', 0)} • "
+        f"политика: {cache_stats.get('eviction_policy', '-')} • "
+        f"хранилище: {cache_stats.get('backend', '-')}"
+    )
+
+def show_usage_statistics(usage_by_day: dict, session_usage: dict = None):
+    """Отображение расхода Gemini по журналу использования (usage_ledger.get_usage_summary)"""
+    
+    st.subheader("💰 Расход Gemini")
+    
+    if not usage_by_day:
+        st.info("Вызовов Gemini пока не было")
+        return
+    
+    today = usage_by_day.get(time.strftime("%Y-%m-%d"), {})
+    total_cost = sum(day["cost_usd"] for day in usage_by_day.values())
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Сегодня", f"${today.get('cost_usd', 0):.2f}")
+        st.caption(f"Вызовов: {today.get('calls', 0)} • токенов: {today.get('total_tokens', 0)}")
+    with col2:
+        session_usage = session_usage or {}
+        st.metric("Эта сессия", f"${session_usage.get('cost_usd', 0):.2f}")
+        st.caption(f"Вызовов: {session_usage.get('calls', 0)} • ошибок: {session_usage.get('errors', 0)}")
+    with col3:
+        st.metric("Всего в журнале", f"${total_cost:.2f}")
+        st.caption(f"Дней: {len(usage_by_day)}")
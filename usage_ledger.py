@@ -0,0 +1,274 @@
+"""
+Журнал использования Gemini API
+Каждый вызов generate_content (токены из usage_metadata, модель, время, исход)
+дописывается строкой JSON в локальный файл; по журналу считаются итоги по
+сессиям, дням и коллекциям, а по размеру изображений и промпта - оценка
+стоимости пакета до запуска
+"""
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from config import (USAGE_LEDGER_ENABLED, USAGE_LEDGER_FILE, GEMINI_PRICING, GEMINI_MODEL,
+                    MAX_IMAGE_SIZE)
+
+# Токены изображения на входе: до 384x384 - одна плитка, больше - плитки 768x768
+IMAGE_TILE_TOKENS = 258
+IMAGE_SMALL_SIDE = 384
+IMAGE_TILE_SIDE = 768
+
+# Выход генерации мокапа: одно изображение и короткий текст
+OUTPUT_IMAGE_TOKENS = 1290
+OUTPUT_TEXT_TOKENS_ESTIMATE = 100
+
+# Приблизительно символов на токен (для оценки промпта)
+CHARS_PER_TOKEN = 4
+
+# Группировки для итогов
+USAGE_GROUPS = {
+    "session": lambda record: record.get("session") or "-",
+    "day": lambda record: record.get("date") or "-",
+    "collection": lambda record: record.get("collection") or "-",
+    "model": lambda record: record.get("model") or "-",
+    "api_kind": lambda record: record.get("api_kind") or "-"
+}
+
+# Сессия по умолчанию - процесс (Streamlit задает свою через set_usage_context)
+PROCESS_SESSION = f"process-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+# Контекст вызова: переходит в задачи asyncio и потоки asyncio.to_thread
+_session_var: ContextVar[str] = ContextVar("usage_session", default=PROCESS_SESSION)
+_collection_var: ContextVar[Optional[str]] = ContextVar("usage_collection", default=None)
+# Итоги, которые копятся по мере вызовов (см. usage_tally)
+_tally_var: ContextVar[Optional[Dict]] = ContextVar("usage_tally", default=None)
+
+_ledger_lock = threading.Lock()
+
+def set_usage_context(session: Optional[str] = None, collection: Optional[str] = None):
+    """Сессия и коллекция для последующих вызовов в текущем контексте (скрипт Streamlit)"""
+    if session is not None:
+        _session_var.set(session)
+    _collection_var.set(collection)
+
+@contextmanager
+def usage_context(session: Optional[str] = None, collection: Optional[str] = None):
+    """Временная привязка вызовов к сессии и/или коллекции"""
+    tokens = []
+    if session is not None:
+        tokens.append((_session_var, _session_var.set(session)))
+    if collection is not None:
+        tokens.append((_collection_var, _collection_var.set(collection)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+@contextmanager
+def usage_tally():
+    """
+    Итоги вызовов текущего контекста, накапливаемые по мере их завершения
+    
+    Позволяет получить расход пакета без чтения журнала; формат итогов как
+    у get_usage_summary.
+    """
+    totals = _new_totals()
+    token = _tally_var.set(totals)
+    try:
+        yield totals
+    finally:
+        _tally_var.reset(token)
+        _round_totals(totals)
+
+def _new_totals() -> Dict:
+    """Пустые итоги группы"""
+    return {"calls": 0, "errors": 0, "prompt_tokens": 0, "output_tokens": 0,
+            "image_tokens": 0, "total_tokens": 0, "cost_usd": 0.0, "latency_seconds": 0.0}
+
+def _add_to_totals(totals: Dict, record: Dict):
+    """Добавление записи журнала к итогам"""
+    totals["calls"] += 1
+    totals["errors"] += record.get("outcome") != "success"
+    totals["prompt_tokens"] += record.get("prompt_tokens", 0)
+    totals["output_tokens"] += record.get("output_tokens", 0)
+    totals["image_tokens"] += record.get("input_image_tokens", 0) + record.get("output_image_tokens", 0)
+    totals["total_tokens"] += record.get("total_tokens", 0)
+    totals["cost_usd"] += record.get("cost_usd", 0.0)
+    totals["latency_seconds"] += record.get("latency_seconds", 0.0)
+
+def _round_totals(totals: Dict):
+    """Округление денежных и временных итогов"""
+    totals["cost_usd"] = round(totals["cost_usd"], 4)
+    totals["latency_seconds"] = round(totals["latency_seconds"], 2)
+
+def _modality_tokens(details, modality: str) -> int:
+    """Токены указанной модальности из *_tokens_details"""
+    return sum(item.token_count or 0 for item in details or []
+               if item.modality is not None and str(getattr(item.modality, "value", item.modality)) == modality)
+
+def calculate_cost(model: str, prompt_tokens: int, output_tokens: int, output_image_tokens: int) -> float:
+    """Стоимость вызова в USD по GEMINI_PRICING"""
+    pricing = GEMINI_PRICING.get(model, GEMINI_PRICING[GEMINI_MODEL])
+    text_output = max(0, output_tokens - output_image_tokens)
+    return (prompt_tokens * pricing["input"] +
+            text_output * pricing["output"] +
+            output_image_tokens * pricing["image_output"]) / 1_000_000
+
+def usage_from_response(model: str, response) -> Dict:
+    """Токены и стоимость из usage_metadata ответа (нули, если ответа нет)"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {"prompt_tokens": 0, "output_tokens": 0, "input_image_tokens": 0,
+                "output_image_tokens": 0, "total_tokens": 0, "cost_usd": 0.0}
+    
+    prompt_tokens = usage.prompt_token_count or 0
+    # Токены рассуждений оплачиваются как выход
+    output_tokens = (usage.candidates_token_count or 0) + (usage.thoughts_token_count or 0)
+    output_image_tokens = _modality_tokens(usage.candidates_tokens_details, "IMAGE")
+    return {
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "input_image_tokens": _modality_tokens(usage.prompt_tokens_details, "IMAGE"),
+        "output_image_tokens": output_image_tokens,
+        "total_tokens": usage.total_token_count or prompt_tokens + output_tokens,
+        "cost_usd": round(calculate_cost(model, prompt_tokens, output_tokens, output_image_tokens), 6)
+    }
+
+def record_call(model: str, api_kind: Optional[str], response, latency_seconds: float,
+                attempt: int, outcome: str, fake: bool = False):
+    """
+    Запись вызова в журнал
+    
+    Args:
+        model: Модель Gemini
+        api_kind: Тип вызова (ключ GEMINI_CALL_ESTIMATES)
+        response: Ответ generate_content (None при ошибке)
+        latency_seconds: Время попытки
+        attempt: Номер попытки
+        outcome: success или тип ошибки (см. retry_policy.classify_error)
+        fake: Ответ офлайн-заглушки - запись помечается, стоимость нулевая,
+            в итоги get_usage_summary не попадает
+    """
+    now = time.time()
+    record = {
+        "ts": round(now, 3),
+        "date": datetime.fromtimestamp(now).strftime("%Y-%m-%d"),
+        "session": _session_var.get(),
+        "collection": _collection_var.get(),
+        "model": model,
+        "api_kind": api_kind,
+        "attempt": attempt,
+        "outcome": outcome,
+        "latency_seconds": round(latency_seconds, 3),
+        **usage_from_response(model, response)
+    }
+    if fake:
+        record["fake"] = True
+        record["cost_usd"] = 0.0
+    
+    tally = _tally_var.get()
+    if tally is not None:
+        with _ledger_lock:
+            _add_to_totals(tally, record)
+    
+    if not USAGE_LEDGER_ENABLED:
+        return
+    
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    try:
+        with _ledger_lock:
+            directory = os.path.dirname(USAGE_LEDGER_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Только дозапись: строки не переписываются, файл можно ротировать снаружи
+            with open(USAGE_LEDGER_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError as e:
+        print(f"Ошибка записи журнала использования: {e}")
+
+def read_ledger(since: Optional[float] = None) -> Iterator[Dict]:
+    """Записи журнала (начиная с момента since, если указан)"""
+    try:
+        with open(USAGE_LEDGER_FILE, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная строка (процесс упал во время записи)
+                    continue
+                if since is None or record.get("ts", 0) >= since:
+                    yield record
+    except FileNotFoundError:
+        return
+
+def get_usage_summary(group_by: str = "day", since: Optional[float] = None) -> Dict[str, Dict]:
+    """
+    Итоги использования по группам
+    
+    Args:
+        group_by: session, day, collection, model или api_kind
+        since: Учитывать вызовы начиная с этого момента (timestamp)
+    
+    Returns:
+        {группа: {calls, errors, prompt_tokens, output_tokens, image_tokens,
+        total_tokens, cost_usd, latency_seconds}}
+    """
+    if group_by not in USAGE_GROUPS:
+        raise ValueError(f"Неизвестная группировка: {group_by}")
+    group_key = USAGE_GROUPS[group_by]
+    
+    summary = {}
+    for record in read_ledger(since):
+        if record.get("fake"):
+            continue
+        _add_to_totals(summary.setdefault(group_key(record), _new_totals()), record)
+    
+    for totals in summary.values():
+        _round_totals(totals)
+    return summary
+
+def get_current_session() -> str:
+    """Сессия, к которой сейчас привязываются вызовы"""
+    return _session_var.get()
+
+def api_image_size(size: Tuple[int, int], target_size: Tuple[int, int] = MAX_IMAGE_SIZE) -> Tuple[int, int]:
+    """Размер изображения после подготовки для API (thumbnail с сохранением пропорций)"""
+    width, height = size
+    scale = min(1.0, target_size[0] / width, target_size[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def image_input_tokens(size: Tuple[int, int]) -> int:
+    """Оценка токенов изображения на входе Gemini"""
+    width, height = size
+    if width <= IMAGE_SMALL_SIDE and height <= IMAGE_SMALL_SIDE:
+        return IMAGE_TILE_TOKENS
+    return math.ceil(width / IMAGE_TILE_SIDE) * math.ceil(height / IMAGE_TILE_SIDE) * IMAGE_TILE_TOKENS
+
+def estimate_mockup_call(image_sizes: List[Tuple[int, int]], prompt_chars: int,
+                         model: str = GEMINI_MODEL) -> Dict:
+    """
+    Оценка одного вызова генерации мокапа до отправки
+    
+    Args:
+        image_sizes: Размеры исходных изображений запроса (товар, логотип, паттерн)
+        prompt_chars: Длина текста промпта
+        model: Модель Gemini
+    
+    Returns:
+        {prompt_tokens, output_tokens, total_tokens, cost_usd}
+    """
+    prompt_tokens = (sum(image_input_tokens(api_image_size(size)) for size in image_sizes) +
+                     math.ceil(prompt_chars / CHARS_PER_TOKEN))
+    output_tokens = OUTPUT_IMAGE_TOKENS + OUTPUT_TEXT_TOKENS_ESTIMATE
+    return {
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": prompt_tokens + output_tokens,
+        "cost_usd": round(calculate_cost(model, prompt_tokens, output_tokens, OUTPUT_IMAGE_TOKENS), 6)
+    }